@@ -0,0 +1,130 @@
+"""
+This file defines the class PatientBatch, a column-oriented collection of patients.
+
+Where a Patient holds one value per attribute, a PatientBatch holds one NumPy array per attribute,
+with one entry per patient. A categorizer that is written using only elementwise operations, e.g.,
+(patient.age >= 50) * 1, can therefore be handed a PatientBatch in place of a Patient and will
+categorize the whole batch in a single call, instead of once per patient.
+"""
+import time
+
+import numpy as np
+
+from sandbox.josh_sandbox.disease_testing.common import Patient
+
+CATEGORY_DTYPE = np.uint8   # Categories are small non-negative integers.
+ATTRIBUTE_DTYPE = np.float64
+
+
+class PatientBatch:
+    def __init__(self, **columns):
+        """
+        Create a batch from one sequence per patient attribute.
+        The keyword names are the same as those of Patient.__init__(), e.g.,
+        PatientBatch(age = [40, 62], systolic_blood_pressure = [130, 118], ...)
+        :param columns: maps each name in Patient.ATTRIBUTES to a sequence of values, one per patient.
+        """
+        missing = set(Patient.ATTRIBUTES) - columns.keys()
+        unknown = columns.keys() - set(Patient.ATTRIBUTES)
+        if missing or unknown:
+            raise ValueError("PatientBatch needs exactly the columns {expected}; missing {missing}, unknown {unknown}".format(
+                expected = Patient.ATTRIBUTES, missing = sorted(missing), unknown = sorted(unknown)))
+
+        self._size = None
+        for name in Patient.ATTRIBUTES:
+            column = np.asarray(columns[name], dtype = ATTRIBUTE_DTYPE)
+            if column.ndim != 1:
+                raise ValueError("Column {name} must be one-dimensional.".format(name = name))
+            if self._size is None:
+                self._size = len(column)
+            elif len(column) != self._size:
+                raise ValueError("All columns must have the same length.")
+            setattr(self, name, column) # Same attribute names as Patient, so categorizers can't tell the difference.
+
+    @classmethod
+    def from_patients(cls, patients):
+        """
+        Alternate constructor: build a batch out of an iterable of Patient objects.
+        :param patients: an iterable of Patient objects
+        :return: a new PatientBatch
+        """
+        patients = list(patients)
+        return cls(**{name: [getattr(patient, name) for patient in patients] for name in Patient.ATTRIBUTES})
+
+    @property
+    def columns(self):
+        """
+        Return a dict mapping each attribute name to its column array.
+        """
+        return {name: getattr(self, name) for name in Patient.ATTRIBUTES}
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, i):
+        """
+        Return the i-th patient of the batch as a Patient object.
+        """
+        return Patient(**{name: getattr(self, name)[i].item() for name in Patient.ATTRIBUTES})
+
+    def __iter__(self):
+        """
+        Iterate over the patients of the batch as Patient objects.
+        This is the slow path, used for categorizers that cannot operate on whole columns.
+        """
+        for row in zip(*(getattr(self, name).tolist() for name in Patient.ATTRIBUTES)):
+            yield Patient(*row)
+
+    def __repr__(self):
+        return "<PatientBatch of {n} patients>".format(n = len(self))
+
+
+def random_batch(n, seed = 0):
+    """
+    Return a PatientBatch of n synthetic patients, for demos and timing runs.
+    Values are quantized the way real measurements are: integer ages, blood pressure in steps of 5 mmHg, etc.
+    """
+    rng = np.random.default_rng(seed)
+    return PatientBatch(age = rng.integers(18, 90, n),
+                        systolic_blood_pressure = 5 * rng.integers(18, 40, n),
+                        fasting_blood_sugar = rng.integers(70, 140, n),
+                        cholesterol = rng.integers(140, 280, n),
+                        blood_viscosity = np.round(rng.uniform(2.0, 3.5, n), 1))
+
+
+# =============================================================================
+#                     Test
+# =============================================================================
+def test(disease_stages, n = 200_000):
+    """
+    Categorize n synthetic patients twice, once per patient the way common.test() does it,
+    and once per batch, check that both agree, and print the timings.
+    :param disease_stages: a list of disease-stage objects that implement categorize_batch()
+    """
+    batch = random_batch(n)
+    patients = list(batch)
+
+    start = time.perf_counter()
+    per_patient = {}
+    for disease_stage in disease_stages:
+        for risk_factor, method in disease_stage.categorizers:
+            per_patient[disease_stage.__class__.__name__, risk_factor] = [method(patient) for patient in patients]
+    loop_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    per_batch = {}
+    for disease_stage in disease_stages:
+        for risk_factor, categories in disease_stage.categorize_batch(batch).items():
+            per_batch[disease_stage.__class__.__name__, risk_factor] = categories
+    batch_seconds = time.perf_counter() - start
+
+    for key, categories in per_patient.items():
+        assert per_batch[key].tolist() == categories, "Batch and per-patient categories disagree for {key}".format(key = key)
+
+    print("{n} patients: per-patient loop {loop:.3f}s, batch {batch:.3f}s, speedup {speedup:.0f}x".format(
+        n = n, loop = loop_seconds, batch = batch_seconds, speedup = loop_seconds / batch_seconds))
+
+
+if __name__ == '__main__':
+    from sandbox.josh_sandbox.disease_testing.solution5 import StrokeStageA, IschemicStrokeStageA, HemorrhagicStrokeStageA, DiabetesStageA
+    test([StrokeStageA(), IschemicStrokeStageA(), HemorrhagicStrokeStageA(), DiabetesStageA()])
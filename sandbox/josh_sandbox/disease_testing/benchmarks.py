@@ -0,0 +1,336 @@
+"""
+This file benchmarks the five disease-testing solutions against each other.
+
+The solutions dispatch to categorizers in very different ways:
+    solution1: getattr() on a method name built from a string.
+    solution2: methods installed on the class by a decorator, then found by name as in solution1.
+    solution3: a per-instance dict of bound methods, filled in by hand in __init__().
+    solution4: a per-instance dict of bound methods, found by a dir() scan in __init__().
+    solution5: a class-level dict of method names, built once in __init_subclass__().
+
+For each solution, and for synthetic hierarchies of various sizes, we measure
+    class_definition_seconds:    the time to define every class of the hierarchy,
+    construction_ns:             the mean time to construct one disease-stage instance,
+    first_use_ns:                the mean time of the first categorize() call on each class, which includes any
+                                 work a solution defers until first use, such as solution5's table compilation,
+    dispatch_ns:                 the mean time of one categorize(risk_factor, patient) call, once every class
+                                 has been used,
+    screen_calls_per_second:     categorizer calls per second when screening as common.test() does,
+    instance_bytes:              the mean memory allocated per disease-stage instance.
+
+A hierarchy of size n has n disease-stage classes, arranged as a binary tree under DiseaseStageBase, and a pool
+of n risk factors. Each class defines CATEGORIZERS_PER_STAGE categorizers, drawn from the pool, and inherits
+the rest from its ancestors.
+
+Separately, --import-time measures how the start-up cost of a solution5 catalog grows with its size: for each size,
+it writes a module that defines a hierarchy of that many threshold-categorizer stages, and times importing it
+in a fresh interpreter.
+
+Each metric is the median of --repeat measurements. Results are printed as a table and can be written as JSON.
+Given a baseline JSON file from an earlier run,
+the benchmark exits with status 1 if any metric got worse than the baseline by more than a tolerance,
+so it can fail a build:
+
+    python -m sandbox.josh_sandbox.disease_testing.benchmarks --sizes 10 100 1000 --output bench.json
+    python -m sandbox.josh_sandbox.disease_testing.benchmarks --sizes 10 100 1000 --baseline bench.json --tolerance 0.25
+"""
+import argparse
+import importlib
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from sandbox.josh_sandbox.disease_testing.common import Patient
+
+SOLUTIONS = ['solution1', 'solution2', 'solution3', 'solution4', 'solution5']
+DEFAULT_SIZES = [10, 100, 1000, 10000]
+CATEGORIZERS_PER_STAGE = 5
+DISPATCH_CALLS = 100_000
+DEFAULT_REPEAT = 5
+
+# Whether a larger value of each metric is better or worse. Used by the regression check.
+HIGHER_IS_BETTER = {
+    'import_seconds': False,
+    'class_definition_seconds': False,
+    'construction_ns': False,
+    'first_use_ns': False,
+    'dispatch_ns': False,
+    'screen_calls_per_second': True,
+    'instance_bytes': False,
+}
+
+
+def load_solution(name):
+    return importlib.import_module('sandbox.josh_sandbox.disease_testing.' + name)
+
+
+# =============================================================================
+#                     Synthetic hierarchies
+# =============================================================================
+def make_categorizer_function(threshold):
+    def f(self, patient):
+        return 0 if patient.age < threshold else 1
+    return f
+
+
+def hierarchy_spec(size, seed = 0):
+    """
+    Describe a synthetic hierarchy of size classes, independently of any solution.
+    :return: a list of (class_name, parent_index, [(risk_factor, threshold), ...]) triples, parents first.
+             parent_index is None for classes that derive directly from DiseaseStageBase.
+    """
+    rng = random.Random(seed)
+    risk_factors = ['risk_factor_{j}'.format(j = j) for j in range(size)]
+    spec = []
+    for i in range(size):
+        parent_index = (i - 1) // 2 if i > 0 else None
+        chosen = rng.sample(risk_factors, min(CATEGORIZERS_PER_STAGE, size))
+        spec.append(('Stage{i}'.format(i = i), parent_index, [(risk_factor, rng.randint(20, 80)) for risk_factor in chosen]))
+    return spec
+
+
+def build_hierarchy(solution, spec):
+    """
+    Define the classes described by spec the way that the given solution module expects them to be defined.
+    :return: the list of classes, in the order of spec.
+    """
+    base = solution.DiseaseStageBase
+    name = solution.__name__.rsplit('.', 1)[1]
+    classes = []
+    for class_name, parent_index, categorizers in spec:
+        parent = base if parent_index is None else classes[parent_index]
+        method_names = ['_categorize_' + risk_factor for risk_factor, _ in categorizers]
+        functions = [make_categorizer_function(threshold) for _, threshold in categorizers]
+        risk_factors = [risk_factor for risk_factor, _ in categorizers]
+
+        if name == 'solution1':
+            namespace = dict(zip(method_names, functions))
+            namespace['risk_factors'] = set(parent.risk_factors) | set(risk_factors)
+            cls = type(class_name, (parent,), namespace)
+        elif name == 'solution2':
+            cls = type(class_name, (parent,), {})
+            for risk_factor, f in zip(risk_factors, functions):
+                solution.categorizer(cls, risk_factor)(f)
+        elif name == 'solution3':
+            cls = type(class_name, (parent,), dict(zip(method_names, functions)))
+            cls.__init__ = make_solution3_init(parent, list(zip(risk_factors, method_names)))
+        else: # solution4 and solution5 share the same decorator-based declaration.
+            namespace = {method_name: solution.categorizer(risk_factor)(f)
+                         for method_name, risk_factor, f in zip(method_names, risk_factors, functions)}
+            cls = type(class_name, (parent,), namespace)
+        classes.append(cls)
+    return classes
+
+
+def make_solution3_init(parent, categorizers):
+    def __init__(self):
+        parent.__init__(self)
+        for risk_factor, method_name in categorizers:
+            self.set_categorizer(risk_factor, getattr(self, method_name))
+    return __init__
+
+
+# =============================================================================
+#                     Measurements
+# =============================================================================
+def measure(solution_name, size, dispatch_calls = DISPATCH_CALLS, seed = 0):
+    """
+    Run every measurement for one solution and one hierarchy size.
+    :return: a dict mapping metric names (the keys of HIGHER_IS_BETTER) to values.
+    """
+    solution = load_solution(solution_name)
+    spec = hierarchy_spec(size, seed)
+    patient = Patient(age = 40, systolic_blood_pressure = 130, blood_viscosity = 2.8, fasting_blood_sugar = 90,
+                      cholesterol = 210)
+
+    start = time.perf_counter()
+    classes = build_hierarchy(solution, spec)
+    class_definition_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    disease_stages = [cls() for cls in classes]
+    construction_ns = (time.perf_counter() - start) / len(classes) * 1e9
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    more_disease_stages = [cls() for cls in classes]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    instance_bytes = sum(stat.size_diff for stat in after.compare_to(before, 'lineno')) / len(classes)
+    del more_disease_stages
+
+    start = time.perf_counter()
+    for disease_stage in disease_stages:
+        disease_stage.categorize(next(iter(disease_stage.risk_factors)), patient)
+    first_use_ns = (time.perf_counter() - start) / len(disease_stages) * 1e9
+
+    rng = random.Random(seed)
+    calls = []
+    for _ in range(dispatch_calls):
+        disease_stage = rng.choice(disease_stages)
+        calls.append((disease_stage, rng.choice(list(disease_stage.risk_factors))))
+    start = time.perf_counter()
+    for disease_stage, risk_factor in calls:
+        disease_stage.categorize(risk_factor, patient)
+    dispatch_ns = (time.perf_counter() - start) / dispatch_calls * 1e9
+
+    n_calls = 0
+    start = time.perf_counter()
+    for disease_stage in disease_stages:
+        for risk_factor, method in disease_stage.categorizers:
+            method(patient)
+            n_calls += 1
+    screen_calls_per_second = n_calls / (time.perf_counter() - start)
+
+    return {'class_definition_seconds': class_definition_seconds,
+            'construction_ns': construction_ns,
+            'first_use_ns': first_use_ns,
+            'dispatch_ns': dispatch_ns,
+            'screen_calls_per_second': screen_calls_per_second,
+            'instance_bytes': instance_bytes}
+
+
+def run(solutions = SOLUTIONS, sizes = DEFAULT_SIZES, dispatch_calls = DISPATCH_CALLS, repeat = DEFAULT_REPEAT):
+    """
+    Measure every solution at every size, repeat times, keeping the median value of each metric. A single timing,
+    or the best of a few, varies too much from run to run to compare against a baseline. The repeats are
+    interleaved (every solution and size once, then again, ...), so that a stretch of time in which the machine is
+    slow spreads over every measurement rather than skewing all the repeats of one.
+    :return: a list of result dicts, each with 'solution', 'size', and one entry per metric.
+    """
+    runs = {(solution_name, size): [] for size in sizes for solution_name in solutions}
+    for _ in range(repeat):
+        for (solution_name, size), measurements in runs.items():
+            measurements.append(measure(solution_name, size, dispatch_calls))
+
+    results = []
+    for (solution_name, size), measurements in runs.items():
+        medians = {metric: statistics.median(measurement[metric] for measurement in measurements)
+                   for metric in HIGHER_IS_BETTER if metric in measurements[0]}
+        results.append(dict(solution = solution_name, size = size, **medians))
+    return results
+
+
+# =============================================================================
+#                     Import time
+# =============================================================================
+REPOSITORY_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+
+
+def catalog_source(size, seed = 0):
+    """
+    Return the source code of a module that defines a solution5 hierarchy of size stages, as hierarchy_spec() describes.
+    Each risk factor is categorized by a threshold on one of the Patient attributes.
+    """
+    lines = ['from sandbox.josh_sandbox.disease_testing.solution5 import DiseaseStageBase, threshold_categorizer', '']
+    spec = hierarchy_spec(size, seed)
+    for class_name, parent_index, categorizers in spec:
+        parent = 'DiseaseStageBase' if parent_index is None else spec[parent_index][0]
+        lines.append('class {class_name}({parent}):'.format(class_name = class_name, parent = parent))
+        for risk_factor, threshold in categorizers:
+            attribute = Patient.ATTRIBUTES[int(risk_factor.rsplit('_', 1)[1]) % len(Patient.ATTRIBUTES)]
+            lines.append("    _categorize_{risk_factor} = threshold_categorizer('{risk_factor}', attr = '{attribute}', cut = {threshold})".format(
+                risk_factor = risk_factor, attribute = attribute, threshold = threshold))
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def measure_import_time(size, repeat = DEFAULT_REPEAT):
+    """
+    Return the median time, in seconds, that a fresh interpreter takes to import a generated catalog of size stages.
+    The time to import solution5 itself is excluded.
+    """
+    script = ('import time\n'
+              'import sandbox.josh_sandbox.disease_testing.solution5\n'
+              'start = time.perf_counter()\n'
+              'import catalog\n'
+              'print(time.perf_counter() - start)\n')
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, 'catalog.py'), 'w') as f:
+            f.write(catalog_source(size))
+        env = dict(os.environ, PYTHONPATH = os.pathsep.join([directory, REPOSITORY_ROOT]), PYTHONDONTWRITEBYTECODE = '1')
+        return statistics.median(float(subprocess.run([sys.executable, '-c', script], env = env, check = True,
+                                                      capture_output = True, text = True).stdout)
+                                 for _ in range(repeat))
+
+
+def run_import_time(sizes = DEFAULT_SIZES, repeat = DEFAULT_REPEAT):
+    """
+    :return: a list of result dicts, each with 'solution', 'size', and 'import_seconds'.
+    """
+    return [{'solution': 'solution5', 'size': size, 'import_seconds': measure_import_time(size, repeat)} for size in sizes]
+
+
+def find_regressions(results, baseline, tolerance):
+    """
+    Compare results to baseline, a list of results from an earlier run.
+    :param tolerance: the fraction by which a metric may get worse before it counts as a regression, e.g. 0.25.
+    :return: a list of human-readable descriptions of regressions; empty if there are none.
+    """
+    baseline = {(result['solution'], result['size']): result for result in baseline}
+    regressions = []
+    for result in results:
+        old = baseline.get((result['solution'], result['size']))
+        if old is None:
+            continue
+        for metric, higher in HIGHER_IS_BETTER.items():
+            if metric not in old or metric not in result:
+                continue
+            limit = old[metric] * (1 - tolerance) if higher else old[metric] * (1 + tolerance)
+            if (result[metric] < limit) if higher else (result[metric] > limit):
+                regressions.append("{solution} size {size}: {metric} {new:.4g} vs baseline {old:.4g}".format(
+                    metric = metric, new = result[metric], old = old[metric], **result))
+    return regressions
+
+
+def format_table(results):
+    header = ['solution', 'size'] + [metric for metric in HIGHER_IS_BETTER if metric in results[0]]
+    lines = ['  '.join('{:>24}'.format(column) for column in header)]
+    for result in results:
+        lines.append('  '.join('{:>24.4g}'.format(result[column]) if isinstance(result[column], float)
+                               else '{:>24}'.format(result[column]) for column in header))
+    return '\n'.join(lines)
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Benchmark the disease-testing dispatch strategies.")
+    parser.add_argument('--solutions', nargs = '*', default = SOLUTIONS, choices = SOLUTIONS)
+    parser.add_argument('--sizes', nargs = '*', type = int, default = DEFAULT_SIZES)
+    parser.add_argument('--dispatch-calls', type = int, default = DISPATCH_CALLS)
+    parser.add_argument('--repeat', type = int, default = DEFAULT_REPEAT,
+                        help = "the number of times to measure each metric; the median is kept (default {repeat})".format(
+                            repeat = DEFAULT_REPEAT))
+    parser.add_argument('--import-time', action = 'store_true',
+                        help = "measure the import time of generated solution5 catalogs instead")
+    parser.add_argument('--output', help = "write the results to this JSON file")
+    parser.add_argument('--baseline', help = "a JSON file of earlier results to check for regressions against")
+    parser.add_argument('--tolerance', type = float, default = 0.25,
+                        help = "the fraction by which a metric may get worse than the baseline (default 0.25)")
+    args = parser.parse_args(argv)
+
+    if args.import_time:
+        results = run_import_time(args.sizes, args.repeat)
+    else:
+        results = run(args.solutions, args.sizes, args.dispatch_calls, args.repeat)
+    print(format_table(results))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent = 2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION: " + regression, file = sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,304 @@
+"""
+This file defines ResultIndex, a bitmap index over screening results, for fast cohort queries such as
+"patients whose HemorrhagicStrokeStageA blood_pressure is 1 and whose DiabetesStageA blood_sugar is 1".
+
+For every (result column, category) pair, where a result column is named <stage>.<risk factor> as in
+pipeline.result_columns(), the index keeps one bitset with a bit per screened patient, set if that patient
+was put in that category. Bitsets are packed eight rows to a byte, so that 10M patients take 1.25 MB per bitset,
+and a query is a few whole-array AND/OR/NOT operations on them, followed by a population count.
+
+Queries are built from Terms with the operators &, | and ~:
+
+    index = ResultIndex()
+    for patient_ids, columns, categories in screen_chunks(chunks, classes):
+        index.append(columns, categories)
+    query = Term('HemorrhagicStrokeStageA.blood_pressure', 1) & Term('DiabetesStageA.blood_sugar', 1)
+    index.count(query)  # How many patients match.
+    index.rows(query)   # Their row numbers, in screening order.
+
+Rows are numbered in the order they were appended, starting at 0. The index is saved with zlib compression,
+which shrinks the sparse bitsets of rare categories to almost nothing.
+
+A Term whose column was never appended, or whose category no patient was put in, raises KeyError when the query is
+evaluated, so that a misspelled name is not mistaken for an empty cohort; keys() lists the pairs that can be queried.
+"""
+import json
+import time
+
+import numpy as np
+
+BIT_ORDER = 'little' # Row r is bit r % 8 of byte r // 8.
+
+if hasattr(np, 'bitwise_count'): # NumPy 2.0+
+    def _popcount(bits):
+        return int(np.bitwise_count(bits).sum(dtype = np.int64))
+else:
+    _BITS_IN_BYTE = np.array([bin(i).count('1') for i in range(256)], dtype = np.uint8)
+
+    def _popcount(bits):
+        return int(_BITS_IN_BYTE[bits].sum(dtype = np.int64))
+
+
+# =============================================================================
+#                     Queries
+# =============================================================================
+class Query:
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+
+class Term(Query):
+    def __init__(self, column, category):
+        """
+        Match the patients put in category for column.
+        :param column: a result column name, <stage>.<risk factor>
+        """
+        self.column = column
+        self.category = int(category)
+
+    def evaluate(self, index):
+        return index.bitset(self.column, self.category).copy()
+
+    def __repr__(self):
+        return "{column}={category}".format(column = self.column, category = self.category)
+
+
+class And(Query):
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+
+    def evaluate(self, index):
+        bits = self.left.evaluate(index)
+        return np.bitwise_and(bits, self.right.evaluate(index), out = bits)
+
+    def __repr__(self):
+        return "({left} & {right})".format(left = self.left, right = self.right)
+
+
+class Or(Query):
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+
+    def evaluate(self, index):
+        bits = self.left.evaluate(index)
+        return np.bitwise_or(bits, self.right.evaluate(index), out = bits)
+
+    def __repr__(self):
+        return "({left} | {right})".format(left = self.left, right = self.right)
+
+
+class Not(Query):
+    def __init__(self, operand):
+        self.operand = operand
+
+    def evaluate(self, index):
+        bits = self.operand.evaluate(index)
+        return index._clear_padding(np.invert(bits, out = bits))
+
+    def __repr__(self):
+        return "~{operand}".format(operand = self.operand)
+
+
+# =============================================================================
+#                     Index
+# =============================================================================
+class ResultIndex:
+    def __init__(self):
+        self._size = 0      # The number of rows indexed so far.
+        self._bitsets = {}  # Maps (column, category) to a zero-padded byte buffer, of which the first _nbytes are in use.
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def _nbytes(self):
+        return (self._size + 7) // 8
+
+    def keys(self):
+        """
+        Return the (column, category) pairs that have a bitset, sorted.
+        """
+        return sorted(self._bitsets)
+
+    def bitset(self, column, category):
+        """
+        Return the packed bitset of the patients put in category for column. This is a view; do not modify it.
+        :raise KeyError: if no patient was put in category for column, or column is not a result column we index.
+        """
+        bits = self._bitsets.get((column, category))
+        if bits is None:
+            if not any(key[0] == column for key in self._bitsets):
+                raise KeyError("Unknown result column: {column}".format(column = column))
+            raise KeyError("No patient is in category {category} of {column}".format(category = category, column = column))
+        return bits[:self._nbytes]
+
+    def _clear_padding(self, bits):
+        """
+        Clear the bits past the last row, which NOT sets.
+        """
+        if self._size % 8:
+            bits[-1] &= (1 << (self._size % 8)) - 1
+        return bits
+
+    # =============================================================================
+    #                     Appending
+    # =============================================================================
+    def append(self, columns, categories):
+        """
+        Index another chunk of screening results, as yielded by pipeline.screen_chunks().
+        :param columns: the names of the result columns.
+        :param categories: a (patient x column) array of categories.
+        """
+        categories = np.asarray(categories)
+        if categories.ndim != 2 or categories.shape[1] != len(columns):
+            raise ValueError("categories must have one column per name in columns.")
+        start, size = self._size, self._size + len(categories)
+        nbytes = (size + 7) // 8
+        for j, column in enumerate(columns):
+            values = categories[:, j]
+            for category in np.unique(values).tolist():
+                key = (column, category)
+                if key not in self._bitsets:
+                    self._bitsets[key] = np.zeros(max(nbytes, 64), dtype = np.uint8)
+                self._write_bits(key, start, values == category)
+        # Categories that no patient of this chunk fell in still need room for its (zero) bits.
+        for key, buffer in self._bitsets.items():
+            if len(buffer) < nbytes:
+                self._bitsets[key] = self._grow(buffer, nbytes)
+        self._size = size
+
+    @staticmethod
+    def _grow(buffer, nbytes):
+        grown = np.zeros(max(nbytes, 2 * len(buffer)), dtype = np.uint8)
+        grown[:len(buffer)] = buffer
+        return grown
+
+    def _write_bits(self, key, start, bits):
+        buffer = self._bitsets[key]
+        end = (start + len(bits) + 7) // 8
+        if len(buffer) < end:
+            buffer = self._bitsets[key] = self._grow(buffer, end)
+        offset = start % 8
+        if offset: # The first byte is shared with earlier rows; repack those rows along with the new ones.
+            earlier = np.unpackbits(buffer[start // 8:start // 8 + 1], count = offset, bitorder = BIT_ORDER)
+            bits = np.concatenate([earlier.astype(bool), bits])
+        packed = np.packbits(bits, bitorder = BIT_ORDER)
+        buffer[start // 8:start // 8 + len(packed)] = packed
+
+    # =============================================================================
+    #                     Querying
+    # =============================================================================
+    def evaluate(self, query):
+        """
+        Return the packed bitset of the rows that match query.
+        """
+        return query.evaluate(self)
+
+    def count(self, query):
+        """
+        Return the number of rows that match query.
+        """
+        return _popcount(query.evaluate(self))
+
+    def rows(self, query):
+        """
+        Return the row numbers that match query, in increasing order.
+        """
+        return np.flatnonzero(np.unpackbits(query.evaluate(self), count = self._size, bitorder = BIT_ORDER))
+
+    # =============================================================================
+    #                     Persistence
+    # =============================================================================
+    def save(self, path):
+        """
+        Save the index to path, as a compressed .npz file.
+        """
+        keys = self.keys()
+        arrays = {'bitset{i}'.format(i = i): self._bitsets[key][:self._nbytes] for i, key in enumerate(keys)}
+        header = json.dumps({'size': self._size, 'keys': keys})
+        np.savez_compressed(path, header = np.array(header), **arrays)
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        with np.load(path, allow_pickle = False) as data:
+            header = json.loads(str(data['header']))
+            index._size = header['size']
+            for i, (column, category) in enumerate(header['keys']):
+                index._bitsets[(column, category)] = data['bitset{i}'.format(i = i)].copy()
+        return index
+
+
+def index_results(screened_chunks, index = None):
+    """
+    Append every chunk of screened_chunks, as yielded by pipeline.screen_chunks(), to index.
+    :param index: the ResultIndex to append to; defaults to a new one.
+    :return: the index.
+    """
+    index = ResultIndex() if index is None else index
+    for _, columns, categories in screened_chunks:
+        index.append(columns, categories)
+    return index
+
+
+# =============================================================================
+#                     Test
+# =============================================================================
+def test(disease_stage_classes, n = 10_000_000, chunk_size = 1_000_000):
+    import os
+    import tempfile
+    from sandbox.josh_sandbox.disease_testing.batch import random_batch
+    from sandbox.josh_sandbox.disease_testing.pipeline import screen_chunks
+
+    # Odd-sized chunks, so that appends start in the middle of a byte.
+    sizes = [chunk_size + 3] * (n // chunk_size - 1)
+    sizes.append(n - sum(sizes))
+    chunks = ((None, random_batch(size, seed = i)) for i, size in enumerate(sizes))
+    start = time.perf_counter()
+    index = index_results(screen_chunks(chunks, disease_stage_classes))
+    print("Screened and indexed {n} patients in {s:.2f}s".format(n = len(index), s = time.perf_counter() - start))
+
+    query = Term('HemorrhagicStrokeStageA.blood_pressure', 1) & Term('DiabetesStageA.blood_sugar', 1)
+    for q in [query, query | ~Term('StrokeStageA.age', 0), ~query]:
+        start = time.perf_counter()
+        count = index.count(q)
+        print("{q}: {count} patients in {ms:.1f}ms".format(q = q, count = count, ms = (time.perf_counter() - start) * 1000))
+    assert index.count(query) + index.count(~query) == n
+
+    # Check the index against a brute-force scan of the last chunk.
+    batch = random_batch(sizes[-1], seed = len(sizes) - 1)
+    classes = {cls.__name__: cls for cls in disease_stage_classes}
+    matches = ((classes['HemorrhagicStrokeStageA']().categorize_batch(batch)['blood_pressure'] == 1)
+               & (classes['DiabetesStageA']().categorize_batch(batch)['blood_sugar'] == 1))
+    expected = np.flatnonzero(matches) + (n - sizes[-1])
+    rows = index.rows(query)
+    assert np.array_equal(rows[rows >= n - sizes[-1]], expected)
+
+    # A misspelled column or an unused category is an error, not an empty cohort.
+    for term in [Term('DiabetesStageA.blood_suger', 1), Term('DiabetesStageA.blood_sugar', 7)]:
+        try:
+            index.count(query & term)
+        except KeyError:
+            pass
+        else:
+            raise AssertionError("{term} did not raise KeyError".format(term = term))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'results_index.npz')
+        index.save(path)
+        print("Saved index: {mb:.1f} MB on disk".format(mb = os.path.getsize(path) / 2 ** 20))
+        loaded = ResultIndex.load(path)
+    assert loaded.count(query) == index.count(query) and len(loaded) == n
+
+
+if __name__ == '__main__':
+    from sandbox.josh_sandbox.disease_testing.solution5 import StrokeStageA, IschemicStrokeStageA, HemorrhagicStrokeStageA, DiabetesStageA
+    test([StrokeStageA, IschemicStrokeStageA, HemorrhagicStrokeStageA, DiabetesStageA])
@@ -0,0 +1,74 @@
+"""
+This file defines LRUCache, the bounded cache behind DiseaseStageBase.enable_cache().
+
+Patient attributes are heavily quantized in practice (integer ages, blood pressure in steps of 5 mmHg),
+so the same attribute values come up again and again. A categorizer that declares which attributes it reads
+can therefore have its results cached under just those values. The cache keeps counters of its hits, misses
+and evictions, so that it can be sized from real traffic.
+
+functools.lru_cache would do the caching, but it does not count evictions and cannot be shared between
+the categorizers of several classes, so we keep our own.
+"""
+from collections import OrderedDict
+
+MISSING = object() # Returned by LRUCache.get() for keys that are not in the cache.
+
+
+class LRUCache:
+    def __init__(self, maxsize = 4096):
+        """
+        :param maxsize: the maximum number of entries. When it is reached, adding an entry evicts the least
+                        recently used one.
+        """
+        if maxsize < 1:
+            raise ValueError("maxsize must be positive.")
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Return the value cached under key, marking it as most recently used, or MISSING.
+        """
+        value = self._entries.get(key, MISSING)
+        if value is MISSING:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last = False)
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Empty the cache and reset its counters.
+        """
+        self._entries.clear()
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def stats(self):
+        """
+        Return a dict of the cache's counters, its current size, and its hit rate.
+        """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self),
+                'maxsize': self.maxsize,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    def __repr__(self):
+        return "<LRUCache {size}/{maxsize}: {hits} hits, {misses} misses, {evictions} evictions>".format(**self.stats)
@@ -0,0 +1,346 @@
+"""
+This file defines load_catalog(), which builds DiseaseStageBase subclasses from a declarative catalog
+instead of hand-written Python classes.
+
+A catalog is a JSON or TOML file listing stages. Each stage has a name, an optional parent (another stage of
+the catalog), and its threshold categorizers, in the same form as DiseaseStageBase.rule_table() returns them:
+
+    {"stages": [
+        {"name": "StrokeStageA",
+         "categorizers": {"age": {"attribute": "age", "threshold": 50},
+                          "blood_pressure": {"attribute": "systolic_blood_pressure", "threshold": 120}}},
+        {"name": "IschemicStrokeStageA", "parent": "StrokeStageA",
+         "categorizers": {"blood_viscosity": {"attribute": "blood_viscosity", "threshold": 2.7}}}
+    ]}
+
+A categorizer's comparator defaults to '>=', as in threshold_categorizer(). A categorizer with several bands lists
+its cutpoints instead, as in banded_categorizer():
+
+    "blood_pressure": {"attribute": "systolic_blood_pressure", "cutpoints": [120, 130, 140, 180]}
+
+See example_catalog.json.
+
+Parsing and checking a large catalog takes longer than building its classes, so the first load writes a compiled
+cache next to the catalog (<catalog>.cache). It holds the checked stage definitions, already in inheritance order,
+in marshal format. Later loads read the cache instead of the catalog, provided that its format version matches
+and that it was built from a catalog with the same SHA-256 digest; otherwise the cache is rebuilt.
+
+Classes cannot be cached, since they only exist at run time, so instead load_catalog() returns a Catalog, a mapping
+from stage names to classes that builds each class (and its ancestors) the first time it is looked up. A process
+that loads a catalog of thousands of stages but screens against a few of them builds only those few.
+
+The classes are not attributes of any module, so they cannot be pickled by reference, as classes usually are.
+Instead each pickles as its base class, its catalog's key (a digest of its definitions) and the definitions of
+the stage and its ancestors, and unpickling looks the catalog up by key, or rebuilds the stage in a process that
+has no such catalog. So catalog stages can be sent to other processes, as ProcessPoolScreener does, and
+unpickling a stage in the process that built it returns the very same class.
+"""
+import copyreg
+import hashlib
+import json
+import marshal
+import os
+import time
+import weakref
+from collections.abc import Mapping
+
+from sandbox.josh_sandbox.disease_testing.rules import BandRule, rule_from_dict
+from sandbox.josh_sandbox.disease_testing.solution5 import DiseaseStageBase, banded_categorizer, threshold_categorizer
+
+CACHE_MAGIC = b'DSCATLG\0'
+CACHE_FORMAT_VERSION = 2 # Increment whenever the layout of the cached definitions changes.
+CACHE_SUFFIX = '.cache'
+
+
+class CatalogError(ValueError):
+    pass
+
+
+# =============================================================================
+#                     Parsing
+# =============================================================================
+def parse_catalog(data, file_format):
+    """
+    Parse and check the text of a catalog.
+    :param data: the catalog's contents, as bytes.
+    :param file_format: 'json' or 'toml'
+    :return: a list of (name, parent_name or None, [(risk_factor, rule_dict), ...]) triples, ordered so that every
+             stage comes after its parent. Each rule_dict is the to_dict() of a checked ThresholdRule or BandRule.
+    """
+    try:
+        if file_format == 'json':
+            document = json.loads(data)
+        elif file_format == 'toml':
+            import tomllib # Python 3.11+; only needed for TOML catalogs.
+            document = tomllib.loads(data.decode('utf-8'))
+        else:
+            raise CatalogError("Unknown catalog format: {file_format}".format(file_format = file_format))
+    except (UnicodeDecodeError, ValueError) as e:
+        if isinstance(e, CatalogError):
+            raise
+        raise CatalogError("Catalog is not valid {file_format}: {e}".format(file_format = file_format, e = e)) from None
+    if not isinstance(document, dict) or not isinstance(document.get('stages', []), list):
+        raise CatalogError("A catalog must be an object with a list of stages.")
+
+    stages = {}
+    for i, stage in enumerate(document.get('stages', [])):
+        if not isinstance(stage, dict) or not isinstance(stage.get('name'), str):
+            raise CatalogError("Stage {i} is not an object with a name.".format(i = i))
+        name = stage['name']
+        if name in stages:
+            raise CatalogError("Stage {name} is defined twice.".format(name = name))
+        if not isinstance(stage.get('categorizers', {}), dict):
+            raise CatalogError("The categorizers of stage {name} are not an object.".format(name = name))
+        categorizers = []
+        for risk_factor, d in stage.get('categorizers', {}).items():
+            try:
+                rule = rule_from_dict(d)
+            except (KeyError, TypeError, ValueError) as e:
+                raise CatalogError("Bad categorizer {risk_factor} in stage {name}: {e}".format(risk_factor = risk_factor,
+                                                                                              name = name, e = e)) from None
+            categorizers.append((risk_factor, rule.to_dict()))
+        stages[name] = (name, stage.get('parent'), categorizers)
+
+    ordered = []
+    placed = set()
+    def place(name, path):
+        if name in placed:
+            return
+        if name in path:
+            raise CatalogError("Stage {name} inherits from itself.".format(name = name))
+        parent = stages[name][1]
+        if parent is not None:
+            if parent not in stages:
+                raise CatalogError("Stage {name} has unknown parent {parent}.".format(name = name, parent = parent))
+            place(parent, path | {name})
+        ordered.append(stages[name])
+        placed.add(name)
+
+    for name in stages:
+        place(name, frozenset())
+    return ordered
+
+
+# =============================================================================
+#                     Cache
+# =============================================================================
+def cache_path(catalog_path):
+    return catalog_path + CACHE_SUFFIX
+
+
+def read_cache(path, digest):
+    """
+    Return the stage definitions stored in the cache file path, or None if it is missing, of another
+    format version, or was built from a catalog whose digest is not digest.
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    header = CACHE_MAGIC + CACHE_FORMAT_VERSION.to_bytes(4, 'little') + digest
+    if not data.startswith(header):
+        return None
+    try:
+        return marshal.loads(data[len(header):])
+    except (EOFError, ValueError, TypeError):
+        return None
+
+
+def write_cache(path, digest, definitions):
+    """
+    Write definitions to the cache file path. The file is replaced atomically, so a concurrent reader sees either
+    the old cache or the new one. Failing to write the cache (e.g., in a read-only directory) is not an error.
+    """
+    header = CACHE_MAGIC + CACHE_FORMAT_VERSION.to_bytes(4, 'little') + digest
+    temporary_path = '{path}.{pid}.tmp'.format(path = path, pid = os.getpid())
+    try:
+        with open(temporary_path, 'wb') as f:
+            f.write(header + marshal.dumps(definitions))
+        os.replace(temporary_path, path)
+    except OSError:
+        try:
+            os.remove(temporary_path)
+        except OSError:
+            pass
+
+
+# =============================================================================
+#                     Loading
+# =============================================================================
+_catalogs = weakref.WeakValueDictionary() # Maps (base, key) to the first Catalog of that key built in this process.
+
+
+class _CatalogStageType(type):
+    """
+    The metaclass of the classes that a Catalog builds. It exists so that they can be pickled; see _reduce_stage().
+    """
+
+
+def _reduce_stage(cls):
+    catalog = cls.__dict__.get('_catalog')
+    if catalog is None: # A hand-written subclass of a catalog stage is pickled by reference, as usual.
+        return cls.__qualname__
+    _catalogs.setdefault((catalog.base, catalog.key), catalog) # In case an equal catalog was registered, then freed.
+    return _unpickle_stage, (catalog.base, catalog.key, catalog.ancestry(cls.__name__), cls.__name__)
+
+
+def _unpickle_stage(base, key, ancestry, name):
+    catalog = _catalogs.get((base, key))
+    if catalog is None:
+        catalog = Catalog(ancestry, base, key = key)
+    else:
+        for stage_name, parent, categorizers in ancestry: # Perhaps a stage this process has not seen before.
+            catalog._definitions.setdefault(stage_name, (parent, categorizers))
+    return catalog[name]
+
+
+copyreg.pickle(_CatalogStageType, _reduce_stage)
+
+
+class Catalog(Mapping):
+    """
+    A read-only mapping from stage names to disease-stage classes, which builds each class on first lookup.
+    Iterating over it yields the stage names parents first.
+    """
+    def __init__(self, definitions, base = DiseaseStageBase, module = __name__, key = None):
+        """
+        :param definitions: as returned by parse_catalog()
+        :param base: the class that stages without a parent derive from.
+        :param module: the __module__ of the classes built.
+        :param key: identifies the catalog when its classes are unpickled; by default, a digest of definitions.
+        """
+        definitions = list(definitions)
+        self._definitions = {name: (parent, categorizers) for name, parent, categorizers in definitions}
+        self._classes = {}
+        self.base = base
+        self.module = module
+        self.key = key if key is not None else hashlib.sha256(marshal.dumps(definitions)).hexdigest()
+        _catalogs.setdefault((base, self.key), self)
+
+    def __getitem__(self, name):
+        cls = self._classes.get(name)
+        if cls is not None:
+            return cls
+
+        # Find the chain of ancestors that have not been built yet, then build them from the top down.
+        chain = []
+        while name is not None and name not in self._classes:
+            chain.append(name)
+            name = self._definitions[name][0]
+        for name in reversed(chain):
+            self._classes[name] = self._build(name)
+        return self._classes[chain[0]]
+
+    def __iter__(self):
+        return iter(self._definitions)
+
+    def __len__(self):
+        return len(self._definitions)
+
+    def ancestry(self, name):
+        """
+        Return the definitions, as parse_catalog() returns them, of the stage name and its ancestors, parents first.
+        """
+        definitions = []
+        while name is not None:
+            parent, categorizers = self._definitions[name]
+            definitions.append((name, parent, categorizers))
+            name = parent
+        return definitions[::-1]
+
+    @property
+    def built(self):
+        """
+        Return the number of classes built so far.
+        """
+        return len(self._classes)
+
+    def _build(self, name):
+        parent, categorizers = self._definitions[name]
+        namespace = {'__module__': self.module, '__slots__': (), '_catalog': self}
+        for risk_factor, d in categorizers:
+            rule = rule_from_dict(d)
+            if isinstance(rule, BandRule):
+                f = banded_categorizer(risk_factor, attr = rule.attribute, cutpoints = rule.cutpoints)
+            else:
+                f = threshold_categorizer(risk_factor, attr = rule.attribute, cut = rule.threshold, comparator = rule.comparator)
+            namespace['_categorize_' + risk_factor] = f
+        return _CatalogStageType(name, (self._classes[parent] if parent is not None else self.base,), namespace)
+
+
+def load_catalog(path, base = DiseaseStageBase, use_cache = True):
+    """
+    Build the disease-stage classes defined by the catalog at path.
+    :param path: a .json or .toml catalog.
+    :param base: the class that stages without a parent derive from.
+    :param use_cache: whether to read and write the compiled cache next to the catalog.
+    :return: a Catalog, mapping stage names to classes.
+    """
+    file_format = os.path.splitext(path)[1].lower().lstrip('.')
+    with open(path, 'rb') as f:
+        data = f.read()
+    digest = hashlib.sha256(data).digest()
+
+    definitions = read_cache(cache_path(path), digest) if use_cache else None
+    if definitions is None:
+        definitions = parse_catalog(data, file_format)
+        if use_cache:
+            write_cache(cache_path(path), digest, definitions)
+    return Catalog(definitions, base)
+
+
+# =============================================================================
+#                     Test
+# =============================================================================
+def test(path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'example_catalog.json')):
+    import shutil
+    import tempfile
+    from sandbox.josh_sandbox.disease_testing import solution5
+
+    # Load a copy of the catalog, so that its cache is written to a temporary directory, not next to path.
+    with tempfile.TemporaryDirectory() as directory:
+        copy_path = shutil.copy(path, directory)
+        for attempt in ['without cache', 'with cache']:
+            start = time.perf_counter()
+            classes = load_catalog(copy_path)
+            print("Loaded {n} stages {attempt} in {ms:.2f}ms".format(n = len(classes), attempt = attempt,
+                                                                    ms = (time.perf_counter() - start) * 1000))
+        assert os.path.exists(cache_path(copy_path))
+
+    # The example catalog describes the same stages as solution5 does by hand.
+    assert classes.built == 0
+    for name, cls in classes.items():
+        assert cls.rule_table() == getattr(solution5, name).rule_table(), "Catalog stage {name} differs".format(name = name)
+    assert issubclass(classes['IschemicStrokeStageA'], classes['StrokeStageA'])
+
+    # Catalog stages pickle: to themselves in this process, and to an equivalent class in another.
+    import pickle
+    import subprocess
+    import sys
+    cls = classes['IschemicStrokeStageA']
+    assert pickle.loads(pickle.dumps(cls)) is cls and pickle.loads(pickle.dumps(cls())) is cls()
+    script = ('import pickle, sys\n'
+              'cls = pickle.loads(sys.stdin.buffer.read())\n'
+              'print(cls.__name__, cls.__mro__[1].__name__, sorted(cls.rule_table()))\n')
+    output = subprocess.run([sys.executable, '-c', script], input = pickle.dumps(cls), capture_output = True, check = True,
+                            env = dict(os.environ, PYTHONPATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))))
+    assert output.stdout.decode().split()[:2] == ['IschemicStrokeStageA', 'StrokeStageA'], output
+
+    # Malformed catalogs raise CatalogError.
+    bad_rule = '{{"stages": [{{"name": "A", "categorizers": {{"age": {rule}}}}}]}}'
+    for bad in [b'[1, 2]', b'{"stages": [5]}', b'{"stages": [{"parent": "A"}]}', b'{"stages": [{"name": "A", "categorizers": 5}]}',
+                b'not json'] + [bad_rule.format(rule = rule).encode() for rule in [
+                    '{"attribute": "age", "threshold": "abc"}', '{"attribute": "age", "threshold": null}',
+                    '{"attribute": "age", "threshold": true}', '{"attribute": "age", "cutpoints": ["40", "60"]}']]:
+        try:
+            parse_catalog(bad, 'json')
+        except CatalogError:
+            pass
+        else:
+            raise AssertionError("{bad} parsed".format(bad = bad))
+
+
+if __name__ == '__main__':
+    from sandbox.josh_sandbox.disease_testing import catalog # So that pickles refer to the module, not to __main__.
+    catalog.test()
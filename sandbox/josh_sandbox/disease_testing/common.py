@@ -2,6 +2,10 @@
 This file defines the class Patient.
 """
 class Patient:
+    # The names of the attributes every patient carries, in constructor order.
+    # Code that stores patients column-wise (see batch.PatientBatch) uses this to lay out its columns.
+    ATTRIBUTES = ('age', 'systolic_blood_pressure', 'fasting_blood_sugar', 'cholesterol', 'blood_viscosity')
+
     def __init__(self,
                  age,
                  systolic_blood_pressure,
@@ -16,17 +20,24 @@ class Patient:
         self.blood_viscosity = blood_viscosity
 
 
-def test(disease_stages):
+def test(disease_stages, stats = None):
+    """
+    :param stats: if given, a population_stats.PopulationStats to add the patient and its categories to.
+    """
     patient = Patient(age = 40,
                       systolic_blood_pressure = 130,
                       blood_viscosity = 2.8,
                       fasting_blood_sugar = 90,
                       cholesterol = 210)
 
+    if stats is not None:
+        stats.add_patient(patient)
     for disease_stage in disease_stages:
         print()
         for risk_factor, method in disease_stage.categorizers:
             category = method(patient)
+            if stats is not None:
+                stats.add_category(disease_stage.__class__.__name__, risk_factor, category)
             print("{disease_stage}, {risk_factor} -> {category}".format(disease_stage = disease_stage.__class__.__name__,
                                                                         risk_factor = risk_factor,
                                                                         category = category))
\ No newline at end of file
@@ -0,0 +1,148 @@
+"""
+This file defines incremental re-screening for patients whose vital signs are updated by a monitoring feed.
+
+ObservablePatient is a Patient whose attributes are validating properties, in the style of IngredientAmount
+in josh_sandbox2.py. Setting an attribute to a new value notifies the patient's observers of the change, and
+records the attribute's name in patient.changed_attributes, until the caller calls patient.clear_changes().
+
+IncrementalScreener keeps, for each patient it watches, the current result vector of every disease stage.
+It builds a dependency map from the categorizer registry (DiseaseStageBase.attributes_read()), so that
+when an attribute changes it recomputes only the categorizers that read that attribute. Updating one
+attribute therefore costs O(affected categorizers), not O(all categorizers).
+"""
+from numbers import Real
+
+from sandbox.josh_sandbox.disease_testing.common import Patient
+
+
+def _observed_attribute(name):
+    """
+    Return a property for the Patient attribute name that validates new values and notifies observers of changes.
+    """
+    private_name = '_' + name
+
+    def getter(self):
+        return getattr(self, private_name)
+
+    def setter(self, v):
+        assert isinstance(v, Real) and v >= 0, "{name} must be a non-negative number.".format(name = name)
+        if getattr(self, private_name, None) == v:
+            return
+        setattr(self, private_name, v)
+        self._changed.add(name)
+        for observer in self._observers:
+            observer(self, name)
+
+    return property(getter, setter, doc = "The patient's {name}.".format(name = name))
+
+
+class ObservablePatient(Patient):
+    def __init__(self, *args, **kwds):
+        self._observers = [] # Must exist before the attributes are first set, below.
+        self._changed = set()
+        super().__init__(*args, **kwds)
+        self._changed.clear() # Setting the initial values is not a change.
+
+    @property
+    def changed_attributes(self):
+        """
+        The set of names of the attributes that have changed value since we were made or clear_changes() was last called.
+        """
+        return frozenset(self._changed)
+
+    def clear_changes(self):
+        self._changed.clear()
+
+    def add_observer(self, observer):
+        """
+        Call observer(patient, attribute_name) whenever one of our attributes changes value.
+        """
+        self._observers.append(observer)
+
+    def remove_observer(self, observer):
+        self._observers.remove(observer)
+
+
+for _name in Patient.ATTRIBUTES:
+    setattr(ObservablePatient, _name, _observed_attribute(_name))
+del _name
+
+
+class IncrementalScreener:
+    def __init__(self, disease_stage_classes):
+        """
+        :param disease_stage_classes: a list of DiseaseStageBase subclasses.
+        """
+        self.disease_stages = [cls() for cls in disease_stage_classes]
+        self._results = {}      # Maps each watched patient to its list of result vectors, one per disease stage.
+        self.recomputations = 0 # The number of categorizer calls made so far; useful for checking incrementality.
+
+        # Map each patient attribute to the (stage_index, position, bound_method) of every categorizer that reads it,
+        # where position is the index of the categorizer's risk factor in the stage's risk_factor_order.
+        self._dependents = {name: [] for name in Patient.ATTRIBUTES}
+        for i, disease_stage in enumerate(self.disease_stages):
+            for position, risk_factor in enumerate(disease_stage.risk_factor_order):
+                method = disease_stage.get_categorizer(risk_factor)
+                for name in disease_stage.attributes_read(risk_factor):
+                    self._dependents[name].append((i, position, method))
+
+    def watch(self, patient):
+        """
+        Screen patient in full, and from now on keep its results up to date as its attributes change.
+        :param patient: an ObservablePatient
+        """
+        if patient in self._results:
+            return
+        self._results[patient] = [list(disease_stage.screen(patient)) for disease_stage in self.disease_stages]
+        self.recomputations += sum(len(disease_stage.risk_factor_order) for disease_stage in self.disease_stages)
+        patient.add_observer(self._attribute_changed)
+
+    def unwatch(self, patient):
+        patient.remove_observer(self._attribute_changed)
+        del self._results[patient]
+
+    def results(self, patient):
+        """
+        Return a dict mapping each disease-stage class to the tuple of patient's current categories,
+        ordered as the class's risk_factor_order.
+        """
+        return {disease_stage.__class__: tuple(vector)
+                for disease_stage, vector in zip(self.disease_stages, self._results[patient])}
+
+    def _attribute_changed(self, patient, name):
+        vectors = self._results[patient]
+        for i, position, method in self._dependents[name]:
+            vectors[i][position] = method(patient)
+        self.recomputations += len(self._dependents[name])
+
+
+# =============================================================================
+#                     Test
+# =============================================================================
+def test(disease_stage_classes):
+    patient = ObservablePatient(age = 40,
+                                systolic_blood_pressure = 130,
+                                blood_viscosity = 2.8,
+                                fasting_blood_sugar = 90,
+                                cholesterol = 210)
+    screener = IncrementalScreener(disease_stage_classes)
+    screener.watch(patient)
+    assert patient.changed_attributes == set()
+
+    for name, value in [('systolic_blood_pressure', 175), ('age', 55), ('fasting_blood_sugar', 101)]:
+        before = screener.recomputations
+        setattr(patient, name, value)
+        print("{name} -> {value}: {n} categorizers recomputed".format(name = name, value = value,
+                                                                     n = screener.recomputations - before))
+        for cls, categories in screener.results(patient).items():
+            assert categories == cls().screen(patient), "Incremental results are stale for {cls}".format(cls = cls.__name__)
+
+    patient.age = 55 # Unchanged value: no notification, no change recorded.
+    assert patient.changed_attributes == {'systolic_blood_pressure', 'age', 'fasting_blood_sugar'}
+    patient.clear_changes()
+    assert patient.changed_attributes == set()
+
+
+if __name__ == '__main__':
+    from sandbox.josh_sandbox.disease_testing.solution5 import StrokeStageA, IschemicStrokeStageA, HemorrhagicStrokeStageA, DiabetesStageA
+    test([StrokeStageA, IschemicStrokeStageA, HemorrhagicStrokeStageA, DiabetesStageA])
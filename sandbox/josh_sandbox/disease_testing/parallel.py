@@ -0,0 +1,296 @@
+"""
+This file defines ProcessPoolScreener, which spreads the screening of one large patient file over several processes.
+
+Screening is CPU-bound Python, so a single process can use only one core. ProcessPoolScreener splits the input
+file into byte ranges ("shards") that each start at the beginning of a line, and hands the shards to a pool of
+worker processes. Each worker imports the disease-stage classes once, when it starts, screens its shards
+chunk by chunk exactly as pipeline.screen_chunks() does, and sends back, per shard, one compact uint8 array of
+categories and one NumPy array of patient ids. The parent yields the shard results in file order, so the output
+is the same, byte for byte, as that of a single-process pipeline.run(), whatever the number of workers.
+At most MAX_IN_FLIGHT_PER_WORKER shards per worker are submitted at a time, so that the parent's memory does not
+grow with the size of the file when its consumer is slower than the workers.
+
+Disease-stage classes must be picklable: defined at module level, or built by a catalog.Catalog, since that is
+how they are sent to the workers.
+
+Shards are split at newlines, so a CSV file with quoted fields that contain newlines cannot be screened in
+parallel; a worker that meets such a field raises ValueError. Use pipeline.run() for such files.
+
+    python -m sandbox.josh_sandbox.disease_testing.parallel patients.csv results.csv --workers 4
+    python -m sandbox.josh_sandbox.disease_testing.parallel --test
+"""
+import argparse
+import csv
+import io
+import itertools
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from sandbox.josh_sandbox.disease_testing import pipeline
+from sandbox.josh_sandbox.disease_testing.batch import CATEGORY_DTYPE
+
+MAX_IN_FLIGHT_PER_WORKER = 2
+
+_worker_disease_stage_classes = None # Set once per worker process by _init_worker().
+
+
+def _init_worker(disease_stage_classes):
+    global _worker_disease_stage_classes
+    _worker_disease_stage_classes = disease_stage_classes
+
+
+def _read_shard(path, file_format, start, end, fieldnames):
+    """
+    Lazily read the records of the lines that begin in the byte range [start, end) of path.
+    """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        position = start
+        while position < end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            text = line.decode('utf-8')
+            if file_format == 'csv':
+                if text.count('"') % 2: # An unbalanced quote: a quoted field continues on another line.
+                    raise ValueError("{path}: a quoted CSV field spans lines near byte {position}, so the file cannot be "
+                                     "split into shards; screen it with pipeline.run().".format(path = path,
+                                                                                               position = position))
+                row = next(csv.reader(io.StringIO(text)), [])
+                if not row: # An empty line, which csv.DictReader skips too.
+                    continue
+                # Fill in short rows and keep the extra fields of long ones as csv.DictReader does, so that records
+                # are exactly those that pipeline.read_records() reads.
+                record = dict(zip(fieldnames, row))
+                if len(row) < len(fieldnames):
+                    record.update(dict.fromkeys(fieldnames[len(row):]))
+                elif len(row) > len(fieldnames):
+                    record[None] = row[len(fieldnames):]
+                yield record
+            elif text.strip():
+                yield json.loads(text)
+
+
+def _screen_shard(path, file_format, start, end, fieldnames, chunk_size):
+    """
+    Screen one shard in a worker process.
+    :return: (patient_ids, categories), where patient_ids is as _pack_ids() returns it, and categories is a
+             (patient x column) uint8 array.
+    """
+    records = _read_shard(path, file_format, start, end, fieldnames)
+    patient_ids = []
+    unnumbered = [] # The positions in the shard of the records with no patient_id field, unlike those whose id is None.
+    parts = []
+
+    def record_ids(records):
+        for record in records:
+            if 'patient_id' not in record:
+                unnumbered.append(len(patient_ids))
+            patient_ids.append(record.get('patient_id'))
+            yield record
+
+    chunks = pipeline.iter_chunks(record_ids(records), chunk_size)
+    for _, _, categories in pipeline.screen_chunks(chunks, _worker_disease_stage_classes):
+        parts.append(categories)
+
+    n_columns = sum(len(cls.risk_factor_order) for cls in _worker_disease_stage_classes)
+    categories = np.concatenate(parts) if parts else np.empty((0, n_columns), dtype = CATEGORY_DTYPE)
+    return _pack_ids(patient_ids, unnumbered), categories
+
+
+def _pack_ids(patient_ids, unnumbered):
+    """
+    Pack the patient ids of a shard into NumPy arrays, which pickle far more compactly than lists.
+    :param unnumbered: the positions of the records that have no patient_id field. The parent numbers those,
+                       since only it knows the global row numbers, as pipeline.iter_chunks() does.
+    :return: None if no record had a patient_id field; otherwise an (ids, unnumbered) pair, where ids is an int64,
+             float64 or unicode array if the ids are all of one such type, so that tolist() gives them back unchanged,
+             or else an object array; and unnumbered is an int64 array of the positions at which ids holds a None
+             that stands for a missing field, rather than an explicit null id.
+    """
+    if len(unnumbered) == len(patient_ids):
+        return None
+    unnumbered = np.array(unnumbered, dtype = np.int64)
+    types = {type(patient_id) for patient_id in patient_ids}
+    if len(types) == 1 and types <= {int, float, str}:
+        try:
+            return np.array(patient_ids), unnumbered
+        except OverflowError: # Integers too large for int64.
+            pass
+    return np.array(patient_ids, dtype = object), unnumbered
+
+
+def _unpack_ids(packed_ids, n, row_number):
+    """
+    Return the list of ids of a shard of n records starting at row_number, from the packed_ids of _pack_ids().
+    """
+    if packed_ids is None:
+        return list(range(row_number, row_number + n))
+    patient_ids, unnumbered = packed_ids
+    patient_ids = patient_ids.tolist()
+    for i in unnumbered.tolist():
+        patient_ids[i] = row_number + i
+    return patient_ids
+
+
+class ProcessPoolScreener:
+    def __init__(self, disease_stage_classes, workers = None, chunk_size = pipeline.DEFAULT_CHUNK_SIZE,
+                 shards_per_worker = 4):
+        """
+        :param disease_stage_classes: a list of DiseaseStageBase subclasses, defined at module level or built by a
+                                      catalog.Catalog, so that they can be pickled.
+        :param workers: the number of worker processes. Defaults to the number of CPUs.
+        :param chunk_size: the number of patients that a worker screens at a time.
+        :param shards_per_worker: the file is split into workers * shards_per_worker shards, so that a worker
+                                  that finishes early can pick up more work.
+        """
+        self.disease_stage_classes = list(disease_stage_classes)
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.shards_per_worker = shards_per_worker
+        self.columns = pipeline.result_columns([cls() for cls in self.disease_stage_classes])
+
+    def shards(self, path, file_format = None):
+        """
+        Split path into byte ranges, each beginning at the start of a line.
+        :return: (fieldnames, ranges), where fieldnames is the CSV header (None for JSONL),
+                 and ranges is a list of (start, end) byte offsets in file order.
+        """
+        file_format = pipeline.get_format(path, file_format)
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            fieldnames = None
+            if file_format == 'csv':
+                fieldnames = next(csv.reader([f.readline().decode('utf-8')]), None)
+            first = f.tell()
+
+            n_shards = max(1, self.workers * self.shards_per_worker)
+            boundaries = [first]
+            for i in range(1, n_shards):
+                target = first + (size - first) * i // n_shards
+                if target <= boundaries[-1]:
+                    continue
+                f.seek(target - 1)
+                f.readline() # Move to the start of the next line, unless target already is one.
+                if boundaries[-1] < f.tell() < size:
+                    boundaries.append(f.tell())
+            boundaries.append(size)
+
+        return fieldnames, list(zip(boundaries, boundaries[1:]))
+
+    def screen_file(self, path, file_format = None):
+        """
+        Screen every patient in path.
+        :return: an iterator over (patient_ids, columns, categories) triples, one per shard, in file order,
+                 in the same form as pipeline.screen_chunks() returns.
+        """
+        file_format = pipeline.get_format(path, file_format)
+        fieldnames, ranges = self.shards(path, file_format)
+        row_number = 0
+        with ProcessPoolExecutor(max_workers = self.workers, initializer = _init_worker,
+                                 initargs = (self.disease_stage_classes,)) as executor:
+            def submit(shard):
+                start, end = shard
+                return executor.submit(_screen_shard, path, file_format, start, end, fieldnames, self.chunk_size)
+
+            ranges = iter(ranges)
+            futures = deque(map(submit, itertools.islice(ranges, MAX_IN_FLIGHT_PER_WORKER * self.workers)))
+            while futures:
+                patient_ids, categories = futures.popleft().result() # In submission order, which is file order.
+                shard = next(ranges, None)
+                if shard is not None:
+                    futures.append(submit(shard))
+                patient_ids = _unpack_ids(patient_ids, len(categories), row_number)
+                row_number += len(patient_ids)
+                yield patient_ids, self.columns, categories
+
+    def run(self, input_path, output_path, input_format = None, output_format = None):
+        """
+        Screen input_path and write the results to output_path, as pipeline.run() does.
+        :return: a dict with the number of 'rows' screened, the elapsed 'seconds', and 'rows_per_second'.
+        """
+        start = time.perf_counter()
+        rows = pipeline.write_results(self.screen_file(input_path, input_format), output_path, output_format)
+        seconds = time.perf_counter() - start
+        return {'rows': rows, 'seconds': seconds, 'rows_per_second': rows / seconds if seconds else float('inf')}
+
+
+# =============================================================================
+#                     Benchmark
+# =============================================================================
+def benchmark(input_path, disease_stage_classes, worker_counts = None, chunk_size = pipeline.DEFAULT_CHUNK_SIZE):
+    """
+    Screen input_path with each number of workers in worker_counts, check that every run produces the same
+    output, and print the throughput and the speedup over one worker.
+    """
+    worker_counts = worker_counts or sorted({1, 2, 4, os.cpu_count() or 1})
+    outputs = []
+    baseline = None
+    for workers in worker_counts:
+        output_path = '{input_path}.{workers}workers.csv'.format(input_path = input_path, workers = workers)
+        summary = ProcessPoolScreener(disease_stage_classes, workers, chunk_size).run(input_path, output_path)
+        baseline = baseline or summary['rows_per_second']
+        print("{workers:3d} workers: {rows_per_second:10.0f} rows/s, speedup {speedup:.2f}x".format(
+            workers = workers, speedup = summary['rows_per_second'] / baseline, **summary))
+        with open(output_path, 'rb') as f:
+            outputs.append(f.read())
+        os.remove(output_path)
+    assert all(output == outputs[0] for output in outputs), "Output depends on the number of workers"
+
+
+# =============================================================================
+#                     Test
+# =============================================================================
+def test(disease_stage_classes, n = 200):
+    """
+    Screen small CSV and JSONL files, with blank, missing and explicit null ids, in parallel, and check that the
+    results are those of categorize(), and the same, byte for byte, as those of pipeline.run().
+    """
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        for input_path, records in pipeline.write_test_patients(directory, n).items():
+            with open(input_path, 'a') as f:
+                f.write('\n') # A blank line, which both must skip.
+            for extension in ['.csv', '.jsonl']:
+                sequential_path = input_path + '.sequential' + extension
+                parallel_path = input_path + '.parallel' + extension
+                pipeline.run(input_path, sequential_path, disease_stage_classes)
+                ProcessPoolScreener(disease_stage_classes, workers = 2, chunk_size = 16).run(input_path, parallel_path)
+                pipeline.check_results(parallel_path, records, disease_stage_classes)
+                with open(sequential_path, 'rb') as f, open(parallel_path, 'rb') as g:
+                    assert f.read() == g.read(), "Parallel and sequential results differ for {path}".format(path = input_path)
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Screen a file of patients against disease stages, in parallel.")
+    parser.add_argument('input', help = "a .csv or .jsonl file of patients")
+    parser.add_argument('output', help = "the .csv, .jsonl or .dsr file to write results to")
+    parser.add_argument('--module', default = 'sandbox.josh_sandbox.disease_testing.solution5',
+                        help = "the module that defines the disease stages")
+    parser.add_argument('--stages', nargs = '*', help = "names of disease-stage classes (default: all in --module)")
+    parser.add_argument('--workers', type = int, default = None, help = "default: the number of CPUs")
+    parser.add_argument('--chunk-size', type = int, default = pipeline.DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--input-format', choices = ['csv', 'jsonl'])
+    parser.add_argument('--output-format', choices = ['csv', 'jsonl', 'binary'])
+    args = parser.parse_args(argv)
+
+    screener = ProcessPoolScreener(pipeline.find_disease_stage_classes(args.module, args.stages),
+                                   workers = args.workers, chunk_size = args.chunk_size)
+    summary = screener.run(args.input, args.output, input_format = args.input_format, output_format = args.output_format)
+    print("Screened {rows} patients with {workers} workers in {seconds:.2f}s ({rows_per_second:.0f} rows/s)".format(
+        workers = screener.workers, **summary), file = sys.stderr)
+    return summary
+
+
+if __name__ == '__main__':
+    if '--test' in sys.argv[1:]:
+        test(pipeline.find_disease_stage_classes('sandbox.josh_sandbox.disease_testing.solution5'))
+    else:
+        main()
@@ -0,0 +1,237 @@
+"""
+This file defines PatientStore, a compact in-memory or memory-mapped store of patients.
+
+A Patient object carries a __dict__ and five boxed floats, and costs hundreds of bytes. A PatientStore keeps each
+patient as one fixed-width record of a NumPy structured array instead: an int64 patient id followed by one float64
+per attribute in Patient.ATTRIBUTES, 48 bytes in all. A store can be saved as a .npy file, and opened again as a
+memory map, so that a store of millions of patients opens instantly and pages in only the records that are read.
+
+store[i] and store.get(patient_id) return a PatientView, a small object with the same attributes as a Patient,
+read straight from the record, so the existing categorizers accept it unchanged.
+"""
+import numpy as np
+
+from sandbox.josh_sandbox.disease_testing.batch import PatientBatch
+from sandbox.josh_sandbox.disease_testing.common import Patient
+
+RECORD_DTYPE = np.dtype([('patient_id', '<i8')] + [(name, '<f8') for name in Patient.ATTRIBUTES])
+
+
+class PatientView:
+    """
+    A read-only Patient backed by one record of a PatientStore.
+    """
+    __slots__ = ('_store', '_index')
+
+    def __init__(self, store, index):
+        self._store = store
+        self._index = index
+
+    @property
+    def patient_id(self):
+        return int(self._store._records['patient_id'][self._index])
+
+    def to_patient(self):
+        """
+        Return a standalone Patient with the same attribute values.
+        """
+        return Patient(*self._store._records[self._index].tolist()[1:])
+
+    def __repr__(self):
+        return "<PatientView {patient_id}>".format(patient_id = self.patient_id)
+
+
+def _view_attribute(name):
+    def getter(self):
+        return self._store._columns[name][self._index].item() # A Python float, as a Patient's would be, not a NumPy one.
+    return property(getter, doc = "The patient's {name}.".format(name = name))
+
+
+for _name in Patient.ATTRIBUTES:
+    setattr(PatientView, _name, _view_attribute(_name))
+del _name
+
+
+class PatientStore:
+    def __init__(self, capacity = 1024, records = None):
+        """
+        Create an empty, growable store, or wrap an existing array of records.
+        :param capacity: the number of records to allocate room for at first.
+        :param records: an existing array of RECORD_DTYPE, e.g. a memory map. The store then holds exactly those records.
+        """
+        if records is None:
+            self._records = np.zeros(max(1, capacity), dtype = RECORD_DTYPE)
+            self._size = 0
+        else:
+            if records.dtype != RECORD_DTYPE:
+                raise ValueError("Records must have dtype {dtype}".format(dtype = RECORD_DTYPE))
+            self._records = records
+            self._size = len(records)
+        self._on_records_changed()
+
+    def _on_records_changed(self):
+        self._columns = {name: self._records[name] for name in Patient.ATTRIBUTES} # Views, not copies.
+        self._id_order = None # Argsort of the patient ids, built on demand if they are not already sorted.
+
+    @classmethod
+    def from_patients(cls, patients, patient_ids = None):
+        patients = list(patients)
+        store = cls(capacity = len(patients))
+        store.extend(patients, patient_ids)
+        return store
+
+    # =============================================================================
+    #                     Adding patients
+    # =============================================================================
+    def append(self, patient, patient_id = None):
+        """
+        Add patient to the store.
+        :param patient_id: defaults to the index of the new record.
+        :return: the index of the new record.
+        """
+        return self.extend([patient], None if patient_id is None else [patient_id])
+
+    def extend(self, patients, patient_ids = None):
+        """
+        Add every patient of patients to the store.
+        :param patient_ids: a sequence of ids, one per patient. Defaults to the indexes of the new records.
+        :return: the index of the first new record.
+        """
+        patients = list(patients)
+        start = self._size
+        self._reserve(start + len(patients))
+        new = self._records[start:start + len(patients)]
+        new['patient_id'] = np.arange(start, start + len(patients)) if patient_ids is None else patient_ids
+        for name in Patient.ATTRIBUTES:
+            new[name] = [getattr(patient, name) for patient in patients]
+        self._size += len(patients)
+        self._id_order = None
+        return start
+
+    def _reserve(self, size):
+        if not self._records.flags.writeable or not self._records.flags.owndata:
+            raise ValueError("Cannot add patients to a store opened from a file.")
+        if size > len(self._records):
+            records = np.zeros(max(size, 2 * len(self._records)), dtype = RECORD_DTYPE)
+            records[:self._size] = self._records[:self._size]
+            self._records = records
+            self._on_records_changed()
+
+    # =============================================================================
+    #                     Reading patients
+    # =============================================================================
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index):
+        """
+        Return the patient in record number index, as a PatientView.
+        """
+        if not -self._size <= index < self._size:
+            raise IndexError("PatientStore index out of range")
+        return PatientView(self, index % self._size)
+
+    def __iter__(self):
+        for index in range(self._size):
+            yield PatientView(self, index)
+
+    def index_of(self, patient_id):
+        """
+        Return the record number of the patient with id patient_id, by binary search on the ids.
+        """
+        ids = self._records['patient_id'][:self._size]
+        if self._id_order is None:
+            self._id_order = False if bool(np.all(ids[:-1] <= ids[1:])) else np.argsort(ids, kind = 'stable')
+        if self._id_order is False: # The ids are already sorted, as they are when they default to record numbers.
+            index = int(np.searchsorted(ids, patient_id))
+        else:
+            position = int(np.searchsorted(ids, patient_id, sorter = self._id_order))
+            index = int(self._id_order[position]) if position < self._size else self._size
+        if index >= self._size or ids[index] != patient_id:
+            raise KeyError(patient_id)
+        return index
+
+    def get(self, patient_id):
+        """
+        Return the patient with id patient_id, as a PatientView.
+        """
+        return PatientView(self, self.index_of(patient_id))
+
+    @property
+    def records(self):
+        """
+        Return the records in use, as a structured array. This is a view; no data is copied.
+        """
+        return self._records[:self._size]
+
+    def as_batch(self, start = 0, stop = None):
+        """
+        Return records start to stop as a PatientBatch, for categorize_batch(). Its columns are strided views of the
+        records; no data is copied.
+        """
+        records = self.records[start:stop]
+        return PatientBatch(**{name: records[name] for name in Patient.ATTRIBUTES})
+
+    # =============================================================================
+    #                     Persistence
+    # =============================================================================
+    def save(self, path):
+        """
+        Save the store to path, in NumPy's .npy format.
+        """
+        np.save(path, self.records, allow_pickle = False)
+
+    @classmethod
+    def open(cls, path, mode = 'r'):
+        """
+        Open a store saved by save() as a memory map, without reading the records into memory.
+        :param mode: 'r' for read-only, or 'r+' to allow the records to be modified in place (but not added to).
+        """
+        return cls(records = np.load(path, mmap_mode = mode, allow_pickle = False))
+
+
+# =============================================================================
+#                     Test
+# =============================================================================
+def test(disease_stages, n = 1_000_000):
+    import os
+    import sys
+    import tempfile
+    import time
+    from sandbox.josh_sandbox.disease_testing.batch import random_batch
+
+    batch = random_batch(n)
+    patients = list(batch)
+    records = np.empty(n, dtype = RECORD_DTYPE)
+    records['patient_id'] = np.arange(10 * n, 11 * n)
+    for name, column in batch.columns.items():
+        records[name] = column
+    store = PatientStore(records = records)
+
+    print("{n} patients: about {objects} MB as Patient objects, {records} MB as records".format(
+        n = n, objects = n * (sys.getsizeof(patients[0]) + sys.getsizeof(vars(patients[0])) + 5 * 24) // 2 ** 20,
+        records = store.records.nbytes // 2 ** 20))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'patients.npy')
+        store.save(path)
+        start = time.perf_counter()
+        opened = PatientStore.open(path)
+        print("Opened a memory-mapped store in {ms:.2f}ms".format(ms = (time.perf_counter() - start) * 1000))
+
+        for i in [0, n // 2, n - 1]:
+            view = opened.get(10 * n + i)
+            assert all(type(getattr(view, name)) is float for name in Patient.ATTRIBUTES)
+            for disease_stage in disease_stages:
+                assert disease_stage.screen(view) == disease_stage.screen(patients[i])
+        batch_view = opened.as_batch()
+        assert np.shares_memory(batch_view.age, opened.records)
+        for disease_stage in disease_stages:
+            for risk_factor, categories in disease_stage.categorize_batch(batch_view).items():
+                assert np.array_equal(categories, disease_stage.categorize_batch(batch)[risk_factor])
+        del opened, batch_view # Release the memory map, so that the file can be removed.
+
+
+if __name__ == '__main__':
+    from sandbox.josh_sandbox.disease_testing.solution5 import StrokeStageA, IschemicStrokeStageA, HemorrhagicStrokeStageA, DiabetesStageA
+    test([StrokeStageA(), IschemicStrokeStageA(), HemorrhagicStrokeStageA(), DiabetesStageA()])
@@ -0,0 +1,301 @@
+"""
+This file defines a streaming screening pipeline: patients are read lazily from a CSV or JSONL file,
+collected into chunks, screened one chunk at a time against a list of disease-stage classes, and the
+results are written out incrementally as CSV or JSONL. Only one chunk is ever held in memory, so memory
+use does not depend on the size of the input.
+
+Each stage of the pipeline is a generator, so the pieces can also be used on their own:
+
+    records = read_records('patients.csv')
+    for patient_ids, columns, categories in screen_chunks(iter_chunks(records, 10000), [StrokeStageA, DiabetesStageA]):
+        ...
+
+Input rows must have one field per name in Patient.ATTRIBUTES, and may have a 'patient_id' field.
+Patients without an id are numbered by their position in the input, starting at 0.
+
+Output has one row per patient: its patient_id, followed by one column per (stage, risk factor),
+named <stage class name>.<risk factor>, e.g. StrokeStageA.blood_pressure. Output can also be written in the
+compact binary format of result_sink.py (extension .dsr), which is much faster to write at large volumes.
+
+From the command line:
+
+    python -m sandbox.josh_sandbox.disease_testing.pipeline patients.csv results.jsonl --chunk-size 50000
+    python -m sandbox.josh_sandbox.disease_testing.pipeline --test
+"""
+import argparse
+import csv
+import importlib
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from sandbox.josh_sandbox.disease_testing.batch import CATEGORY_DTYPE, PatientBatch
+from sandbox.josh_sandbox.disease_testing.common import Patient
+from sandbox.josh_sandbox.disease_testing.result_sink import RESULT_SUFFIX, write_screened
+
+FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl'}
+OUTPUT_FORMATS = {**FORMATS, RESULT_SUFFIX: 'binary'}
+DEFAULT_CHUNK_SIZE = 10000
+
+
+def get_format(path, file_format = None, formats = FORMATS):
+    """
+    Return file_format if given, otherwise the format implied by the extension of path: 'csv' or 'jsonl'.
+    :param formats: maps extensions to the formats allowed; pass OUTPUT_FORMATS for output files.
+    """
+    if file_format is None:
+        file_format = formats.get(os.path.splitext(path)[1].lower())
+        if file_format is None:
+            raise ValueError("Cannot tell the format of {path}; expected one of {extensions}".format(
+                path = path, extensions = sorted(formats)))
+    if file_format not in formats.values():
+        raise ValueError("Unknown format: {file_format}".format(file_format = file_format))
+    return file_format
+
+
+# =============================================================================
+#                     Reading
+# =============================================================================
+def read_records(path, file_format = None):
+    """
+    Lazily read the rows of a CSV or JSONL file of patients.
+    :param path: the file to read.
+    :param file_format: 'csv' or 'jsonl'. If None, it is inferred from the extension of path.
+    :return: an iterator over dicts, one per row.
+    """
+    file_format = get_format(path, file_format)
+    with open(path, newline = '') as f:
+        if file_format == 'csv':
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def iter_chunks(records, chunk_size = DEFAULT_CHUNK_SIZE):
+    """
+    Collect records into chunks of at most chunk_size patients.
+    :param records: an iterable of dicts, as returned by read_records()
+    :param chunk_size: the maximum number of patients per chunk.
+    :return: an iterator over (patient_ids, batch) pairs, where batch is a PatientBatch.
+    """
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be positive.")
+
+    patient_ids = []
+    columns = {name: [] for name in Patient.ATTRIBUTES}
+    for row_number, record in enumerate(records):
+        patient_ids.append(record.get('patient_id', row_number))
+        try:
+            for name, column in columns.items():
+                column.append(float(record[name]))
+        except KeyError as e:
+            raise ValueError("Patient record {row_number} has no {name} field.".format(row_number = row_number,
+                                                                                    name = e.args[0])) from None
+        if len(patient_ids) == chunk_size:
+            yield patient_ids, PatientBatch(**columns)
+            patient_ids = []
+            columns = {name: [] for name in Patient.ATTRIBUTES}
+
+    if patient_ids:
+        yield patient_ids, PatientBatch(**columns)
+
+
+# =============================================================================
+#                     Screening
+# =============================================================================
+def result_columns(disease_stages):
+    """
+    Return the names of the result columns for disease_stages, in output order.
+    """
+    return ['{stage}.{risk_factor}'.format(stage = disease_stage.__class__.__name__, risk_factor = risk_factor)
+            for disease_stage in disease_stages
+            for risk_factor in disease_stage.risk_factor_order]
+
+
+def screen_chunks(chunks, disease_stage_classes, stats = None):
+    """
+    Screen each chunk against every disease stage.
+    :param chunks: an iterable of (patient_ids, batch) pairs, as returned by iter_chunks()
+    :param disease_stage_classes: a list of DiseaseStageBase subclasses.
+    :param stats: if given, a population_stats.PopulationStats to add each screened chunk to.
+    :return: an iterator over (patient_ids, columns, categories) triples, where categories is a
+             (patient x column) array and columns names its columns, as result_columns() does.
+    """
+    disease_stages = [cls() for cls in disease_stage_classes]
+    columns = result_columns(disease_stages)
+    for patient_ids, batch in chunks:
+        categories = np.empty((len(batch), len(columns)), dtype = CATEGORY_DTYPE)
+        j = 0
+        for disease_stage in disease_stages:
+            by_risk_factor = disease_stage.categorize_batch(batch)
+            for risk_factor in disease_stage.risk_factor_order:
+                categories[:, j] = by_risk_factor[risk_factor]
+                j += 1
+        if stats is not None:
+            stats.add_batch(batch, columns, categories)
+        yield patient_ids, columns, categories
+
+
+# =============================================================================
+#                     Writing
+# =============================================================================
+def write_results(screened_chunks, path, file_format = None):
+    """
+    Write screened chunks to path as they arrive.
+    :param screened_chunks: an iterable of (patient_ids, columns, categories), as returned by screen_chunks()
+    :param path: the file to write.
+    :param file_format: 'csv', 'jsonl' or 'binary'. If None, it is inferred from the extension of path.
+    :return: the number of patients written.
+    """
+    file_format = get_format(path, file_format, OUTPUT_FORMATS)
+    if file_format == 'binary':
+        return write_screened(screened_chunks, path)
+    n = 0
+    with open(path, 'w', newline = '') as f:
+        writer = csv.writer(f) if file_format == 'csv' else None
+        for patient_ids, columns, categories in screened_chunks:
+            if writer is not None:
+                if n == 0:
+                    writer.writerow(['patient_id'] + columns)
+                writer.writerows([patient_id] + row for patient_id, row in zip(patient_ids, categories.tolist()))
+            else:
+                f.writelines(json.dumps({'patient_id': patient_id, **dict(zip(columns, row))}) + '\n'
+                             for patient_id, row in zip(patient_ids, categories.tolist()))
+            n += len(patient_ids)
+    return n
+
+
+def run(input_path, output_path, disease_stage_classes, chunk_size = DEFAULT_CHUNK_SIZE,
+        input_format = None, output_format = None):
+    """
+    Screen every patient in input_path against disease_stage_classes, and write the results to output_path.
+    :return: a dict with the number of 'rows' screened, the elapsed 'seconds', and 'rows_per_second'.
+    """
+    start = time.perf_counter()
+    chunks = iter_chunks(read_records(input_path, input_format), chunk_size)
+    rows = write_results(screen_chunks(chunks, disease_stage_classes), output_path, output_format)
+    seconds = time.perf_counter() - start
+    return {'rows': rows, 'seconds': seconds, 'rows_per_second': rows / seconds if seconds else float('inf')}
+
+
+# =============================================================================
+#                     Command line
+# =============================================================================
+def find_disease_stage_classes(module_name, class_names = None):
+    """
+    Return the disease-stage classes named class_names in the module module_name,
+    or all of the module's DiseaseStageBase subclasses if class_names is empty.
+    """
+    module = importlib.import_module(module_name)
+    if class_names:
+        return [getattr(module, name) for name in class_names]
+    return [value for value in vars(module).values()
+            if isinstance(value, type) and issubclass(value, module.DiseaseStageBase) and value is not module.DiseaseStageBase]
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Screen a file of patients against disease stages.")
+    parser.add_argument('input', help = "a .csv or .jsonl file of patients")
+    parser.add_argument('output', help = "the .csv, .jsonl or .dsr file to write results to")
+    parser.add_argument('--module', default = 'sandbox.josh_sandbox.disease_testing.solution5',
+                        help = "the module that defines the disease stages")
+    parser.add_argument('--stages', nargs = '*', help = "names of disease-stage classes (default: all in --module)")
+    parser.add_argument('--chunk-size', type = int, default = DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--input-format', choices = ['csv', 'jsonl'])
+    parser.add_argument('--output-format', choices = ['csv', 'jsonl', 'binary'])
+    args = parser.parse_args(argv)
+
+    summary = run(args.input, args.output, find_disease_stage_classes(args.module, args.stages),
+                  chunk_size = args.chunk_size, input_format = args.input_format, output_format = args.output_format)
+    print("Screened {rows} patients in {seconds:.2f}s ({rows_per_second:.0f} rows/s)".format(**summary), file = sys.stderr)
+    return summary
+
+
+# =============================================================================
+#                     Test
+# =============================================================================
+def write_test_patients(directory, n = 200, seed = 0):
+    """
+    Write n synthetic patients to each of three small files in directory: a CSV file with a patient_id column, in
+    which some ids are blank; a CSV file with no patient_id column; and a JSONL file in which some records have no
+    patient_id field and some have an explicit null one.
+    :return: a dict mapping the path of each file to its list of records, as read_records() returns them.
+    """
+    from sandbox.josh_sandbox.disease_testing.batch import random_batch
+
+    rows = [dict(zip(Patient.ATTRIBUTES, values)) for values in zip(*(column.tolist() for column in
+                                                                      random_batch(n, seed = seed).columns.values()))]
+    files = {}
+    path = os.path.join(directory, 'patients_with_ids.csv')
+    with open(path, 'w', newline = '') as f:
+        writer = csv.writer(f)
+        writer.writerow(('patient_id',) + Patient.ATTRIBUTES)
+        writer.writerows(['' if i % 5 == 0 else 'p{i}'.format(i = i)] + [row[name] for name in Patient.ATTRIBUTES]
+                         for i, row in enumerate(rows))
+    files[path] = list(read_records(path))
+
+    path = os.path.join(directory, 'patients_without_ids.csv')
+    with open(path, 'w', newline = '') as f:
+        writer = csv.writer(f)
+        writer.writerow(Patient.ATTRIBUTES)
+        writer.writerows([row[name] for name in Patient.ATTRIBUTES] for row in rows)
+    files[path] = list(read_records(path))
+
+    path = os.path.join(directory, 'patients.jsonl')
+    with open(path, 'w') as f:
+        for i, row in enumerate(rows):
+            if i % 3 == 0:
+                row = {'patient_id': 1000 + i, **row}
+            elif i % 3 == 1:
+                row = {'patient_id': None, **row}
+            f.write(json.dumps(row) + '\n')
+    files[path] = list(read_records(path))
+    return files
+
+
+def check_results(path, records, disease_stage_classes):
+    """
+    Check that the CSV or JSONL results in path are those that categorize() gives for each of records, and that each
+    patient has its own id, or its row number if its record has no patient_id field.
+    """
+    disease_stages = [cls() for cls in disease_stage_classes]
+    columns = result_columns(disease_stages)
+    expected = []
+    for row_number, record in enumerate(records):
+        patient = Patient(**{name: float(record[name]) for name in Patient.ATTRIBUTES})
+        categories = [disease_stage.categorize(risk_factor, patient)
+                      for disease_stage in disease_stages for risk_factor in disease_stage.risk_factor_order]
+        expected.append((record.get('patient_id', row_number), categories))
+
+    with open(path, newline = '') as f:
+        if get_format(path, formats = OUTPUT_FORMATS) == 'csv':
+            rows = list(csv.reader(f))
+            assert rows[0] == ['patient_id'] + columns
+            assert rows[1:] == [['' if patient_id is None else str(patient_id)] + [str(c) for c in categories]
+                                for patient_id, categories in expected], path
+        else:
+            assert [json.loads(line) for line in f] == [{'patient_id': patient_id, **dict(zip(columns, categories))}
+                                                       for patient_id, categories in expected], path
+
+
+def test(disease_stage_classes, n = 200):
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        for input_path, records in write_test_patients(directory, n).items():
+            for extension in ['.csv', '.jsonl']:
+                output_path = input_path + '.results' + extension
+                summary = run(input_path, output_path, disease_stage_classes, chunk_size = 64) # Several chunks.
+                assert summary['rows'] == len(records)
+                check_results(output_path, records, disease_stage_classes)
+
+
+if __name__ == '__main__':
+    if '--test' in sys.argv[1:]:
+        test(find_disease_stage_classes('sandbox.josh_sandbox.disease_testing.solution5'))
+    else:
+        main()
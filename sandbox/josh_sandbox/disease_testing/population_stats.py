@@ -0,0 +1,390 @@
+"""
+This file defines PopulationStats, which gathers statistics about a screening run while it happens,
+so that no second pass over the data is needed:
+
+    - the number of patients put in each category, for each (stage, risk factor) result column;
+    - a histogram of each of a chosen set of patient attributes;
+    - a quantile sketch of each of those attributes, for medians, percentiles, etc.
+
+Memory use is bounded, whatever the number of patients: counts and histograms have a fixed number of cells,
+and each sketch has at most QuantileSketch.max_buckets buckets.
+
+Statistics gathered separately, e.g., by the workers of parallel.py or for different shards of a file, can be
+combined with merge(). Counts and histograms merge exactly. Sketches merge exactly too, in the sense that merging
+two sketches gives the very sketch that one would have got by adding all of their values to one sketch. So merged
+quantiles are as accurate as those of a single pass:
+
+    Error bound: quantile(q) returns a value within relative_accuracy (1% by default) of the true value of rank
+    q * (count - 1) in the data; i.e., |estimate - true| <= relative_accuracy * true.
+
+If the values span too wide a range for max_buckets buckets, the sketch halves its resolution, merging each pair
+of neighbouring buckets into one, until they fit. The bound then still holds for every quantile, but with the
+coarser sketch.effective_accuracy in place of relative_accuracy. A merged sketch is coarsened in the same way,
+so it is still the very sketch that a single pass would have given.
+
+PopulationStats can follow either kind of screening loop: the per-patient loop of common.test() (see the stats
+argument there), and the batch loop of pipeline.screen_chunks() (see its stats argument).
+"""
+import json
+import math
+from collections import Counter
+
+import numpy as np
+
+DEFAULT_ATTRIBUTES = ('age', 'systolic_blood_pressure', 'cholesterol')
+
+# Histogram bin edges for each attribute. Values below the first edge or above the last are counted
+# in an underflow or overflow bin, so no value is ever dropped.
+DEFAULT_HISTOGRAM_EDGES = {
+    'age': list(range(0, 125, 5)),
+    'systolic_blood_pressure': list(range(60, 270, 10)),
+    'fasting_blood_sugar': list(range(50, 310, 10)),
+    'cholesterol': list(range(100, 410, 10)),
+    'blood_viscosity': [1 + 0.25 * i for i in range(21)],
+}
+
+
+# =============================================================================
+#                     Quantile sketch
+# =============================================================================
+class QuantileSketch:
+    """
+    A streaming quantile sketch with relative-error guarantees, for non-negative values.
+
+    Positive values are counted in logarithmically sized buckets: bucket i holds the values in (gamma^(i-1), gamma^i],
+    where gamma = (1 + a) / (1 - a) and a is the relative accuracy. Every value in a bucket is within a relative
+    distance a of the bucket's representative value, 2 * gamma^i / (gamma + 1), which is what quantile() returns.
+
+    When there are more than max_buckets buckets, they are collapsed: buckets 2j - 1 and 2j become bucket j of a
+    sketch whose gamma is squared. After k collapses, gamma is gamma^(2^k), and bucket i holds the values that
+    would have gone to buckets 2^k * (i - 1) + 1 to 2^k * i.
+    """
+    MIN_VALUE = 1e-9 # Values at or below this are counted as zero.
+
+    def __init__(self, relative_accuracy = 0.01, max_buckets = 2048):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("relative_accuracy must be between 0 and 1.")
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self._buckets = Counter() # Maps bucket index to the number of values in that bucket.
+        self._collapses = 0 # The number of times the resolution has been halved.
+        self.zero_count = 0
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        if value <= self.MIN_VALUE:
+            self.zero_count += 1
+        else:
+            self._buckets[-(-math.ceil(math.log(value) / self._log_gamma) >> self._collapses)] += 1
+        self.count += 1
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self._collapse()
+
+    def add_array(self, values):
+        """
+        Add every value in the array values. Equivalent to calling add() on each, but much faster.
+        """
+        values = np.asarray(values, dtype = np.float64)
+        if len(values) == 0:
+            return
+        positive = values[values > self.MIN_VALUE]
+        indexes = np.ceil(np.log(positive) / self._log_gamma).astype(np.int64)
+        indexes, counts = np.unique(-(-indexes >> self._collapses), return_counts = True)
+        self._buckets.update(dict(zip(indexes.tolist(), counts.tolist())))
+        self.zero_count += len(values) - len(positive)
+        self.count += len(values)
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self._collapse()
+
+    @property
+    def effective_accuracy(self):
+        """
+        The relative accuracy that quantile() guarantees: relative_accuracy, unless the sketch has been collapsed.
+        """
+        gamma = self._gamma ** (2 ** self._collapses)
+        return (gamma - 1) / (gamma + 1)
+
+    def _collapse(self, collapses = 0):
+        """
+        Halve the resolution of the sketch at least collapses times, and then until it has at most max_buckets buckets.
+        Bucket indexes are integers and ceil(ceil(x) / 2) == ceil(x / 2), so collapsing buckets gives the same buckets,
+        exactly, as adding their values to an already collapsed sketch.
+        """
+        while collapses > 0 or len(self._buckets) > self.max_buckets:
+            buckets = Counter()
+            for i, n in self._buckets.items():
+                buckets[-(-i >> 1)] += n # ceil(i / 2)
+            self._buckets = buckets
+            self._collapses += 1
+            collapses -= 1
+
+    def merge(self, other):
+        """
+        Add the values counted by other to this sketch.
+        """
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge sketches of different relative accuracies.")
+        if other._collapses > self._collapses:
+            self._collapse(other._collapses - self._collapses)
+        if other._collapses < self._collapses:
+            other = QuantileSketch.from_dict(other.to_dict())
+            other._collapse(self._collapses - other._collapses)
+        self._buckets.update(other._buckets)
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._collapse()
+        return self
+
+    def quantile(self, q):
+        """
+        Return an estimate of the q-quantile of the values added so far, 0 <= q <= 1. See the error bound above.
+        """
+        if not 0 <= q <= 1:
+            raise ValueError("q must be between 0 and 1.")
+        if self.count == 0:
+            return math.nan
+        rank = q * (self.count - 1)
+        if rank < self.zero_count:
+            return max(self.min, 0.0)
+        gamma = self._gamma ** (2 ** self._collapses)
+        seen = self.zero_count
+        for i in sorted(self._buckets):
+            seen += self._buckets[i]
+            if seen > rank:
+                return min(max(2 * gamma ** i / (gamma + 1), self.min), self.max)
+        return self.max
+
+    def to_dict(self):
+        return {'relative_accuracy': self.relative_accuracy, 'max_buckets': self.max_buckets,
+                'buckets': {str(i): n for i, n in sorted(self._buckets.items())}, 'collapses': self._collapses,
+                'zero_count': self.zero_count, 'count': self.count,
+                'min': self.min if self.count else None, 'max': self.max if self.count else None}
+
+    @classmethod
+    def from_dict(cls, d):
+        sketch = cls(d['relative_accuracy'], d['max_buckets'])
+        sketch._buckets.update({int(i): n for i, n in d['buckets'].items()})
+        sketch._collapses = d['collapses']
+        sketch.zero_count = d['zero_count']
+        sketch.count = d['count']
+        if sketch.count:
+            sketch.min, sketch.max = d['min'], d['max']
+        return sketch
+
+
+# =============================================================================
+#                     Histogram
+# =============================================================================
+class Histogram:
+    def __init__(self, edges):
+        """
+        :param edges: the increasing bin edges. Bin i holds the values in [edges[i - 1], edges[i]); bin 0 holds the values
+                      below edges[0] and the last bin those at or above edges[-1].
+        """
+        self.edges = [float(edge) for edge in edges]
+        if any(a >= b for a, b in zip(self.edges, self.edges[1:])):
+            raise ValueError("Histogram edges must be increasing.")
+        self.counts = np.zeros(len(self.edges) + 1, dtype = np.int64)
+
+    def add(self, value):
+        self.counts[int(np.searchsorted(self.edges, value, side = 'right'))] += 1
+
+    def add_array(self, values):
+        self.counts += np.bincount(np.searchsorted(self.edges, values, side = 'right'), minlength = len(self.counts))
+
+    def merge(self, other):
+        if other.edges != self.edges:
+            raise ValueError("Cannot merge histograms with different edges.")
+        self.counts += other.counts
+        return self
+
+    def to_dict(self):
+        return {'edges': self.edges, 'counts': self.counts.tolist()}
+
+    @classmethod
+    def from_dict(cls, d):
+        histogram = cls(d['edges'])
+        histogram.counts[:] = d['counts']
+        return histogram
+
+
+# =============================================================================
+#                     Population statistics
+# =============================================================================
+class PopulationStats:
+    def __init__(self, attributes = DEFAULT_ATTRIBUTES, histogram_edges = None, relative_accuracy = 0.01):
+        """
+        :param attributes: the patient attributes to keep distributions of.
+        :param histogram_edges: a dict mapping attributes to bin edges; defaults to DEFAULT_HISTOGRAM_EDGES.
+        :param relative_accuracy: the relative accuracy of the quantile sketches.
+        """
+        histogram_edges = DEFAULT_HISTOGRAM_EDGES if histogram_edges is None else histogram_edges
+        self.attributes = tuple(attributes)
+        self.patients = 0
+        self.category_counts = Counter() # Maps (column, category) to a count, where column is <stage>.<risk factor>.
+        self.histograms = {name: Histogram(histogram_edges[name]) for name in self.attributes}
+        self.sketches = {name: QuantileSketch(relative_accuracy) for name in self.attributes}
+
+    # =============================================================================
+    #                     Gathering
+    # =============================================================================
+    def add_patient(self, patient):
+        """
+        Add patient's attributes to the distributions. Call this once per patient screened.
+        """
+        self.patients += 1
+        for name in self.attributes:
+            value = getattr(patient, name)
+            self.histograms[name].add(value)
+            self.sketches[name].add(value)
+
+    def add_category(self, stage_name, risk_factor, category):
+        """
+        Count one patient put in category for risk_factor by the stage named stage_name.
+        """
+        self.category_counts[('{stage}.{risk_factor}'.format(stage = stage_name, risk_factor = risk_factor), category)] += 1
+
+    def add_batch(self, batch, columns, categories):
+        """
+        Add a whole screened batch, as pipeline.screen_chunks() produces it.
+        :param batch: a PatientBatch
+        :param columns: the names of the result columns, as pipeline.result_columns() returns them.
+        :param categories: a (patient x column) array of categories.
+        """
+        self.patients += len(batch)
+        for name in self.attributes:
+            values = getattr(batch, name)
+            self.histograms[name].add_array(values)
+            self.sketches[name].add_array(values)
+        for j, column in enumerate(columns):
+            for category, count in enumerate(np.bincount(categories[:, j]).tolist()):
+                if count:
+                    self.category_counts[(column, category)] += count
+
+    # =============================================================================
+    #                     Merging and reporting
+    # =============================================================================
+    def merge(self, other):
+        """
+        Add the statistics gathered by other, e.g. on another shard, to ours.
+        """
+        if other.attributes != self.attributes:
+            raise ValueError("Cannot merge statistics of different attributes.")
+        self.patients += other.patients
+        self.category_counts.update(other.category_counts)
+        for name in self.attributes:
+            self.histograms[name].merge(other.histograms[name])
+            self.sketches[name].merge(other.sketches[name])
+        return self
+
+    def quantiles(self, name, qs = (0.01, 0.25, 0.5, 0.75, 0.99)):
+        return {q: self.sketches[name].quantile(q) for q in qs}
+
+    def to_dict(self):
+        return {'patients': self.patients,
+                'attributes': list(self.attributes),
+                'category_counts': [[column, category, count]
+                                    for (column, category), count in sorted(self.category_counts.items())],
+                'histograms': {name: histogram.to_dict() for name, histogram in self.histograms.items()},
+                'sketches': {name: sketch.to_dict() for name, sketch in self.sketches.items()}}
+
+    @classmethod
+    def from_dict(cls, d):
+        stats = cls(d['attributes'], {name: h['edges'] for name, h in d['histograms'].items()})
+        stats.patients = d['patients']
+        stats.category_counts.update({(column, category): count for column, category, count in d['category_counts']})
+        stats.histograms = {name: Histogram.from_dict(h) for name, h in d['histograms'].items()}
+        stats.sketches = {name: QuantileSketch.from_dict(s) for name, s in d['sketches'].items()}
+        return stats
+
+    def to_json(self, **kwds):
+        return json.dumps(self.to_dict(), **kwds)
+
+    def table(self):
+        lines = ["{n} patients".format(n = self.patients), ""]
+        for (column, category), count in sorted(self.category_counts.items()):
+            lines.append("{column:<45}{category:>4}{count:>12}{percent:>8.1f}%".format(
+                column = column, category = category, count = count, percent = 100 * count / max(1, self.patients)))
+        lines.append("")
+        for name in self.attributes:
+            lines.append("{name:<25}".format(name = name) + "".join(
+                "  p{q:g}={value:.1f}".format(q = 100 * q, value = value) for q, value in self.quantiles(name).items()))
+        return "\n".join(lines)
+
+
+# =============================================================================
+#                     Test
+# =============================================================================
+def test_collapse(n = 100_000, shards = 4, max_buckets = 200):
+    """
+    Check a sketch of values that span far too wide a range for max_buckets: every quantile must stay within the
+    effective accuracy, and merged shards must give the same sketch as one pass, whether fed in bulk or one by one.
+    """
+    values = np.exp(np.random.default_rng(0).normal(5, 5, n)) # Log-normal: medians near 150, tails from 1e-6 to 1e9.
+    whole = QuantileSketch(max_buckets = max_buckets)
+    whole.add_array(values)
+    assert whole._collapses > 0 and len(whole._buckets) <= max_buckets
+
+    sorted_values = np.sort(values)
+    for q in (0, 0.01, 0.25, 0.5, 0.75, 0.99, 1):
+        true = sorted_values[int(q * (n - 1))]
+        assert abs(whole.quantile(q) - true) <= whole.effective_accuracy * true, (q, whole.quantile(q), true)
+
+    merged = QuantileSketch(max_buckets = max_buckets)
+    for i, shard in enumerate(np.array_split(values, shards)):
+        partial = QuantileSketch(max_buckets = max_buckets)
+        if i == 0:
+            for value in shard.tolist():
+                partial.add(value)
+        else:
+            partial.add_array(shard[:len(shard) // (10 * i)]) # Shards collapsed to different degrees.
+        partial = QuantileSketch.from_dict(json.loads(json.dumps(partial.to_dict()))) # As if shipped from a worker.
+        merged.merge(partial)
+    merged.add_array(np.concatenate([shard[len(shard) // (10 * i):]
+                                     for i, shard in enumerate(np.array_split(values, shards)) if i]))
+    assert merged.to_dict() == whole.to_dict()
+
+
+def test(disease_stage_classes, n = 200_000, shards = 4):
+    from sandbox.josh_sandbox.disease_testing.batch import random_batch
+    from sandbox.josh_sandbox.disease_testing.pipeline import screen_chunks
+
+    # Gather statistics shard by shard, as separate workers would, and merge them.
+    batches = [random_batch(n // shards, seed = i) for i in range(shards)]
+    partials = []
+    for batch in batches:
+        stats = PopulationStats()
+        for _ in screen_chunks([(None, batch)], disease_stage_classes, stats = stats):
+            pass
+        partials.append(PopulationStats.from_dict(json.loads(stats.to_json()))) # As if shipped back from a worker.
+    merged = partials[0]
+    for stats in partials[1:]:
+        merged.merge(stats)
+
+    # Gather them again in one pass over every patient; the result must be the same.
+    whole = PopulationStats()
+    for _ in screen_chunks([(None, batch) for batch in batches], disease_stage_classes, stats = whole):
+        pass
+    assert merged.to_dict() == whole.to_dict()
+
+    # Check the error bound of the sketches against the exact quantiles.
+    for name in merged.attributes:
+        values = np.sort(np.concatenate([getattr(batch, name) for batch in batches]))
+        for q, estimate in merged.quantiles(name).items():
+            true = values[int(q * (len(values) - 1))]
+            assert abs(estimate - true) <= merged.sketches[name].relative_accuracy * true, (name, q, estimate, true)
+    print(merged.table())
+
+
+if __name__ == '__main__':
+    from sandbox.josh_sandbox.disease_testing.solution5 import StrokeStageA, IschemicStrokeStageA, HemorrhagicStrokeStageA, DiabetesStageA
+    test_collapse()
+    test([StrokeStageA, IschemicStrokeStageA, HemorrhagicStrokeStageA, DiabetesStageA])
@@ -0,0 +1,207 @@
+"""
+This file defines Profiler, which instruments the categorizers of the disease-stage classes of solution5.
+
+While a profiler is enabled, every call to a categorizer, whether through categorize(), categorizers, or screen(),
+is counted and timed, and its result is tallied, separately for each (disease-stage class, risk factor) pair.
+The report gives call counts, total and percentile latencies, and the distribution of categories, as a table
+or as JSON.
+
+Enabling a profiler replaces the categorizer functions on the classes with instrumented wrappers, and swaps each
+generated screen() method for one that goes through them. Disabling it puts the original functions and screen()
+methods back, so that when profiling is off there is no wrapper in the hot path and nothing is recorded.
+
+    with Profiler() as profiler:
+        test([StrokeStageA(), DiabetesStageA()])
+    print(profiler.table())
+
+Notes:
+    - Only one profiler can be enabled at a time, since it patches the classes themselves.
+    - Classes defined while a profiler is enabled are not instrumented.
+    - categorize_batch() is not profiled; it does not call the categorizers once per patient.
+"""
+import json
+import random
+from collections import Counter
+from functools import wraps
+from time import perf_counter_ns
+
+from sandbox.josh_sandbox.disease_testing.batch import PatientBatch
+from sandbox.josh_sandbox.disease_testing.solution5 import DiseaseStageBase
+
+PERCENTILES = (50, 90, 99)
+
+
+class CategorizerStats:
+    """
+    The statistics that a profiler keeps for one (disease-stage class, risk factor) pair.
+    """
+    SAMPLE_SIZE = 10000 # Latency percentiles are estimated from a uniform random sample of at most this many calls.
+
+    def __init__(self):
+        self.calls = 0
+        self.total_ns = 0
+        self.categories = Counter()
+        self._sample = []
+
+    def record(self, elapsed_ns, category):
+        self.calls += 1
+        self.total_ns += elapsed_ns
+        self.categories[category] += 1
+        if len(self._sample) < self.SAMPLE_SIZE:
+            self._sample.append(elapsed_ns)
+        else:
+            i = random.randrange(self.calls) # Reservoir sampling: every call is equally likely to be in the sample.
+            if i < self.SAMPLE_SIZE:
+                self._sample[i] = elapsed_ns
+
+    def percentile(self, p):
+        """
+        Return the estimated p-th percentile of the latency, in nanoseconds.
+        """
+        if not self._sample:
+            return 0
+        ordered = sorted(self._sample)
+        return ordered[min(len(ordered) - 1, len(ordered) * p // 100)]
+
+    def as_dict(self):
+        d = {'calls': self.calls,
+             'total_ns': self.total_ns,
+             'mean_ns': self.total_ns / self.calls if self.calls else 0.0}
+        d.update(('p{p}_ns'.format(p = p), self.percentile(p)) for p in PERCENTILES)
+        d['categories'] = {str(category): count for category, count in sorted(self.categories.items())}
+        return d
+
+
+class Profiler:
+    _active = None # The profiler that is currently enabled, if any.
+
+    def __init__(self, base = DiseaseStageBase):
+        """
+        :param base: the class whose subclasses are instrumented.
+        """
+        self.base = base
+        self.stats = {} # Maps (class_name, risk_factor) to CategorizerStats.
+        self._originals = [] # (cls, attribute_name, original value or None) for every attribute we replaced.
+
+    @property
+    def enabled(self):
+        return Profiler._active is self
+
+    def enable(self):
+        if self.enabled:
+            return self
+        if Profiler._active is not None:
+            raise RuntimeError("Another Profiler is already enabled.")
+
+        for cls in self._disease_stage_classes():
+            for risk_factor, method_name in cls._categorizer_dict.items():
+                f = cls.__dict__.get(method_name)
+                if f is not None and DiseaseStageBase._is_categorizer(f):
+                    self._replace(cls, method_name, self._instrument(f, risk_factor))
+            self._replace(cls, 'screen', _instrumented_screen)
+            cls._invalidate_tables() # Tables compiled so far refer to the uninstrumented functions.
+
+        Profiler._active = self
+        return self
+
+    def disable(self):
+        if not self.enabled:
+            return self
+        for cls, name, original in reversed(self._originals):
+            if original is None:
+                delattr(cls, name)
+            else:
+                setattr(cls, name, original)
+        for cls in {cls for cls, _, _ in self._originals}:
+            cls._invalidate_tables()
+        self._originals = []
+        Profiler._active = None
+        return self
+
+    def reset(self):
+        self.stats = {}
+
+    def __enter__(self):
+        return self.enable()
+
+    def __exit__(self, *exc_info):
+        self.disable()
+        return False
+
+    def _disease_stage_classes(self):
+        pending = [self.base]
+        seen = set()
+        while pending:
+            cls = pending.pop()
+            if cls in seen:
+                continue
+            seen.add(cls)
+            pending.extend(cls.__subclasses__())
+            if cls is not DiseaseStageBase:
+                yield cls
+
+    def _replace(self, cls, name, value):
+        self._originals.append((cls, name, cls.__dict__.get(name)))
+        setattr(cls, name, value)
+
+    def _instrument(self, f, risk_factor):
+        """
+        Return a wrapper around the categorizer function f that records each call made on a single patient.
+        """
+        stats = self.stats
+
+        @wraps(f) # Also copies the categorizer flags, such as _risk_factor, that f carries.
+        def instrumented(disease_stage, patient):
+            if isinstance(patient, PatientBatch):
+                return f(disease_stage, patient)
+            start = perf_counter_ns()
+            category = f(disease_stage, patient)
+            elapsed_ns = perf_counter_ns() - start
+            key = (disease_stage.__class__.__name__, risk_factor)
+            entry = stats.get(key)
+            if entry is None:
+                entry = stats[key] = CategorizerStats()
+            entry.record(elapsed_ns, category)
+            return category
+
+        return instrumented
+
+    def report(self):
+        """
+        Return the statistics as a list of dicts, one per (stage, risk_factor), sorted by total time, largest first.
+        """
+        rows = [dict(stage = stage, risk_factor = risk_factor, **entry.as_dict())
+                for (stage, risk_factor), entry in self.stats.items()]
+        return sorted(rows, key = lambda row: row['total_ns'], reverse = True)
+
+    def to_json(self, **kwds):
+        return json.dumps(self.report(), **kwds)
+
+    def table(self):
+        columns = ['stage', 'risk_factor', 'calls', 'total_ns', 'mean_ns'] + ['p{p}_ns'.format(p = p) for p in PERCENTILES]
+        lines = ['{:<28}{:<22}'.format(*columns[:2]) + ''.join('{:>12}'.format(column) for column in columns[2:])
+                 + '  categories']
+        for row in self.report():
+            lines.append('{:<28}{:<22}'.format(row['stage'], row['risk_factor'])
+                         + ''.join('{:>12.0f}'.format(row[column]) for column in columns[2:])
+                         + '  ' + ', '.join('{}: {}'.format(category, count) for category, count in row['categories'].items()))
+        return '\n'.join(lines)
+
+
+def _instrumented_screen(self, patient):
+    """
+    Stands in for the generated screen() while profiling, so that every categorizer goes through its wrapper.
+    """
+    return tuple(self.get_categorizer(risk_factor)(patient) for risk_factor in self.risk_factor_order)
+
+
+if __name__ == '__main__':
+    from sandbox.josh_sandbox.disease_testing.batch import random_batch
+    from sandbox.josh_sandbox.disease_testing.solution5 import StrokeStageA, IschemicStrokeStageA, HemorrhagicStrokeStageA, DiabetesStageA
+
+    disease_stages = [StrokeStageA(), IschemicStrokeStageA(), HemorrhagicStrokeStageA(), DiabetesStageA()]
+    with Profiler() as profiler:
+        for patient in random_batch(10000):
+            for disease_stage in disease_stages:
+                disease_stage.screen(patient)
+    print(profiler.table())
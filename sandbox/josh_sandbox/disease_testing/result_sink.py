@@ -0,0 +1,313 @@
+"""
+This file defines ResultWriter and ResultReader, for a compact binary format of screening results.
+
+Formatting every result as text costs more than screening at large volumes. A ResultWriter instead buffers
+(patient_id, stage, risk_factor, category) tuples in columns: patient ids as int64, stage and risk-factor names
+as uint16 codes into dictionaries of names, and categories as uint8, so a result takes 13 bytes. When the buffer
+holds buffer_rows results, it is written out as one block, with one large sequential write per column.
+
+A ResultReader memory-maps the file and hands out each block's columns as NumPy arrays that are views of the
+map, so reading copies nothing. to_csv() converts a results file to CSV, for humans.
+
+File layout (all integers little-endian):
+
+    MAGIC, format version (uint32), 4 bytes of padding
+    block 0: patient_id int64[n], stage uint16[n], risk_factor uint16[n], category uint8[n],
+             each column padded to a multiple of 8 bytes
+    block 1: ...
+    footer: JSON {"stages": [...], "risk_factors": [...], "blocks": [[offset, n], ...]}
+    footer length (uint64), MAGIC
+
+The dictionaries and the block table are in the footer, so that they can grow while results are being written.
+Patient ids must be integers.
+
+    with ResultWriter('results.dsr') as writer:
+        for patient_ids, columns, categories in screen_chunks(chunks, classes):
+            writer.add_chunk(patient_ids, columns, categories)
+
+    python -m sandbox.josh_sandbox.disease_testing.result_sink results.dsr results.csv
+"""
+import argparse
+import csv
+import json
+import struct
+import time
+from array import array
+
+import numpy as np
+
+MAGIC = b'DSRSLT\0\0'
+FORMAT_VERSION = 1
+HEADER = MAGIC + struct.pack('<I', FORMAT_VERSION) + bytes(4)
+TRAILER = struct.Struct('<Q8s') # Footer length, MAGIC.
+RESULT_SUFFIX = '.dsr'
+DEFAULT_BUFFER_ROWS = 1 << 20
+
+# The columns of a block, in file order, with their dtypes.
+COLUMNS = (('patient_id', np.dtype('<i8')), ('stage', np.dtype('<u2')), ('risk_factor', np.dtype('<u2')),
+           ('category', np.dtype('u1')))
+MAX_CODES = np.iinfo(np.uint16).max + 1
+
+
+def _padded(nbytes):
+    return (nbytes + 7) // 8 * 8
+
+
+def _column_offsets(offset, n):
+    """
+    Return the offset of each column of a block of n results that starts at offset, and the offset just past it.
+    """
+    offsets = []
+    for _, dtype in COLUMNS:
+        offsets.append(offset)
+        offset += _padded(n * dtype.itemsize)
+    return offsets, offset
+
+
+# =============================================================================
+#                     Writing
+# =============================================================================
+class ResultWriter:
+    def __init__(self, path, buffer_rows = DEFAULT_BUFFER_ROWS):
+        """
+        Create the results file path, replacing any existing file.
+        :param buffer_rows: the number of results to collect before writing them out as a block.
+        """
+        self.path = path
+        self.buffer_rows = buffer_rows
+        self.stages = []       # Code -> name.
+        self.risk_factors = []
+        self._stage_codes = {} # Name -> code.
+        self._risk_factor_codes = {}
+        self._blocks = []      # (offset, n) of each block written so far.
+        self._chunks = []      # Buffered results, as lists of column arrays in the order of COLUMNS.
+        self._rows = array('q'), array('H'), array('H'), array('B') # Buffered results added one at a time by add().
+        self._buffered = 0
+        self._file = open(path, 'wb')
+        self._file.write(HEADER)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    @staticmethod
+    def _code(name, codes, names):
+        code = codes.get(name)
+        if code is None:
+            if len(names) == MAX_CODES:
+                raise ValueError("Too many distinct names; at most {n} are supported.".format(n = MAX_CODES))
+            code = codes[name] = len(names)
+            names.append(name)
+        return code
+
+    def add(self, patient_id, stage, risk_factor, category):
+        """
+        Add one result.
+        :param stage: the name of the disease-stage class.
+        """
+        patient_ids, stages, risk_factors, categories = self._rows
+        patient_ids.append(int(patient_id))
+        stages.append(self._code(stage, self._stage_codes, self.stages))
+        risk_factors.append(self._code(risk_factor, self._risk_factor_codes, self.risk_factors))
+        categories.append(category)
+        self._buffered += 1
+        if self._buffered >= self.buffer_rows:
+            self.flush()
+
+    def add_chunk(self, patient_ids, columns, categories):
+        """
+        Add a chunk of results, as yielded by pipeline.screen_chunks().
+        :param columns: the result column names, <stage>.<risk factor>
+        :param categories: a (patient x column) array of categories.
+        """
+        self._take_rows()
+        names = [column.partition('.') for column in columns]
+        stage_codes = np.array([self._code(stage, self._stage_codes, self.stages) for stage, _, _ in names], dtype = np.uint16)
+        risk_factor_codes = np.array([self._code(risk_factor, self._risk_factor_codes, self.risk_factors)
+                                      for _, _, risk_factor in names], dtype = np.uint16)
+        n = len(patient_ids)
+        self._chunks.append([np.repeat(np.asarray(patient_ids, dtype = np.int64), len(columns)),
+                             np.tile(stage_codes, n),
+                             np.tile(risk_factor_codes, n),
+                             np.asarray(categories, dtype = np.uint8).reshape(-1)]) # Row-major: patient by patient.
+        self._buffered += n * len(columns)
+        if self._buffered >= self.buffer_rows:
+            self.flush()
+
+    def _take_rows(self):
+        """
+        Move the results added by add() to the chunk buffer, preserving their order.
+        """
+        if len(self._rows[0]):
+            self._chunks.append([np.frombuffer(column, dtype = dtype).copy()
+                                 for column, (_, dtype) in zip(self._rows, COLUMNS)])
+            for column in self._rows:
+                del column[:]
+
+    def flush(self):
+        """
+        Write the buffered results out as one block.
+        """
+        self._take_rows()
+        if not self._chunks:
+            return
+        offset = self._file.tell()
+        n = 0
+        for i, (_, dtype) in enumerate(COLUMNS):
+            column = np.concatenate([chunk[i] for chunk in self._chunks]).astype(dtype, copy = False)
+            n = len(column)
+            self._file.write(column.tobytes())
+            self._file.write(bytes(_padded(column.nbytes) - column.nbytes))
+        self._blocks.append((offset, n))
+        self._chunks = []
+        self._buffered = 0
+
+    def close(self):
+        if self._file.closed:
+            return
+        self.flush()
+        footer = json.dumps({'stages': self.stages, 'risk_factors': self.risk_factors, 'blocks': self._blocks}).encode()
+        self._file.write(footer)
+        self._file.write(TRAILER.pack(len(footer), MAGIC))
+        self._file.close()
+
+
+def write_screened(screened_chunks, path, buffer_rows = DEFAULT_BUFFER_ROWS):
+    """
+    Write every chunk of screened_chunks, as yielded by pipeline.screen_chunks(), to the results file path.
+    :return: the number of patients written.
+    """
+    n = 0
+    with ResultWriter(path, buffer_rows) as writer:
+        for patient_ids, columns, categories in screened_chunks:
+            writer.add_chunk(patient_ids, columns, categories)
+            n += len(patient_ids)
+    return n
+
+
+# =============================================================================
+#                     Reading
+# =============================================================================
+class ResultReader:
+    def __init__(self, path):
+        self._map = np.memmap(path, dtype = np.uint8, mode = 'r')
+        if bytes(self._map[:len(HEADER)]) != HEADER:
+            raise ValueError("{path} is not a results file of format version {version}.".format(path = path,
+                                                                                                version = FORMAT_VERSION))
+        footer_length, magic = TRAILER.unpack(bytes(self._map[-TRAILER.size:]))
+        if magic != MAGIC:
+            raise ValueError("{path} is truncated: it has no footer.".format(path = path))
+        footer = json.loads(bytes(self._map[-TRAILER.size - footer_length:-TRAILER.size]))
+        self.stages = footer['stages']
+        self.risk_factors = footer['risk_factors']
+        self._blocks = footer['blocks']
+
+    def __len__(self):
+        return sum(n for _, n in self._blocks)
+
+    def blocks(self):
+        """
+        Yield, for each block, a dict mapping the column names of COLUMNS to arrays that are views of the file.
+        """
+        for offset, n in self._blocks:
+            offsets, _ = _column_offsets(offset, n)
+            yield {name: self._map[start:start + n * dtype.itemsize].view(dtype)
+                   for (name, dtype), start in zip(COLUMNS, offsets)}
+
+    def column(self, name):
+        """
+        Return the whole column name. This is a view of the file if it has a single block, and a copy otherwise.
+        """
+        columns = [block[name] for block in self.blocks()]
+        if len(columns) == 1:
+            return columns[0]
+        return np.concatenate(columns) if columns else np.empty(0, dtype = dict(COLUMNS)[name])
+
+    def __iter__(self):
+        """
+        Yield every result as a (patient_id, stage, risk_factor, category) tuple, with names decoded.
+        """
+        for block in self.blocks():
+            yield from zip(block['patient_id'].tolist(),
+                           [self.stages[code] for code in block['stage'].tolist()],
+                           [self.risk_factors[code] for code in block['risk_factor'].tolist()],
+                           block['category'].tolist())
+
+    def to_csv(self, path):
+        """
+        Write the results to path as CSV, one result per line.
+        :return: the number of results written.
+        """
+        stages = np.array(self.stages, dtype = object)
+        risk_factors = np.array(self.risk_factors, dtype = object)
+        with open(path, 'w', newline = '') as f:
+            writer = csv.writer(f)
+            writer.writerow(['patient_id', 'stage', 'risk_factor', 'category'])
+            for block in self.blocks():
+                writer.writerows(zip(block['patient_id'].tolist(), stages[block['stage']], risk_factors[block['risk_factor']],
+                                     block['category'].tolist()))
+        return len(self)
+
+
+# =============================================================================
+#                     Command line
+# =============================================================================
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Convert a binary results file to CSV.")
+    parser.add_argument('input', help = "a {suffix} results file".format(suffix = RESULT_SUFFIX))
+    parser.add_argument('output', help = "the .csv file to write")
+    args = parser.parse_args(argv)
+    return ResultReader(args.input).to_csv(args.output)
+
+
+# =============================================================================
+#                     Test
+# =============================================================================
+def test(disease_stage_classes, n = 1_000_000, chunk_size = 100_000):
+    import os
+    import tempfile
+    from sandbox.josh_sandbox.disease_testing.batch import random_batch
+    from sandbox.josh_sandbox.disease_testing.pipeline import screen_chunks, write_results
+
+    batches = [random_batch(chunk_size, seed = i) for i in range(n // chunk_size)]
+    def chunks():
+        return ((range(i * chunk_size, (i + 1) * chunk_size), batch) for i, batch in enumerate(batches))
+    screened = list(screen_chunks(chunks(), disease_stage_classes))
+
+    with tempfile.TemporaryDirectory() as directory:
+        csv_path = os.path.join(directory, 'results_test.csv')
+        result_path = os.path.join(directory, 'results_test' + RESULT_SUFFIX)
+        converted_path = os.path.join(directory, 'results_test_converted.csv')
+        for path, write in [(csv_path, write_results), (result_path, write_screened)]:
+            start = time.perf_counter()
+            write(iter(screened), path)
+            print("{name}: written in {s:.2f}s, {mb:.1f} MB".format(name = os.path.basename(path),
+                                                                     s = time.perf_counter() - start,
+                                                                     mb = os.path.getsize(path) / 2 ** 20))
+
+        reader = ResultReader(result_path)
+        _, columns, categories = screened[-1]
+        assert len(reader) == n * len(columns)
+        assert np.shares_memory(next(reader.blocks())['category'], reader._map)
+        last = list(reader)[-len(columns):]
+        assert last == [(n - 1, *column.partition('.')[::2], category) for column, category in zip(columns, categories[-1].tolist())]
+        del reader
+
+        start = time.perf_counter()
+        main([result_path, converted_path])
+        print("Converted to CSV, one result per line, in {s:.2f}s, {mb:.1f} MB".format(
+            s = time.perf_counter() - start, mb = os.path.getsize(converted_path) / 2 ** 20))
+
+        # Results added one at a time, interleaved with chunks, keep their order.
+        with ResultWriter(result_path, buffer_rows = 5) as writer:
+            writer.add(7, 'StrokeStageA', 'age', 1)
+            writer.add_chunk([8, 9], ['StrokeStageA.age', 'DiabetesStageA.blood_sugar'], [[0, 1], [1, 0]])
+            writer.add(10, 'DiabetesStageA', 'blood_sugar', 2)
+        assert [row[0] for row in ResultReader(result_path)] == [7, 8, 8, 9, 9, 10]
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""
+This file defines ThresholdRule, the declarative form of the most common kind of categorizer:
+one that compares a single patient attribute against a cutoff, e.g.,
+
+    0 if patient.systolic_blood_pressure < 120 else 1
+
+and BandRule, its generalization to several bands, e.g., normal / elevated / stage 1 / stage 2 blood pressure:
+
+    0 if bp < 120 else 1 if bp < 130 else 2 if bp < 140 else 3
+
+Because a rule is data rather than code, it can be inspected, serialized, and evaluated in bulk
+over a whole column of patients at once. Both kinds of rule have the same interface: categorize(),
+categorize_column(), cutpoints, and to_dict(); rule_from_dict() rebuilds either kind.
+"""
+import math
+import operator
+from bisect import bisect_right
+from collections import namedtuple
+from numbers import Real
+
+import numpy as np
+
+from sandbox.josh_sandbox.disease_testing.batch import CATEGORY_DTYPE
+from sandbox.josh_sandbox.disease_testing.common import Patient
+
+# Maps the name of a comparator to the function that implements it.
+# The operator functions work elementwise on NumPy arrays as well as on plain numbers.
+COMPARATORS = {
+    '>=': operator.ge,
+    '>':  operator.gt,
+    '<=': operator.le,
+    '<':  operator.lt,
+}
+
+
+def _check_value(value, what):
+    """
+    Raise TypeError unless value is a real number (not a bool), and ValueError if it is NaN, which no value compares to.
+    """
+    if not isinstance(value, Real) or isinstance(value, bool):
+        raise TypeError("A {what} must be a number, not {value!r}".format(what = what, value = value))
+    if math.isnan(value):
+        raise ValueError("A {what} cannot be NaN.".format(what = what))
+
+
+class ThresholdRule(namedtuple('ThresholdRule', ['attribute', 'comparator', 'threshold'])):
+    """
+    A patient is in category 1 if <patient.attribute> <comparator> <threshold> holds, otherwise in category 0.
+    The default comparator, '>=', reproduces the hand-written form 0 if patient.attribute < threshold else 1.
+    """
+    __slots__ = ()
+
+    def __new__(cls, attribute, comparator, threshold):
+        if attribute not in Patient.ATTRIBUTES:
+            raise ValueError("Unknown patient attribute: {attribute}".format(attribute = attribute))
+        if comparator not in COMPARATORS:
+            raise ValueError("Unknown comparator {comparator}; expected one of {known}".format(comparator = comparator,
+                                                                                          known = sorted(COMPARATORS)))
+        _check_value(threshold, 'threshold')
+        return super().__new__(cls, attribute, comparator, threshold)
+
+    def categorize(self, patient):
+        """
+        Return the category of a single patient (or, elementwise, of a PatientBatch).
+        """
+        return COMPARATORS[self.comparator](getattr(patient, self.attribute), self.threshold) * 1
+
+    def categorize_column(self, values):
+        """
+        Return an array holding the category of each value in values, an array of the rule's attribute.
+        """
+        return COMPARATORS[self.comparator](values, self.threshold).astype(CATEGORY_DTYPE)
+
+    @property
+    def cutpoints(self):
+        """
+        Return the values of the attribute at which the category can change.
+        """
+        return (self.threshold,)
+
+    def to_dict(self):
+        return dict(self._asdict())
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['attribute'], d.get('comparator', '>='), d['threshold'])
+
+
+class BandRule(namedtuple('BandRule', ['attribute', 'cutpoints'])):
+    """
+    A patient is in category k if <patient.attribute> is at or above k of the cutpoints, which are in increasing order.
+    So category 0 is below cutpoints[0], category k is [cutpoints[k - 1], cutpoints[k]), and the last category,
+    len(cutpoints), is at or above cutpoints[-1]. With a single cutpoint, this is ThresholdRule(attribute, '>=', cut).
+
+    Finding the band is a binary search, so its cost grows with the logarithm of the number of bands.
+    """
+    __slots__ = ()
+
+    MAX_CUTPOINTS = np.iinfo(CATEGORY_DTYPE).max - 1 # Categories must fit in CATEGORY_DTYPE, short of NOT_SCREENED.
+
+    def __new__(cls, attribute, cutpoints):
+        if attribute not in Patient.ATTRIBUTES:
+            raise ValueError("Unknown patient attribute: {attribute}".format(attribute = attribute))
+        cutpoints = tuple(cutpoints)
+        if not 0 < len(cutpoints) <= cls.MAX_CUTPOINTS:
+            raise ValueError("A BandRule needs between 1 and {n} cutpoints.".format(n = cls.MAX_CUTPOINTS))
+        for cut in cutpoints:
+            _check_value(cut, 'cutpoint')
+        if any(a >= b for a, b in zip(cutpoints, cutpoints[1:])):
+            raise ValueError("Cutpoints must be strictly increasing: {cutpoints}".format(cutpoints = cutpoints))
+        return super().__new__(cls, attribute, cutpoints)
+
+    def categorize(self, patient):
+        """
+        Return the category of a single patient.
+        """
+        return bisect_right(self.cutpoints, getattr(patient, self.attribute))
+
+    def categorize_column(self, values):
+        """
+        Return an array holding the category of each value in values, an array of the rule's attribute.
+        """
+        return np.searchsorted(np.array(self.cutpoints, dtype = np.float64), values, side = 'right').astype(CATEGORY_DTYPE)
+
+    def to_dict(self):
+        return {'attribute': self.attribute, 'cutpoints': list(self.cutpoints)}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['attribute'], d['cutpoints'])
+
+
+def rule_from_dict(d):
+    """
+    Return the ThresholdRule or BandRule that d, as returned by its to_dict(), describes.
+    """
+    return BandRule.from_dict(d) if 'cutpoints' in d else ThresholdRule.from_dict(d)
@@ -0,0 +1,180 @@
+"""
+This file defines ScreeningIndex, which screens a patient against many disease stages at once.
+
+Screening stage by stage reads and compares the same patient attribute once per categorizer that uses it.
+StrokeStageA, HemorrhagicStrokeStageA and DiabetesStageA, for example, all compare systolic_blood_pressure,
+against 120, 170 and 150 respectively. The index instead groups the rules of all stages (threshold and band
+rules alike) by the attribute they test. For each attribute it keeps the distinct cutoffs in a sorted array, and
+precomputes, for every interval between (and at) those cutoffs, the categories that every rule on that attribute
+assigns. Screening then costs one binary search per distinct attribute, no matter how many stages there are.
+
+Categorizers that are not rules are still called one by one, on an instance of their stage.
+"""
+from bisect import bisect_left
+import time
+
+import numpy as np
+
+from sandbox.josh_sandbox.disease_testing.batch import CATEGORY_DTYPE
+
+NOT_SCREENED = np.iinfo(CATEGORY_DTYPE).max # Result-matrix entry for a risk factor that a stage does not categorize.
+
+
+class _AttributeIndex:
+    """
+    The rules of all indexed stages that test one patient attribute.
+    """
+    def __init__(self, attribute, placed_rules):
+        """
+        :param attribute: the name of a Patient attribute
+        :param placed_rules: a list of (flat_position, rule) pairs, where flat_position is the index of the rule's
+                             entry in the flattened (stage x risk_factor) result matrix.
+        """
+        self.attribute = attribute
+        self.cuts = sorted({cut for _, rule in placed_rules for cut in rule.cutpoints})
+        self.cut_array = np.array(self.cuts, dtype = np.float64)
+        self.positions = np.array([position for position, _ in placed_rules], dtype = np.intp)
+
+        # Region 2*i is the open interval just below cuts[i] (region 2*len(cuts) is above the last cut),
+        # and region 2*i+1 is the value cuts[i] itself. A representative value of each region is enough
+        # to work out what every rule answers anywhere in that region.
+        representatives = []
+        for i, cut in enumerate(self.cuts):
+            below = self.cuts[i - 1] if i > 0 else cut - 1
+            representatives.extend([(below + cut) / 2, cut])
+        representatives.append(self.cuts[-1] + 1)
+
+        representatives = np.array(representatives, dtype = np.float64)
+        self.patterns = np.column_stack([rule.categorize_column(representatives) for _, rule in placed_rules])
+
+    def region(self, value):
+        """
+        Return the region that value falls in, using one binary search.
+        """
+        i = bisect_left(self.cuts, value)
+        return 2 * i + 1 if i < len(self.cuts) and self.cuts[i] == value else 2 * i
+
+    def regions(self, values):
+        """
+        Return the region of every value in the array values.
+        """
+        # For distinct cuts, searchsorted right - left is 1 exactly when a value equals a cut, so left + right is
+        # the same region number that region() computes.
+        return np.searchsorted(self.cut_array, values, 'left') + np.searchsorted(self.cut_array, values, 'right')
+
+
+class ScreeningIndex:
+    def __init__(self, disease_stage_classes):
+        """
+        Build an index over the categorizers of disease_stage_classes.
+        :param disease_stage_classes: a list of DiseaseStageBase subclasses (classes, not instances).
+        """
+        self.stages = list(disease_stage_classes)
+        self.risk_factors = sorted({risk_factor for cls in self.stages for risk_factor in cls._categorizer_dict})
+        self._column = {risk_factor: j for j, risk_factor in enumerate(self.risk_factors)}
+
+        rules_by_attribute = {}
+        self._fallbacks = [] # (flat_position, bound_method) pairs for categorizers that are not rules.
+        for i, cls in enumerate(self.stages):
+            disease_stage = cls()
+            for risk_factor, method in disease_stage.categorizers:
+                position = i * len(self.risk_factors) + self._column[risk_factor]
+                rule = cls._rules.get(risk_factor)
+                if rule is None:
+                    self._fallbacks.append((position, method))
+                else:
+                    rules_by_attribute.setdefault(rule.attribute, []).append((position, rule))
+
+        self._attribute_indexes = [_AttributeIndex(attribute, placed_rules)
+                                   for attribute, placed_rules in rules_by_attribute.items()]
+
+    @property
+    def shape(self):
+        return len(self.stages), len(self.risk_factors)
+
+    def screen(self, patient):
+        """
+        Screen patient against every indexed stage.
+        :param patient: a Patient
+        :return: a (stage x risk_factor) array of categories, ordered as self.stages and self.risk_factors.
+                 Risk factors that a stage does not categorize hold NOT_SCREENED.
+        """
+        result = np.full(len(self.stages) * len(self.risk_factors), NOT_SCREENED, dtype = CATEGORY_DTYPE)
+        for index in self._attribute_indexes:
+            result[index.positions] = index.patterns[index.region(getattr(patient, index.attribute))]
+        for position, method in self._fallbacks:
+            result[position] = method(patient)
+        return result.reshape(self.shape)
+
+    def screen_batch(self, batch):
+        """
+        Screen every patient of batch against every indexed stage.
+        :param batch: a PatientBatch
+        :return: a (patient x stage x risk_factor) array of categories.
+        """
+        result = np.full((len(batch), len(self.stages) * len(self.risk_factors)), NOT_SCREENED, dtype = CATEGORY_DTYPE)
+        for index in self._attribute_indexes:
+            result[:, index.positions] = index.patterns[index.regions(getattr(batch, index.attribute))]
+        for position, method in self._fallbacks:
+            result[:, position] = np.fromiter((method(patient) for patient in batch), dtype = CATEGORY_DTYPE, count = len(batch))
+        return result.reshape((len(batch),) + self.shape)
+
+    def category(self, result, stage_class, risk_factor):
+        """
+        Look up the category of (stage_class, risk_factor) in a matrix returned by screen().
+        """
+        return result[self.stages.index(stage_class), self._column[risk_factor]]
+
+
+# =============================================================================
+#                     Test
+# =============================================================================
+def make_synthetic_stages(n, seed = 0):
+    """
+    Return n disease-stage classes, each with a threshold categorizer on every patient attribute
+    at a random cutoff. Stands in for a production catalog with hundreds of stages.
+    """
+    from sandbox.josh_sandbox.disease_testing.batch import random_batch
+    from sandbox.josh_sandbox.disease_testing.solution5 import DiseaseStageBase, threshold_categorizer
+
+    sample = random_batch(1000, seed)
+    rng = np.random.default_rng(seed)
+    classes = []
+    for i in range(n):
+        namespace = {'_categorize_' + name: threshold_categorizer(name, attr = name, cut = float(rng.choice(column)))
+                     for name, column in sample.columns.items()}
+        classes.append(type('SyntheticStage{i}'.format(i = i), (DiseaseStageBase,), namespace))
+    return classes
+
+
+def test(disease_stage_classes, n = 2000):
+    """
+    Check the index against the per-stage categorizers on n synthetic patients, and time both.
+    """
+    from sandbox.josh_sandbox.disease_testing.batch import random_batch
+
+    index = ScreeningIndex(disease_stage_classes)
+    disease_stages = [cls() for cls in disease_stage_classes]
+    patients = list(random_batch(n))
+
+    start = time.perf_counter()
+    expected = [[[disease_stage.categorize(risk_factor, patient) if risk_factor in disease_stage.risk_factors else NOT_SCREENED
+                  for risk_factor in index.risk_factors]
+                 for disease_stage in disease_stages]
+                for patient in patients]
+    loop_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = [index.screen(patient) for patient in patients]
+    index_seconds = time.perf_counter() - start
+
+    assert [result.tolist() for result in actual] == expected, "ScreeningIndex disagrees with the categorizers"
+    print("{stages} stages, {n} patients: per-stage loop {loop:.3f}s, index {index:.3f}s".format(
+        stages = len(disease_stage_classes), n = n, loop = loop_seconds, index = index_seconds))
+
+
+if __name__ == '__main__':
+    from sandbox.josh_sandbox.disease_testing.solution5 import (StrokeStageA, IschemicStrokeStageA, HemorrhagicStrokeStageA,
+                                                                DiabetesStageA, HypertensionStageA)
+    test([StrokeStageA, IschemicStrokeStageA, HemorrhagicStrokeStageA, DiabetesStageA, HypertensionStageA])
+    test(make_synthetic_stages(300), n = 200)
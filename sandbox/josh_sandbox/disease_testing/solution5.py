@@ -11,8 +11,72 @@ the categorizer_dict of the disease-stage class that defines them, so that clien
 code does not have to explicitly do this. Further, it guarantees that subclassing a disease-stage
 class works correctly. If IschemicStrokeStageA is a subclass of StrokeStageA, then it automatically
 inherits and installs all of the categorizers of its class parent.
+
+Categorizers that are declared vectorized can also categorize a whole batch.PatientBatch in one call;
+see DiseaseStageBase.categorize_batch().
+
+Most categorizers simply compare one patient attribute against a cutoff. Those are best declared
+with threshold_categorizer(), which records the comparison as a rules.ThresholdRule. Each class compiles
+its rules into a table, _threshold_rules, that can be inspected, serialized, and evaluated in bulk.
+Hand-written @categorizer methods remain available for anything that is not a simple threshold.
+
+Categorizers with more than two categories, e.g. normal / elevated / stage 1 / stage 2 blood pressure, are best
+declared with banded_categorizer(), which records a sorted list of cutpoints as a rules.BandRule. A patient's band
+is found by binary search (bisect for one patient, searchsorted for a batch), so the cost grows with the logarithm
+of the number of bands, rather than linearly as with a chain of ifs. Threshold and band rules together make up
+the class's rule table, _rules.
+
+Each class also gets a generated screen(patient) method that returns all of its categories as a tuple,
+ordered as the class attribute risk_factor_order. Threshold rules are compiled inline into screen(), and
+hand-written categorizers are called directly as functions, so screening a patient involves no getattr()
+dispatch and creates no bound methods.
+
+Results of categorize() can be cached; see DiseaseStageBase.enable_cache(). Categorizers declare the patient
+attributes they read, and results are cached under just those values, so patients who differ only in
+attributes that a categorizer ignores share a cache entry.
+
+Defining a class is kept cheap, so that catalogs with thousands of stages import quickly. __init_subclass__ looks
+only at the class's own __dict__, and a class that defines no categorizers of its own shares its parent's
+_categorizer_dict rather than copying it. Everything derived from _categorizer_dict (the rule table,
+risk_factor_order, screen(), and so on) is compiled the first time it is used; see _CompiledOnFirstUse.
+
+Disease-stage instances are immutable flyweights: every call to StrokeStageA() returns the same instance, which has
+no per-instance state at all (__slots__ = ()). categorize() and screen_into() call categorizers as plain functions
+looked up in a class-level table, rather than creating a bound method per call, so screening a stream of patients
+into a preallocated buffer allocates nothing per categorizer call.
 """
-from sandbox.josh_sandbox.disease_testing.common import test
+from bisect import bisect_right
+from functools import partial
+from operator import attrgetter
+from types import MethodType
+
+import numpy as np
+
+from sandbox.josh_sandbox.disease_testing.batch import CATEGORY_DTYPE
+from sandbox.josh_sandbox.disease_testing.cache import LRUCache, MISSING
+from sandbox.josh_sandbox.disease_testing.common import Patient, test
+from sandbox.josh_sandbox.disease_testing.rules import COMPARATORS, BandRule, ThresholdRule
+
+
+# =============================================================================
+#                     Lazy class tables
+# =============================================================================
+class _CompiledOnFirstUse:
+    """
+    A placeholder for one of the tables that a DiseaseStageBase subclass derives from its _categorizer_dict.
+    The first time any of them is read, the class compiles them all, and the compiled values replace the
+    placeholders in the class's __dict__, so that later reads are plain attribute lookups.
+    The placeholder for screen() is separate: only reading screen itself generates and compiles it.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if self.name == 'screen':
+            owner.screen = owner._compile_screen()
+        else:
+            owner._compile_tables()
+        return getattr(owner if instance is None else instance, self.name)
 
 
 # =============================================================================
@@ -20,21 +84,107 @@ from sandbox.josh_sandbox.disease_testing.common import test
 # =============================================================================
 
 class DiseaseStageBase:
+    __slots__ = ()         # Instances carry no state; see __new__().
+
     _categorizer_dict = {} # Maps risk factors to the names of methods that implement their associated categorizers.
                            # Example: 'blood_pressure' -> '_categorize_bp'
+    _rules = {}            # Maps risk factors to the rule (ThresholdRule or BandRule) of their categorizer, for those
+                           # categorizers declared with threshold_categorizer() or banded_categorizer().
+    _threshold_rules = {}  # The ThresholdRules of _rules. Both are compiled from _categorizer_dict.
+    risk_factor_order = () # The risk factors of the class, in the order in which screen() returns their categories.
+    _categorizer_reads = {}# Maps risk factors to the names of the Patient attributes that their categorizer reads.
+    _cache_key_getters = {}# Maps risk factors to a function that extracts, from a patient, the attribute values that
+                           # their categorizer reads. None for categorizers that must not be cached.
+    _category_cache = None # The LRUCache used by categorize(), if caching has been enabled. See enable_cache().
+    _categorizer_functions = {} # Maps risk factors to the plain function that implements their categorizer.
+    _ordered_functions = ()     # The functions of _categorizer_functions, ordered as risk_factor_order.
+
+    _COMPILED_TABLES = ('_rules', '_threshold_rules', 'risk_factor_order', '_categorizer_reads', '_cache_key_getters',
+                        '_categorizer_functions', '_ordered_functions')
+
+    def __new__(cls):
+        """
+        Return the one instance of cls, creating it the first time.
+        """
+        instance = cls.__dict__.get('_flyweight') # Not inherited: each class has its own instance.
+        if instance is None:
+            instance = super().__new__(cls)
+            cls._flyweight = instance
+        return instance
+
+
+    def __setattr__(self, name, value):
+        raise AttributeError("{cls} instances are shared, and cannot be modified.".format(cls = self.__class__.__name__))
+
+
+    def __copy__(self):
+        return self
+
+
+    def __deepcopy__(self, memo):
+        return self
 
     def __init_subclass__(cls, **kwargs):
         """
         Install onto ourselves all method names that have been decorated as categorizers.
         :return: self
         """
-        cls._categorizer_dict = cls._categorizer_dict.copy() # Copy the dict from our parent.
-                                                             # This is important; otherwise, the parent gets polluted with its
-                                                             # childrens' risk factors. By copying, the child always gets everything
-                                                             # already defined on the parent, which is correct inheritance behavior.
+        defined = dict(cls._get_defined_categorizers())
+        if defined:
+            cls._categorizer_dict = {**cls._categorizer_dict, **defined} # Copy the dict from our parent.
+                                                                         # This is important; otherwise, the parent gets polluted with its
+                                                                         # childrens' risk factors. By copying, the child always gets everything
+                                                                         # already defined on the parent, which is correct inheritance behavior.
+        # Otherwise we have nothing to add, and simply inherit our parent's dict. Since a _categorizer_dict
+        # is never modified once its class has been defined, sharing it is safe.
 
-        for risk_factor, method_name in cls._get_defined_categorizers():
-            cls._categorizer_dict[risk_factor] = method_name
+        for name in cls._COMPILED_TABLES:
+            setattr(cls, name, _CompiledOnFirstUse(name))
+        if 'screen' not in cls.__dict__: # Leave a hand-written screen() alone.
+            cls.screen = _CompiledOnFirstUse('screen')
+
+
+    @classmethod
+    def _compile_tables(cls):
+        """
+        Compile the tables that we derive from our _categorizer_dict, replacing their _CompiledOnFirstUse placeholders.
+        """
+        # Compile the rule table from scratch rather than copying the parent's, so that a subclass
+        # that overrides a threshold categorizer with a hand-written one drops the parent's rule.
+        rules = {}
+        categorizer_reads = {}
+        cache_key_getters = {}
+        categorizer_functions = {}
+        for risk_factor, method_name in cls._categorizer_dict.items():
+            f = getattr(cls, method_name) # Looked up on the class, this is a plain function, not a bound method.
+            categorizer_functions[risk_factor] = f
+            if cls._is_rule_categorizer(f):
+                rules[risk_factor] = f._rule
+            # A subclass may override a categorizer by name with a plain, undecorated method, which is taken to read
+            # every attribute, deterministically.
+            categorizer_reads[risk_factor] = getattr(f, '_reads', None) or Patient.ATTRIBUTES
+            cache_key_getters[risk_factor] = (attrgetter(*categorizer_reads[risk_factor])
+                                              if getattr(f, '_deterministic', True) else None)
+
+        cls._rules = rules
+        cls._threshold_rules = {risk_factor: rule for risk_factor, rule in rules.items() if isinstance(rule, ThresholdRule)}
+        cls._categorizer_reads = categorizer_reads
+        cls._cache_key_getters = cache_key_getters
+        cls._categorizer_functions = categorizer_functions
+        cls.risk_factor_order = tuple(cls._categorizer_dict)
+        cls._ordered_functions = tuple(categorizer_functions[risk_factor] for risk_factor in cls.risk_factor_order)
+
+
+    @classmethod
+    def _invalidate_tables(cls):
+        """
+        Discard the compiled tables, so that they are compiled again on next use. Call this after replacing
+        categorizer functions on cls, as profiling.Profiler does.
+        """
+        for name in cls._COMPILED_TABLES:
+            setattr(cls, name, _CompiledOnFirstUse(name))
+        if getattr(cls.__dict__.get('screen'), '_generated', False):
+            cls.screen = _CompiledOnFirstUse('screen')
 
 
     # This method is not needed by the implementation, but I add it for completeness.
@@ -44,12 +194,14 @@ class DiseaseStageBase:
         :param risk_factor: A risk factor, e.g. 'age', 'blood_pressure'
         :return: the bound method that should be used for categorization.
         """
-        return getattr(self, self._categorizer_dict[risk_factor])
+        return MethodType(self._categorizer_functions[risk_factor], self)
 
 
-    # This method is not needed by the implementation, but I add it for completeness.
     def categorize(self, risk_factor, patient):
-        return self.get_categorizer(risk_factor)(patient)
+        f = self._categorizer_functions[risk_factor]
+        if self._category_cache is None:
+            return f(self, patient)
+        return self._categorize_cached(risk_factor, f, patient)
 
 
     # This method is not needed by the implementation, but I add it for completeness.
@@ -62,10 +214,193 @@ class DiseaseStageBase:
     def categorizers(self):
         """
         Return an iterator over the installed (risk_factor, method_name) categorizers our class defines.
+        If caching is enabled, each method is wrapped so that it goes through the cache.
         :return:
         """
-        for risk_factor, method_name in self._categorizer_dict.items():
-            yield risk_factor, getattr(self, method_name)
+        for risk_factor, f in zip(self.risk_factor_order, self._ordered_functions):
+            if self._category_cache is None:
+                yield risk_factor, MethodType(f, self)
+            else:
+                yield risk_factor, partial(self._categorize_cached, risk_factor, f)
+
+
+    @classmethod
+    def attributes_read(cls, risk_factor):
+        """
+        Return the names of the Patient attributes that the categorizer for risk_factor reads.
+        """
+        return cls._categorizer_reads[risk_factor]
+
+
+    @classmethod
+    def enable_cache(cls, maxsize = 4096):
+        """
+        Cache the results of categorize() for cls and its subclasses in a new LRUCache of maxsize entries.
+        Entries are keyed on the class, the risk factor, and the values of the patient attributes that the
+        categorizer reads, so subclasses can safely share the cache. Categorizers declared with
+        deterministic = False are never cached.
+        :return: the cache, whose stats property reports hits, misses and evictions.
+        """
+        cls._category_cache = LRUCache(maxsize)
+        return cls._category_cache
+
+
+    @classmethod
+    def disable_cache(cls):
+        cls._category_cache = None
+
+
+    def _categorize_cached(self, risk_factor, f, patient):
+        """
+        Return the category that the categorizer function f assigns to patient for risk_factor, going through our cache.
+        """
+        get_key = self._cache_key_getters[risk_factor]
+        if get_key is None:
+            return f(self, patient)
+
+        key = (self.__class__, risk_factor, get_key(patient))
+        category = self._category_cache.get(key)
+        if category is MISSING:
+            category = f(self, patient)
+            self._category_cache.put(key, category)
+        return category
+
+
+    def screen(self, patient):
+        """
+        Return a tuple of the categories of patient, one per risk factor, ordered as risk_factor_order.
+        Every subclass gets its own compiled version of this method; see _compile_screen().
+        """
+        return ()
+
+
+    def screen_into(self, patients, out, offset = 0):
+        """
+        Screen each patient of patients, writing its categories, ordered as risk_factor_order, into out.
+        The categories of the i-th patient go to out[offset + i * len(risk_factor_order) + j].
+
+        Unlike screen(), this builds no tuple per patient, and it calls the categorizers as plain functions,
+        so it allocates nothing per categorizer call.
+        :param patients: an iterable of Patient objects.
+        :param out: a writable sequence of integers, e.g. a bytearray, an array.array, or a 1-D NumPy array,
+                    long enough to hold every category.
+        :return: the index in out just past the last category written.
+        """
+        functions = self._ordered_functions
+        i = offset
+        for patient in patients:
+            for f in functions:
+                out[i] = f(self, patient)
+                i += 1
+        return i
+
+
+    @classmethod
+    def _compile_screen(cls):
+        """
+        Generate the source code of a screen() method specialized to our categorizers, and compile it.
+
+        For example, a class with a threshold rule for 'age', a band rule for 'blood_pressure', and a hand-written
+        categorizer for 'mood' gets
+
+            def screen(self, patient):
+                return (1 if patient.age >= t0 else 0,
+                        bisect_right(c1, patient.systolic_blood_pressure),
+                        f2(self, patient),
+                        )
+
+        where t0, c1 and f2 are bound, via a closure, to the threshold, to the cutpoints, and to the plain function
+        that implements the categorizer. This is called once per class, the first time its screen() is looked up.
+        :return: the screen function, ready to be installed on cls.
+        """
+        free_variables = {'bisect_right': bisect_right}
+        items = []
+        for i, risk_factor in enumerate(cls.risk_factor_order):
+            rule = cls._rules.get(risk_factor)
+            if isinstance(rule, ThresholdRule):
+                free_variables['t{i}'.format(i = i)] = rule.threshold
+                items.append('1 if patient.{attribute} {comparator} t{i} else 0'.format(attribute = rule.attribute,
+                                                                                      comparator = rule.comparator, i = i))
+            elif isinstance(rule, BandRule):
+                free_variables['c{i}'.format(i = i)] = rule.cutpoints
+                items.append('bisect_right(c{i}, patient.{attribute})'.format(i = i, attribute = rule.attribute))
+            else:
+                free_variables['f{i}'.format(i = i)] = cls._categorizer_functions[risk_factor]
+                items.append('f{i}(self, patient)'.format(i = i))
+
+        source = ('def make_screen({free_variables}):\n'
+                  '    def screen(self, patient):\n'
+                  '        return ({items}\n'
+                  '                )\n'
+                  '    return screen\n').format(free_variables = ', '.join(free_variables),
+                                                 items = ''.join(item + ',\n                ' for item in items))
+        namespace = {}
+        exec(compile(source, '<{name}.screen>'.format(name = cls.__qualname__), 'exec'), namespace)
+        screen = namespace['make_screen'](**free_variables)
+        screen.__qualname__ = cls.__qualname__ + '.screen'
+        screen.__doc__ = DiseaseStageBase.screen.__doc__
+        screen._generated = True # So that _invalidate_tables() knows to discard it.
+        return screen
+
+
+    @classmethod
+    def threshold_rules(cls):
+        """
+        Return a dict mapping each risk factor whose categorizer is a threshold rule to that ThresholdRule.
+        Risk factors with band rules or hand-written categorizers are absent.
+        """
+        return dict(cls._threshold_rules)
+
+
+    @classmethod
+    def rules(cls):
+        """
+        Return a dict mapping each risk factor whose categorizer is a rule to that ThresholdRule or BandRule.
+        Risk factors with hand-written categorizers are absent.
+        """
+        return dict(cls._rules)
+
+
+    @classmethod
+    def rule_table(cls):
+        """
+        Return our rules in a serializable (e.g., JSON-ready) form: a dict mapping risk factor to
+        {'attribute': ..., 'comparator': ..., 'threshold': ...} for a threshold rule, or to
+        {'attribute': ..., 'cutpoints': [...]} for a band rule.
+        """
+        return {risk_factor: rule.to_dict() for risk_factor, rule in cls._rules.items()}
+
+
+    def categorize_batch(self, batch):
+        """
+        Categorize every patient in batch for each of our risk factors.
+
+        Threshold and band rules are evaluated directly on the column they test. Other vectorized categorizers
+        are called once, with the whole batch standing in for a single patient. Any other categorizer
+        is called once per patient, which is correct but slow.
+        :param batch: a PatientBatch
+        :return: a dict mapping each risk factor to an array holding one category per patient in batch.
+        """
+        categories = {}
+        for risk_factor, f in zip(self.risk_factor_order, self._ordered_functions):
+            rule = self._rules.get(risk_factor)
+            if rule is not None:
+                categories[risk_factor] = rule.categorize_column(getattr(batch, rule.attribute))
+            else:
+                categories[risk_factor] = self._categorize_column(f, batch)
+        return categories
+
+
+    def _categorize_column(self, f, batch):
+        """
+        Return an array of the categories that the categorizer function f assigns to the patients of batch.
+        """
+        if not getattr(f, '_vectorized', False):
+            return np.fromiter((f(self, patient) for patient in batch), dtype = CATEGORY_DTYPE, count = len(batch))
+
+        categories = np.empty(len(batch), dtype = CATEGORY_DTYPE)
+        categories[:] = f(self, batch) # Broadcasts, in case the categorizer returned a constant.
+        return categories
 
 
     @classmethod
@@ -76,11 +411,11 @@ class DiseaseStageBase:
         This is called as part of the class initialization process. This method finds the categorizers that
         have been defined, prior to their being installed on our _categorizer_dict.
         """
-        # Loop through all our attributes, checking for those that are categorizer methods.
-        # If we find a categorizer, yield its (risk_factor, method_name) pair.
-        for attribute_name in dir(cls):
-            f = getattr(cls, attribute_name) # Note that this might not be a function. It could be a plain value if
-                                             # attribute_name is not the name of a method.
+        # Loop through the attributes defined in the body of cls, checking for those that are categorizer methods.
+        # If we find a categorizer, yield its (risk_factor, method_name) pair. Inherited categorizers need not be
+        # looked at, since they are already in the _categorizer_dict that we inherit from our parent.
+        for attribute_name, f in cls.__dict__.items(): # Note that f might not be a function. It could be a plain value if
+                                                       # attribute_name is not the name of a method.
             if cls._is_categorizer(f):
                 yield cls._get_risk_factor_for_categorizer(f), attribute_name
 
@@ -89,22 +424,40 @@ class DiseaseStageBase:
     def _is_categorizer(f):
         return callable(f) and hasattr(f, '_risk_factor')
 
+    @staticmethod
+    def _is_rule_categorizer(f):
+        return callable(f) and hasattr(f, '_rule')
+
+    @staticmethod
+    def _is_threshold_categorizer(f):
+        return callable(f) and isinstance(getattr(f, '_rule', None), ThresholdRule)
+
     @staticmethod
     def _get_risk_factor_for_categorizer(f):
         return f._risk_factor
 
     @staticmethod
-    def set_risk_factor_for_categorizer(f, risk_factor):
+    def set_risk_factor_for_categorizer(f, risk_factor, vectorized = False, reads = None, deterministic = True):
         f._risk_factor = risk_factor
+        f._vectorized = vectorized
+        f._reads = tuple(reads) if reads is not None else None
+        f._deterministic = deterministic
 
 
 # =============================================================================
 #                     Decorator
 # =============================================================================
-def categorizer(risk_factor):
+def categorizer(risk_factor, vectorized = False, reads = None, deterministic = True):
     """
     This is a decorator generator.
     :param risk_factor: The risk factor for which the method we are decorating is being defined.
+    :param vectorized: True if the method uses only elementwise operations on the patient's attributes,
+                       so that it also works when handed a PatientBatch instead of a Patient. For example,
+                       (patient.age >= 50) * 1 is vectorized, but 0 if patient.age < 50 else 1 is not.
+    :param reads: The names of the Patient attributes that the method reads, e.g. ['age', 'cholesterol'].
+                  Cached results are keyed on just these. If None, the method is assumed to read all of them.
+    :param deterministic: False if the method can return different categories for the same attribute values,
+                          in which case its results are never cached.
     :return: a dynamically generated decorator
     """
     def decorator(f):
@@ -115,56 +468,274 @@ def categorizer(risk_factor):
         :param f: a function (not a bound method, since this is being evaluated at class-definition time)
         :return: f, with the risk factor added to it as an attribute.
         """
-        DiseaseStageBase.set_risk_factor_for_categorizer(f, risk_factor)
+        DiseaseStageBase.set_risk_factor_for_categorizer(f, risk_factor, vectorized, reads, deterministic)
         return f
 
     return decorator
 
+
+def threshold_categorizer(risk_factor, attr, cut, comparator = '>='):
+    """
+    Return a categorizer method for risk_factor that puts a patient in category 1 if
+    <patient.attr> <comparator> <cut>, and in category 0 otherwise. Assign the result to a name
+    in the body of a disease-stage class, e.g.,
+
+        _categorize_bp = threshold_categorizer('blood_pressure', attr = 'systolic_blood_pressure', cut = 120)
+
+    which is equivalent to the hand-written
+
+        @categorizer('blood_pressure')
+        def _categorize_bp(self, patient):
+            return 0 if patient.systolic_blood_pressure < 120 else 1
+
+    except that the comparison is also recorded as a ThresholdRule, so that the class can evaluate it in bulk.
+    :param risk_factor: The risk factor that the categorizer categorizes.
+    :param attr: The name of the Patient attribute to test, e.g. 'systolic_blood_pressure'
+    :param cut: The threshold.
+    :param comparator: One of '>=', '>', '<=', '<'. The comparison that puts a patient in category 1.
+    :return: a categorizer method.
+    """
+    rule = ThresholdRule(attr, comparator, cut)
+    compare = COMPARATORS[comparator]
+    get_value = attrgetter(attr)
+
+    def f(self, patient):
+        return compare(get_value(patient), cut) * 1
+
+    f.__name__ = '_categorize_' + risk_factor
+    f.__doc__ = "Category 1 if patient.{attr} {comparator} {cut}, else 0.".format(attr = attr, comparator = comparator, cut = cut)
+    f._rule = rule
+    return categorizer(risk_factor, vectorized = True, reads = [attr])(f)
+
+
+def banded_categorizer(risk_factor, attr, cutpoints):
+    """
+    Return a categorizer method for risk_factor that puts a patient in category k if <patient.attr> is at or
+    above k of the cutpoints. Assign the result to a name in the body of a disease-stage class, e.g.,
+
+        _categorize_bp = banded_categorizer('blood_pressure', attr = 'systolic_blood_pressure', cutpoints = [120, 130, 140])
+
+    which is equivalent to the hand-written
+
+        @categorizer('blood_pressure')
+        def _categorize_bp(self, patient):
+            bp = patient.systolic_blood_pressure
+            return 0 if bp < 120 else 1 if bp < 130 else 2 if bp < 140 else 3
+
+    except that the band is found by binary search, and the cutpoints are recorded as a BandRule, so that
+    the class can evaluate it in bulk.
+    :param risk_factor: The risk factor that the categorizer categorizes.
+    :param attr: The name of the Patient attribute to test, e.g. 'systolic_blood_pressure'
+    :param cutpoints: The strictly increasing values at which each band after the first begins.
+    :return: a categorizer method.
+    """
+    rule = BandRule(attr, cutpoints)
+    cutpoints = rule.cutpoints
+    get_value = attrgetter(attr)
+
+    def f(self, patient):
+        return bisect_right(cutpoints, get_value(patient))
+
+    f.__name__ = '_categorize_' + risk_factor
+    f.__doc__ = "Category k if patient.{attr} is at or above k of {cutpoints}.".format(attr = attr, cutpoints = list(cutpoints))
+    f._rule = rule
+    return categorizer(risk_factor, reads = [attr])(f) # Not vectorized: bisect works on one value at a time.
+
 # =============================================================================
 #                     Stroke Stage A
 # =============================================================================
 class StrokeStageA(DiseaseStageBase):
-    @categorizer('age')
-    def _categorize_age(self, patient):
-        return 0 if patient.age < 50 else 1
-
-    @categorizer('blood_pressure')
-    def _cat_blood_pressure(self, patient):
-        return 0 if patient.systolic_blood_pressure < 120 else 1
-
-    @categorizer('cholesterol')
-    def _ctg_cholesterol(self, patient):
-        return 0 if patient.cholesterol < 200 else 1
+    __slots__ = ()
+    _categorize_age = threshold_categorizer('age', attr = 'age', cut = 50)
+    _cat_blood_pressure = threshold_categorizer('blood_pressure', attr = 'systolic_blood_pressure', cut = 120)
+    _ctg_cholesterol = threshold_categorizer('cholesterol', attr = 'cholesterol', cut = 200)
 
 
 class IschemicStrokeStageA(StrokeStageA):
-    @categorizer('blood_viscosity')
-    def _cat_blood_viscosity(self, patient):
-        return 0 if patient.blood_viscosity < 2.7 else 1
+    __slots__ = ()
+    _cat_blood_viscosity = threshold_categorizer('blood_viscosity', attr = 'blood_viscosity', cut = 2.7)
 
 
 class HemorrhagicStrokeStageA(StrokeStageA):
-    @categorizer('blood_pressure')
-    def _ctg_blood_pressure(self, patient):
-        return 0 if patient.systolic_blood_pressure < 170 else 1
+    __slots__ = ()
+    _ctg_blood_pressure = threshold_categorizer('blood_pressure', attr = 'systolic_blood_pressure', cut = 170)
 
 # =============================================================================
 #                     Diabetes Stage A
 # =============================================================================
 class DiabetesStageA(DiseaseStageBase):
-    @categorizer('blood_sugar')
-    def _categorize_patient_blood_sugar(self, patient):
-        return 0 if patient.fasting_blood_sugar < 100 else 1
+    __slots__ = ()
+    _categorize_patient_blood_sugar = threshold_categorizer('blood_sugar', attr = 'fasting_blood_sugar', cut = 100)
+    _categorize_bp = threshold_categorizer('blood_pressure', attr = 'systolic_blood_pressure', cut = 150)
 
-    @categorizer('blood_pressure')
-    def _categorize_bp(self, patient):
-        return 0 if patient.systolic_blood_pressure < 150 else 1
+
+# =============================================================================
+#                     Hypertension Stage A
+# =============================================================================
+class HypertensionStageA(DiseaseStageBase):
+    __slots__ = ()
+    # Normal, elevated, stage 1, stage 2, crisis.
+    _categorize_bp = banded_categorizer('blood_pressure', attr = 'systolic_blood_pressure', cutpoints = [120, 130, 140, 180])
 
 
 # =============================================================================
 #                     Test
 # =============================================================================
+def _count_allocations(screen, disease_stage, patients, out):
+    """
+    Run screen(disease_stage, patients, out), and return the number of its bytecode steps after which more memory
+    blocks were allocated than before. Objects made and dropped within a call are freed at once, so they never show
+    in the memory in use, nor much in its peak; but each of them raises the count of blocks for at least one step.
+    """
+    import sys
+    code = screen.__code__
+    last_blocks = sys.getallocatedblocks()
+    allocations = 0
+
+    def trace_opcodes(frame, event, arg):
+        nonlocal last_blocks, allocations
+        if event == 'opcode':
+            blocks = sys.getallocatedblocks()
+            if blocks > last_blocks:
+                allocations += 1
+            last_blocks = blocks
+        return trace_opcodes
+
+    def trace_calls(frame, event, arg):
+        if frame.f_code is not code:
+            return None
+        frame.f_trace_opcodes = True
+        return trace_opcodes
+
+    sys.settrace(trace_calls)
+    try:
+        screen(disease_stage, patients, out)
+    finally:
+        sys.settrace(None)
+    return allocations
+
+
+def test_allocations(disease_stages, n = 10000, n_traced = 1000):
+    """
+    Check that screen_into() allocates nothing per categorizer call: it must allocate no more often than a bare loop
+    that calls the same functions, and, as tracemalloc snapshots show, keep no new memory blocks once it is done.
+    """
+    import tracemalloc
+    from array import array
+    from sandbox.josh_sandbox.disease_testing.batch import random_batch
+
+    def bare_loop(disease_stage, patients, out, offset = 0):
+        functions = disease_stage._ordered_functions
+        i = offset
+        for patient in patients:
+            for f in functions:
+                out[i] = f(disease_stage, patient)
+                i += 1
+        return i
+
+    patients = list(random_batch(n))
+    buffers = [array('B', bytes(n * len(disease_stage.risk_factor_order))) for disease_stage in disease_stages]
+    for disease_stage, out in zip(disease_stages, buffers):
+        disease_stage.screen_into(patients[:10], out) # Warm up: compile the class tables before measuring.
+
+    allocations = {screen.__name__: sum(_count_allocations(screen, disease_stage, patients[:n_traced], out)
+                                        for disease_stage, out in zip(disease_stages, buffers))
+                   for screen in [bare_loop, DiseaseStageBase.screen_into]}
+    traced_calls = n_traced * sum(len(disease_stage.risk_factor_order) for disease_stage in disease_stages)
+    assert allocations['screen_into'] <= allocations['bare_loop'] + traced_calls // 100, \
+        "screen_into() allocates per call: {allocations} in {calls} calls".format(allocations = allocations,
+                                                                                  calls = traced_calls)
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for disease_stage, out in zip(disease_stages, buffers):
+        disease_stage.screen_into(patients, out)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    calls = n * sum(len(disease_stage.risk_factor_order) for disease_stage in disease_stages)
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'lineno'))
+    assert blocks < 100, "Screening {calls} calls kept {blocks} new memory blocks".format(calls = calls, blocks = blocks)
+    assert all(disease_stage is disease_stage.__class__() for disease_stage in disease_stages)
+    print("Screened {calls} categorizer calls; {allocations} allocating steps in {traced} traced calls, "
+          "as for a bare loop".format(calls = calls, allocations = allocations['screen_into'], traced = traced_calls))
+
+
+def test_bands(n = 100_000, n_bands = 16):
+    """
+    Check that a banded categorizer agrees with the equivalent chain of ifs, per patient and per batch,
+    and compare their speed.
+    """
+    import time
+    from sandbox.josh_sandbox.disease_testing.batch import random_batch
+
+    cutpoints = list(range(95, 95 + 5 * (n_bands - 1), 5))
+    chain = ' else '.join('{k} if patient.systolic_blood_pressure < {cut}'.format(k = k, cut = cut)
+                          for k, cut in enumerate(cutpoints)) + ' else {k}'.format(k = len(cutpoints))
+    namespace = {}
+    exec('def _categorize_bp(self, patient):\n    return {chain}\n'.format(chain = chain), namespace)
+
+    class ChainedStage(DiseaseStageBase):
+        __slots__ = ()
+        _categorize_bp = categorizer('blood_pressure')(namespace['_categorize_bp'])
+
+    class BandedStage(DiseaseStageBase):
+        __slots__ = ()
+        _categorize_bp = banded_categorizer('blood_pressure', attr = 'systolic_blood_pressure', cutpoints = cutpoints)
+
+    batch = random_batch(n)
+    patients = list(batch)
+    timings = {}
+    for cls in [ChainedStage, BandedStage]:
+        disease_stage = cls()
+        start = time.perf_counter()
+        results = [disease_stage.screen(patient) for patient in patients]
+        timings[cls.__name__] = time.perf_counter() - start
+        assert [categories for categories, in results] == BandedStage().categorize_batch(batch)['blood_pressure'].tolist()
+    print("{n} patients, {bands} bands: chained ifs {chained:.3f}s, bisect {banded:.3f}s".format(
+        n = n, bands = n_bands, chained = timings['ChainedStage'], banded = timings['BandedStage']))
+
+
+def test_plain_override():
+    """
+    Check that a subclass can override a categorizer by name with a plain method, as it could before the
+    categorizer tables were compiled.
+    """
+    class OlderStrokeStageA(StrokeStageA):
+        __slots__ = ()
+
+        def _categorize_age(self, patient):
+            return 1 if patient.age >= 65 else 0
+
+    patient = Patient(age = 70, systolic_blood_pressure = 110, cholesterol = 210, blood_viscosity = 2.0,
+                      fasting_blood_sugar = 90)
+    assert OlderStrokeStageA().categorize('age', patient) == 1
+    assert OlderStrokeStageA().screen(patient) == (1, 0, 1)
+    assert OlderStrokeStageA.attributes_read('age') == Patient.ATTRIBUTES
+    from sandbox.josh_sandbox.disease_testing.batch import PatientBatch
+    assert OlderStrokeStageA().categorize_batch(PatientBatch.from_patients([patient]))['age'].tolist() == [1]
+
+
+def test_lazy_screen():
+    """
+    Check that compiling the tables does not compile screen(), and that invalidating them discards a compiled screen().
+    """
+    class LazyStrokeStageA(StrokeStageA):
+        __slots__ = ()
+
+    patient = Patient(age = 70, systolic_blood_pressure = 110, cholesterol = 210, blood_viscosity = 2.0,
+                      fasting_blood_sugar = 90)
+    LazyStrokeStageA().categorize('age', patient)
+    assert isinstance(LazyStrokeStageA.__dict__['screen'], _CompiledOnFirstUse)
+    assert LazyStrokeStageA().screen(patient) == (1, 0, 1)
+    assert getattr(LazyStrokeStageA.__dict__['screen'], '_generated', False)
+    LazyStrokeStageA._invalidate_tables()
+    assert isinstance(LazyStrokeStageA.__dict__['screen'], _CompiledOnFirstUse)
+    assert LazyStrokeStageA().screen(patient) == (1, 0, 1)
 
 
 if __name__ == '__main__':
-    test([StrokeStageA(), IschemicStrokeStageA(), HemorrhagicStrokeStageA(), DiabetesStageA()])
\ No newline at end of file
+    test([StrokeStageA(), IschemicStrokeStageA(), HemorrhagicStrokeStageA(), DiabetesStageA(), HypertensionStageA()])
+    test_allocations([StrokeStageA(), IschemicStrokeStageA(), HemorrhagicStrokeStageA(), DiabetesStageA(), HypertensionStageA()])
+    test_bands()
+    test_plain_override()
+    test_lazy_screen()
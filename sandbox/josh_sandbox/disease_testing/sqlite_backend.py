@@ -0,0 +1,272 @@
+"""
+This file defines SQLiteScreener, which screens patients stored in a SQLite table without loading every
+row into Python.
+
+Threshold and band categorizers are pure data (see rules.ThresholdRule and rules.BandRule), so they can be
+translated into SQL:
+
+    CASE WHEN "systolic_blood_pressure" >= 120 THEN 1 ELSE 0 END
+    CASE WHEN "systolic_blood_pressure" >= 140 THEN 2 WHEN "systolic_blood_pressure" >= 130 THEN 1 ELSE 0 END
+
+Every rule categorizer of every stage being screened becomes one such column of a single SELECT, so SQLite
+evaluates whole stages, or many stages, in one scan of the patients table. Categorizers that are not rules
+cannot be translated, nor can rules with an infinite or NaN threshold or cutpoint, which SQL has no literal for;
+the SELECT fetches the attributes they read as well, and they are evaluated in Python, one batch of fetched rows
+at a time, with categorize_batch() semantics. Either way, rows are streamed from the cursor in batches, so memory
+use does not depend on the size of the table.
+
+Results are written to a results table, one row per (patient, stage, risk factor), with executemany(), one
+transaction per batch. The database is put in WAL mode, so readers are not blocked while results are written.
+
+    screener = SQLiteScreener('patients.db')
+    screener.screen([StrokeStageA, DiabetesStageA])
+    screener.results(patient_id = 17)
+
+The patients table has a patient_id column and one column per name in Patient.ATTRIBUTES; create_patients_table()
+creates it, and insert_patients() fills it.
+"""
+import math
+import sqlite3
+import time
+
+import numpy as np
+
+from sandbox.josh_sandbox.disease_testing.batch import PatientBatch
+from sandbox.josh_sandbox.disease_testing.common import Patient
+from sandbox.josh_sandbox.disease_testing.rules import COMPARATORS, BandRule
+
+DEFAULT_BATCH_SIZE = 10000
+
+
+def quote_identifier(name):
+    return '"{name}"'.format(name = name.replace('"', '""'))
+
+
+def rule_to_sql(rule):
+    """
+    Return the SQL expression that computes the category of rule, a ThresholdRule or BandRule, for a row of the
+    patients table.
+    :raise ValueError: if a threshold or cutpoint of rule is infinite or NaN, which have no SQL literal.
+    """
+    values = rule.cutpoints if isinstance(rule, BandRule) else [rule.threshold]
+    if not all(math.isfinite(value) for value in values):
+        raise ValueError("{rule} cannot be translated to SQL: its values must be finite.".format(rule = rule))
+    if isinstance(rule, BandRule):
+        return 'CASE {whens} ELSE 0 END'.format(whens = ' '.join(
+            'WHEN {column} >= {cut!r} THEN {category}'.format(column = quote_identifier(rule.attribute), cut = float(cut),
+                                                              category = category)
+            for category, cut in reversed(list(enumerate(rule.cutpoints, start = 1)))))
+    if rule.comparator not in COMPARATORS:
+        raise ValueError("Unknown comparator: {comparator}".format(comparator = rule.comparator))
+    return 'CASE WHEN {column} {comparator} {threshold!r} THEN 1 ELSE 0 END'.format(
+        column = quote_identifier(rule.attribute), comparator = rule.comparator, threshold = float(rule.threshold))
+
+
+class SQLiteScreener:
+    def __init__(self, database, patients_table = 'patients', results_table = 'screening_results'):
+        """
+        :param database: the path of a SQLite database, or an open sqlite3.Connection.
+        """
+        self.connection = database if isinstance(database, sqlite3.Connection) else sqlite3.connect(database)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL') # Safe in WAL mode, and much faster than FULL.
+        self.patients_table = patients_table
+        self.results_table = results_table
+
+    def close(self):
+        self.connection.close()
+
+    # =============================================================================
+    #                     Patients
+    # =============================================================================
+    def create_patients_table(self):
+        columns = ', '.join('{name} REAL NOT NULL'.format(name = quote_identifier(name)) for name in Patient.ATTRIBUTES)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS {table} (patient_id INTEGER PRIMARY KEY, {columns})'.format(
+                table = quote_identifier(self.patients_table), columns = columns))
+
+    def insert_patients(self, patients, patient_ids = None):
+        """
+        Insert patients, an iterable of Patients, or a PatientBatch.
+        :param patient_ids: one id per patient; by default SQLite assigns them.
+        """
+        if isinstance(patients, PatientBatch):
+            rows = zip(*[getattr(patients, name).tolist() for name in Patient.ATTRIBUTES])
+        else:
+            rows = ([getattr(patient, name) for name in Patient.ATTRIBUTES] for patient in patients)
+        if patient_ids is not None:
+            rows = ((patient_id, *row) for patient_id, row in zip(patient_ids, rows))
+        columns = ('patient_id',) * (patient_ids is not None) + Patient.ATTRIBUTES
+        with self.connection:
+            self.connection.executemany('INSERT INTO {table} ({columns}) VALUES ({placeholders})'.format(
+                table = quote_identifier(self.patients_table),
+                columns = ', '.join(quote_identifier(column) for column in columns),
+                placeholders = ', '.join('?' * len(columns))), rows)
+
+    # =============================================================================
+    #                     Screening
+    # =============================================================================
+    def create_results_table(self):
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS {table} ('
+                                    'patient_id INTEGER NOT NULL, stage TEXT NOT NULL, risk_factor TEXT NOT NULL, '
+                                    'category INTEGER NOT NULL, '
+                                    'PRIMARY KEY (patient_id, stage, risk_factor)) WITHOUT ROWID'.format(
+                                        table = quote_identifier(self.results_table)))
+
+    def plan(self, disease_stage_classes):
+        """
+        Work out how to screen against disease_stage_classes.
+        :return: a (query, outputs, fallback_attributes) triple. query is the SELECT to run. outputs lists a
+                 (stage_name, risk_factor, disease_stage or None) triple for each risk factor screened, in result-column
+                 order; disease_stage is None if the category is computed by query, and otherwise is the instance
+                 whose categorizer must be called in Python. fallback_attributes are the patient attributes that
+                 query also selects, for those categorizers.
+        """
+        expressions = []
+        outputs = []
+        fallback_attributes = []
+        for cls in disease_stage_classes:
+            disease_stage = cls()
+            rules = cls.rules()
+            for risk_factor in cls.risk_factor_order:
+                rule = rules.get(risk_factor)
+                expression = None
+                if rule is not None:
+                    try:
+                        expression = rule_to_sql(rule)
+                    except ValueError: # E.g. an infinite threshold; evaluate the rule in Python instead.
+                        pass
+                if expression is not None:
+                    expressions.append(expression)
+                    outputs.append((cls.__name__, risk_factor, None))
+                else:
+                    outputs.append((cls.__name__, risk_factor, disease_stage))
+                    fallback_attributes.extend(name for name in cls.attributes_read(risk_factor)
+                                               if name not in fallback_attributes)
+        query = 'SELECT {columns} FROM {table} ORDER BY patient_id'.format(
+            columns = ', '.join(['patient_id'] + expressions + [quote_identifier(name) for name in fallback_attributes]),
+            table = quote_identifier(self.patients_table))
+        return query, outputs, fallback_attributes
+
+    def screen(self, disease_stage_classes, batch_size = DEFAULT_BATCH_SIZE):
+        """
+        Screen every patient in the patients table against disease_stage_classes, and write the results to the
+        results table, replacing any earlier results for the same patient, stage and risk factor.
+        :return: the number of patients screened.
+        """
+        self.create_results_table()
+        query, outputs, fallback_attributes = self.plan(disease_stage_classes)
+        n_sql = sum(disease_stage is None for _, _, disease_stage in outputs)
+        insert = 'INSERT OR REPLACE INTO {table} (patient_id, stage, risk_factor, category) VALUES (?, ?, ?, ?)'.format(
+            table = quote_identifier(self.results_table))
+
+        # Read through a second connection, so that writing results does not disturb the cursor.
+        reader = sqlite3.connect(self._database_path()) if self._database_path() else self.connection
+        try:
+            cursor = reader.execute(query)
+            screened = 0
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                patient_ids = [row[0] for row in rows]
+                columns = list(zip(*rows))
+                sql_categories = iter(columns[1:1 + n_sql])
+                fallback_batch = None
+                if fallback_attributes:
+                    fallback_values = dict(zip(fallback_attributes, columns[1 + n_sql:]))
+                    fallback_batch = PatientBatch(**{name: fallback_values.get(name, np.zeros(len(rows)))
+                                                     for name in Patient.ATTRIBUTES})
+
+                category_columns = {}
+                for stage_name, risk_factor, disease_stage in outputs:
+                    if disease_stage is None:
+                        categories = next(sql_categories)
+                    else:
+                        f = disease_stage._categorizer_functions[risk_factor]
+                        categories = disease_stage._categorize_column(f, fallback_batch).tolist()
+                    category_columns[(stage_name, risk_factor)] = categories
+
+                # Write in primary-key order, so that SQLite appends to the results table's B-tree instead of
+                # inserting all over it.
+                keys = sorted(category_columns)
+                with self.connection:
+                    self.connection.executemany(insert, ((patient_id, stage_name, risk_factor, category)
+                                                         for patient_id, categories in
+                                                         zip(patient_ids, zip(*[category_columns[key] for key in keys]))
+                                                         for (stage_name, risk_factor), category in zip(keys, categories)))
+                screened += len(rows)
+        finally:
+            if reader is not self.connection:
+                reader.close()
+        return screened
+
+    def _database_path(self):
+        """
+        Return the file of our main database, or None if it is in memory.
+        """
+        path = self.connection.execute('PRAGMA database_list').fetchone()[2]
+        return path or None
+
+    def results(self, patient_id):
+        """
+        Return a dict mapping (stage_name, risk_factor) to the category stored for patient_id.
+        """
+        cursor = self.connection.execute('SELECT stage, risk_factor, category FROM {table} WHERE patient_id = ?'.format(
+            table = quote_identifier(self.results_table)), (patient_id,))
+        return {(stage, risk_factor): category for stage, risk_factor, category in cursor}
+
+
+# =============================================================================
+#                     Test
+# =============================================================================
+def test(disease_stage_classes, n = 100_000):
+    import os
+    import tempfile
+    from sandbox.josh_sandbox.disease_testing.batch import random_batch
+    from sandbox.josh_sandbox.disease_testing.solution5 import categorizer, threshold_categorizer
+
+    # A stage with a categorizer that cannot be translated to SQL, to exercise the Python fallback.
+    class ViscousHypertensionStage(disease_stage_classes[0]):
+        __slots__ = ()
+
+        @categorizer('viscous_hypertension', reads = ['systolic_blood_pressure', 'blood_viscosity'])
+        def _categorize_viscous_hypertension(self, patient):
+            return 1 if patient.systolic_blood_pressure * patient.blood_viscosity > 400 else 0
+
+        # A rule with no SQL literal for its threshold, which must fall back to Python too.
+        _categorize_never = threshold_categorizer('never', attr = 'age', cut = float('inf'))
+
+    classes = list(disease_stage_classes) + [ViscousHypertensionStage]
+    with tempfile.TemporaryDirectory() as directory:
+        _test_database(os.path.join(directory, 'patients_test.db'), classes, n)
+
+
+def _test_database(path, classes, n):
+    from sandbox.josh_sandbox.disease_testing.batch import random_batch
+
+    batch = random_batch(n)
+    screener = SQLiteScreener(path)
+    screener.create_patients_table()
+    screener.insert_patients(batch, patient_ids = range(1, n + 1))
+    query, outputs, fallback_attributes = screener.plan(classes)
+    print("{sql} of {total} categorizers pushed down to SQL; fallback reads {attributes}".format(
+        sql = sum(stage is None for _, _, stage in outputs), total = len(outputs), attributes = fallback_attributes))
+
+    start = time.perf_counter()
+    screened = screener.screen(classes)
+    print("Screened {n} patients in SQLite in {s:.2f}s".format(n = screened, s = time.perf_counter() - start))
+    assert screened == n
+
+    for i in [0, n // 2, n - 1]:
+        stored = screener.results(i + 1)
+        for cls in classes:
+            expected = cls().screen(batch[i])
+            assert tuple(stored[(cls.__name__, risk_factor)] for risk_factor in cls.risk_factor_order) == expected
+    screener.close()
+
+
+if __name__ == '__main__':
+    from sandbox.josh_sandbox.disease_testing.solution5 import StrokeStageA, IschemicStrokeStageA, HemorrhagicStrokeStageA, DiabetesStageA
+    test([StrokeStageA, IschemicStrokeStageA, HemorrhagicStrokeStageA, DiabetesStageA])
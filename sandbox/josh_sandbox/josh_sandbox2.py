@@ -19,16 +19,54 @@
 #  grams: 82.00
 #  calories: 50.84
 #  >
+#
+# Update: eval() turned out to be slow when loading tens of thousands of recipes, and it only finds
+# classes visible in this module's globals. Every Ingredient subclass now registers itself by class name
+# when it is defined (see Ingredient.__init_subclass__), and Recipe.make looks names up in that registry.
+# read_recipes() loads recipes in bulk from JSON or CSV files.
+#
+# Update: Recipe used to re-sum every ingredient amount each time calories or grams was read. An IngredientAmount
+# now notifies the recipes that own it when its grams or ingredient change, and each Recipe keeps running totals,
+# updated by the change, so reads and single-amount edits take constant time however many ingredients it has.
+# An amount holds only weak references to its recipes, so it does not keep alive recipes that are otherwise gone.
+# Those references are not copied or pickled: a copied or unpickled amount belongs to no recipe until one takes it,
+# and a copied or unpickled recipe registers itself with its amounts.
+#
+# Update: IngredientAmount and Recipe use __slots__, so they carry no per-instance __dict__. For catalogs that are
+# loaded and then only read, FrozenIngredientAmount is an immutable variant whose instances are interned: every
+# recipe that uses 12 grams of Sugar shares one object. NutritionCatalog (nutrition.py) is the array-backed form.
+import csv
+import json
+import os
+import time
+import weakref
+
 
 class Ingredient:
     NAME = ''
     DENSITY = 0.0
     CALORIES = 0.0
 
+    _registry = {}  # Maps the class name of every Ingredient subclass, e.g. 'Lemon', to the class.
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        Ingredient._registry[cls.__name__] = cls  # A later class of the same name replaces the earlier one.
+
     @classmethod
     def calories_per_cm3(cls):
         return cls.CALORIES * cls.DENSITY
 
+    @staticmethod
+    def lookup(name):
+        """
+        Return the Ingredient subclass whose class name is name, e.g. 'Lemon' -> Lemon.
+        """
+        try:
+            return Ingredient._registry[name]
+        except KeyError:
+            raise ValueError("Unknown ingredient: {name}".format(name = name)) from None
+
 
 class Sugar(Ingredient):
     NAME = 'sugar'
@@ -49,13 +87,15 @@ class Water(Ingredient):
 
 
 class IngredientAmount:
-    def __init__(self, ingredient, grams):
-        self._grams = 1.0  # throw-away value. Will be reset below.
-        self._ingredient = Sugar  # throw-away value. Will be reset below.
-        self._calories = None
+    __slots__ = ('_grams', '_ingredient', '_calories', '_owners')
 
-        self.grams = grams
-        self.ingredient = ingredient
+    def __init__(self, ingredient, grams):
+        assert grams > 0, "Grams must be positive."
+        assert issubclass(ingredient, Ingredient)
+        self._grams = grams
+        self._ingredient = ingredient
+        self._calories = self._calc_calories()
+        self._owners = []  # Weak references to the recipes that hold this amount, once per time they hold it.
 
     @property
     def grams(self):
@@ -64,8 +104,7 @@ class IngredientAmount:
     @grams.setter
     def grams(self, v):
         assert v > 0, "Grams must be positive."
-        self._grams = v
-        self._calories = self._calc_calories()
+        self._change(v, self._ingredient)
 
     @property
     def ingredient(self):
@@ -74,24 +113,164 @@ class IngredientAmount:
     @ingredient.setter
     def ingredient(self, v):
         assert issubclass(v, Ingredient)
-        self._ingredient = v
+        self._change(self._grams, v)
+
+    def _change(self, grams, ingredient):
+        """
+        Set our grams and ingredient, and tell our owners how much our grams and calories changed by.
+        """
+        old_grams, old_calories = self._grams, self._calories
+        self._grams = grams
+        self._ingredient = ingredient
         self._calories = self._calc_calories()
+        if self._owners:
+            delta_grams, delta_calories = grams - old_grams, self._calories - old_calories
+            recipes = [owner() for owner in self._owners]
+            for recipe in recipes:
+                if recipe is not None:
+                    recipe._amount_changed(delta_grams, delta_calories)
+            if None in recipes:
+                self._owners = [owner for owner, recipe in zip(self._owners, recipes) if recipe is not None]
 
     @property
     def calories(self):
         return self._calories
 
+    @property
+    def volume(self):
+        """
+        The volume of the ingredient amount, in cm^3.
+        """
+        return self.grams / self.ingredient.DENSITY
+
     def _calc_calories(self):
         return self.grams * self.ingredient.CALORIES
 
+    def _add_owner(self, recipe):
+        self._owners.append(weakref.ref(recipe))
+
+    def _remove_owner(self, recipe):
+        for i, owner in enumerate(self._owners):
+            if owner() is recipe:
+                del self._owners[i]
+                return
+
+    def __getstate__(self):
+        return self._grams, self._ingredient  # Not our owners, which are the original's, not the copy's.
+
+    def __setstate__(self, state):
+        self._grams, self._ingredient = state
+        self._calories = self._calc_calories()
+        self._owners = []
+
+    def __copy__(self):
+        return type(self)(self._ingredient, self._grams)
+
+    def __deepcopy__(self, memo):
+        return self.__copy__()  # Our ingredient is a class, which deepcopy() would not copy anyway.
+
     def __repr__(self):
         return "<{grams} grams of {ingredient}>".format(grams = self.grams, ingredient = self.ingredient.NAME)
 
 
+class FrozenIngredientAmount:
+    """
+    An immutable ingredient amount, with the same read-only interface as IngredientAmount. Create them with
+    intern(), which returns the same object for equal (ingredient, grams) pairs. Since they never change, they
+    keep no list of owning recipes; to edit a recipe, replace its frozen amount with another.
+    """
+    __slots__ = ('_grams', '_ingredient', '_calories')
+
+    _interned = {}  # Maps (ingredient, grams) to the FrozenIngredientAmount for it.
+
+    def __init__(self, ingredient, grams):
+        assert grams > 0, "Grams must be positive."
+        assert issubclass(ingredient, Ingredient)
+        object.__setattr__(self, '_grams', grams)
+        object.__setattr__(self, '_ingredient', ingredient)
+        object.__setattr__(self, '_calories', grams * ingredient.CALORIES)
+
+    @classmethod
+    def intern(cls, ingredient, grams):
+        key = (ingredient, grams)
+        amount = cls._interned.get(key)
+        if amount is None:
+            amount = cls._interned[key] = cls(ingredient, grams)
+        return amount
+
+    def __setattr__(self, name, value):
+        raise AttributeError("FrozenIngredientAmount is immutable.")
+
+    def __reduce__(self):
+        return FrozenIngredientAmount.intern, (self._ingredient, self._grams)  # So copies and unpickled ones are interned too.
+
+    grams = property(lambda self: self._grams)
+    ingredient = property(lambda self: self._ingredient)
+    calories = property(lambda self: self._calories)
+    volume = IngredientAmount.volume
+
+    def _add_owner(self, recipe):
+        pass
+
+    def _remove_owner(self, recipe):
+        pass
+
+    __repr__ = IngredientAmount.__repr__
+
+
 class Recipe:
+    __slots__ = ('_name', '_ingredient_amounts', '_grams', '_calories', '__weakref__')
+
     def __init__(self, name, ingredient_amounts):
         self._name = name
-        self._ingredient_amounts = ingredient_amounts
+        self._ingredient_amounts = list(ingredient_amounts)  # Our own list, so the caller cannot change it behind our back.
+        for amount in self._ingredient_amounts:
+            amount._add_owner(self)
+        self.recompute()
+
+    def __getstate__(self):
+        return self._name, self._ingredient_amounts
+
+    def __setstate__(self, state):
+        """
+        Used by pickle, copy.copy() and copy.deepcopy(). A shallow copy shares our amounts, and registers itself as
+        another owner of each; a deep copy or an unpickled recipe gets new amounts, which belong to it alone.
+        """
+        Recipe.__init__(self, *state)
+
+    def recompute(self):
+        """
+        Recompute our running totals of grams and calories from scratch. Each edit of an ingredient amount adds its
+        change to the totals, so after very many edits they can drift from a fresh sum by a few units in the last
+        place; this resets them.
+        """
+        self._grams = sum(x.grams for x in self._ingredient_amounts)
+        self._calories = sum(x.calories for x in self._ingredient_amounts)
+
+    def _amount_changed(self, delta_grams, delta_calories):
+        """
+        Called by one of our ingredient amounts when it changes.
+        """
+        self._grams += delta_grams
+        self._calories += delta_calories
+
+    def add_ingredient_amount(self, amount):
+        self._ingredient_amounts.append(amount)
+        amount._add_owner(self)
+        self._amount_changed(amount.grams, amount.calories)
+
+    def remove_ingredient_amount(self, amount):
+        """
+        Remove amount from the recipe. This takes time proportional to the number of ingredient amounts.
+        """
+        for i, x in enumerate(self._ingredient_amounts):
+            if x is amount:
+                del self._ingredient_amounts[i]
+                break
+        else:
+            raise ValueError("{amount} is not in recipe {name}".format(amount = amount, name = self.name))
+        amount._remove_owner(self)
+        self._amount_changed(-amount.grams, -amount.calories)
 
     @staticmethod
     def ounces_to_grams(ounces):
@@ -103,9 +282,10 @@ class Recipe:
         """
         Create a new recipe object whose ingredient amounts are
         specified by the key/value pairs in ingredient_amount_dict,
-        where the key is not a string but an Ingredient object.
+        where the key is the class name of an Ingredient, e.g. 'Lemon'.
         """
-        return cls(name, [IngredientAmount(ingredient = eval(ingr), grams = amt) for ingr, amt in ingredient_amounts.items()])
+        return cls(name, [IngredientAmount(ingredient = Ingredient.lookup(ingr), grams = amt)
+                          for ingr, amt in ingredient_amounts.items()])
 
     @classmethod
     def make_from_ounces(cls, name, **ingredient_amounts):
@@ -114,16 +294,28 @@ class Recipe:
 
     @property
     def calories(self):
-        return sum(x.calories for x in self._ingredient_amounts)
+        return self._calories
 
     @property
     def grams(self):
-        return sum(x.grams for x in self._ingredient_amounts)
+        return self._grams
+
+    @property
+    def volume(self):
+        """
+        The volume of the recipe, in cm^3. Unlike grams and calories, this is summed when read, since the volume of
+        an ingredient without a DENSITY is undefined.
+        """
+        return sum(x.volume for x in self._ingredient_amounts)
 
     @property
     def name(self):
         return self._name
 
+    @property
+    def ingredient_amounts(self):
+        return tuple(self._ingredient_amounts)
+
     def __repr__(self):
         lines = ["<{name}:".format(name = self.name)]
         lines.extend('    ' + str(ingred_amt) for ingred_amt in self._ingredient_amounts)
@@ -132,8 +324,279 @@ class Recipe:
         lines.append('>')
         return '\n'.join(lines)
 
+# =============================================================================
+#                     Bulk loading
+# =============================================================================
+def read_recipes(path, file_format = None, units = 'grams', frozen = False):
+    """
+    Yield a Recipe for each recipe in the file path, reading it a recipe at a time.
+
+    A .jsonl file has one recipe per line, and a .json file holds a list of them, each of the form
+        {"name": "lemonade", "ingredients": {"Sugar": 12, "Lemon": 20, "Water": 50}}
+    A .csv file has one ingredient amount per row, with the rows of a recipe next to each other:
+        name,ingredient,amount
+        lemonade,Sugar,12
+        lemonade,Lemon,20
+    :param file_format: 'json', 'jsonl' or 'csv'; by default, taken from the extension of path.
+    :param units: 'grams' or 'ounces', the units of the amounts.
+    :param frozen: if true, the recipes are made of interned FrozenIngredientAmounts, which use much less memory.
+    """
+    if file_format is None:
+        file_format = os.path.splitext(path)[1].lower().lstrip('.')
+    if units not in ('grams', 'ounces'):
+        raise ValueError("Unknown units: {units}".format(units = units))
+    scale = Recipe.ounces_to_grams(1) if units == 'ounces' else 1
+
+    with open(path, newline = '') as f:
+        if file_format == 'jsonl':
+            records = (json.loads(line) for line in f if line.strip()) # Skip blank lines, such as a trailing one.
+            pairs = ((record['name'], record['ingredients'].items()) for record in records)
+        elif file_format == 'json':
+            pairs = ((record['name'], record['ingredients'].items()) for record in json.load(f))
+        elif file_format == 'csv':
+            pairs = _group_csv_rows(csv.DictReader(f))
+        else:
+            raise ValueError("Unknown recipe file format: {file_format}".format(file_format = file_format))
+
+        lookup = Ingredient.lookup
+        make_amount = FrozenIngredientAmount.intern if frozen else IngredientAmount
+        for name, amounts in pairs:
+            yield Recipe(name, [make_amount(lookup(ingr), float(amt) * scale) for ingr, amt in amounts])
+
+
+def _group_csv_rows(rows):
+    """
+    Yield a (name, [(ingredient, amount), ...]) pair for each run of rows with the same recipe name.
+    """
+    name, amounts = None, []
+    for row in rows:
+        if row['name'] != name:
+            if amounts:
+                yield name, amounts
+            name, amounts = row['name'], []
+        amounts.append((row['ingredient'], row['amount']))
+    if amounts:
+        yield name, amounts
+
+
+def write_recipes(path, recipes):
+    """
+    Write recipes, an iterable of (name, {ingredient_class_name: amount}) pairs, to path, in the format
+    implied by its extension: .json, .jsonl or .csv. The inverse of read_recipes().
+    """
+    file_format = os.path.splitext(path)[1].lower().lstrip('.')
+    if file_format not in ('json', 'jsonl', 'csv'):
+        raise ValueError("Unknown recipe file format: {file_format}".format(file_format = file_format))
+    with open(path, 'w', newline = '') as f:
+        if file_format == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(['name', 'ingredient', 'amount'])
+            writer.writerows((name, ingr, amt) for name, amounts in recipes for ingr, amt in amounts.items())
+        elif file_format == 'jsonl':
+            f.writelines(json.dumps({'name': name, 'ingredients': amounts}) + '\n' for name, amounts in recipes)
+        else:
+            json.dump([{'name': name, 'ingredients': amounts} for name, amounts in recipes], f)
+
+
+# =============================================================================
+#                     Test
+# =============================================================================
+def random_recipes(n, seed = 0):
+    """
+    Return n synthetic (name, {ingredient_class_name: ounces}) pairs, for timing runs.
+    """
+    import random
+    rng = random.Random(seed)
+    names = sorted(Ingredient._registry)
+    return [('recipe{i}'.format(i = i), {ingr: rng.randint(1, 64) for ingr in rng.sample(names, rng.randint(1, len(names)))})
+            for i in range(n)]
+
+
+def benchmark(n = 20000):
+    """
+    Time building n recipes with eval() per ingredient, as Recipe.make used to, with the registry, and from files.
+    """
+    recipes = random_recipes(n)
+
+    def make_with_eval(name, **ingredient_amounts):
+        return Recipe(name, [IngredientAmount(ingredient = eval(ingr), grams = Recipe.ounces_to_grams(amt))
+                             for ingr, amt in ingredient_amounts.items()])
+
+    timings = []
+    for label, build in [('eval() per ingredient', lambda: [make_with_eval(name, **amounts) for name, amounts in recipes]),
+                         ('make_from_ounces, registry', lambda: [Recipe.make_from_ounces(name, **amounts)
+                                                                 for name, amounts in recipes])]:
+        start = time.perf_counter()
+        built = build()
+        timings.append((label, time.perf_counter() - start))
+
+    for extension in ['.jsonl', '.csv']:
+        path = 'recipes_benchmark' + extension
+        write_recipes(path, recipes)
+        start = time.perf_counter()
+        loaded = list(read_recipes(path, units = 'ounces'))
+        timings.append(('read_recipes, ' + extension, time.perf_counter() - start))
+        os.remove(path)
+        assert [repr(recipe) for recipe in loaded] == [repr(recipe) for recipe in built]
+
+    for label, seconds in timings:
+        print("{label:<28}{n} recipes in {seconds:.3f}s".format(label = label, n = n, seconds = seconds))
+
+
+def benchmark_edits(n_ingredients = 5000, n_edits = 20000):
+    """
+    Time repeated single-amount edits of a recipe with n_ingredients amounts, each followed by a read of its
+    calories, against re-summing the amounts on every read, as Recipe used to.
+    """
+    import math
+    import random
+    rng = random.Random(0)
+    ingredients = [Ingredient.lookup(name) for name in sorted(Ingredient._registry)]
+    recipe = Recipe('big', [IngredientAmount(rng.choice(ingredients), rng.uniform(1, 100)) for _ in range(n_ingredients)])
+    amounts = recipe.ingredient_amounts
+    edits = [(rng.choice(amounts), rng.uniform(1, 100)) for _ in range(n_edits)]
+
+    start = time.perf_counter()
+    for amount, grams in edits:
+        amount.grams = grams
+        recipe.calories
+    running_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for amount, grams in edits[:n_edits // 100]:
+        amount.grams = grams
+        sum(x.calories for x in amounts)
+    resum_seconds = (time.perf_counter() - start) * 100
+
+    running = recipe.calories, recipe.grams
+    recipe.recompute()
+    assert all(math.isclose(a, b, rel_tol = 1e-9) for a, b in zip(running, (recipe.calories, recipe.grams)))
+    print("{n} edits of a {k}-ingredient recipe: running totals {running:.3f}s, re-summing {resum:.2f}s (estimated)".format(
+        n = n_edits, k = n_ingredients, running = running_seconds, resum = resum_seconds))
+
+
+def benchmark_memory(n = 1_000_000):
+    """
+    Measure the memory taken by a catalog of n synthetic recipes held as Recipes of IngredientAmounts, as Recipes of
+    interned FrozenIngredientAmounts, and as a NutritionCatalog.
+    """
+    import gc
+    import tracemalloc
+    from sandbox.josh_sandbox.nutrition import NutritionCatalog
+
+    records = [(name, [(Ingredient.lookup(ingr), Recipe.ounces_to_grams(amt)) for ingr, amt in amounts.items()])
+               for name, amounts in random_recipes(n)]
+    builds = [('IngredientAmount', lambda: [Recipe(name, [IngredientAmount(ingr, grams) for ingr, grams in amounts])
+                                            for name, amounts in records]),
+              ('FrozenIngredientAmount', lambda: [Recipe(name, [FrozenIngredientAmount.intern(ingr, grams)
+                                                                for ingr, grams in amounts])
+                                                  for name, amounts in records]),
+              ('NutritionCatalog', lambda: NutritionCatalog.from_records(
+                  (name, [(ingr.__name__, grams) for ingr, grams in amounts]) for name, amounts in records))]
+    n_amounts = sum(len(amounts) for _, amounts in records)
+    for label, build in builds:
+        gc.collect()
+        tracemalloc.start()
+        catalog = build()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del catalog
+        print("{label:<24}{n} recipes, {k} amounts: {mb:.0f} MB, {per:.0f} bytes per amount".format(
+            label = label, n = n, k = n_amounts, mb = size / 2 ** 20, per = size / n_amounts))
+    FrozenIngredientAmount._interned.clear()
+
+
 def test():
-    print(Recipe.make_from_ounces('lemonade', Sugar = 12, Lemon = 20, Water = 50))
+    import math
+    lemonade = Recipe.make_from_ounces('lemonade', Sugar = 12, Lemon = 20, Water = 50)
+    print(lemonade)
+
+    # Edits of an amount reach every recipe that holds it.
+    lemon = IngredientAmount(Lemon, 20)
+    lemon_water = Recipe('lemon water', [lemon, IngredientAmount(Water, 50)])
+    double_lemon = Recipe('double lemon', [lemon, lemon])
+    lemon.grams = 30
+    lemon.ingredient = Sugar
+    assert lemon_water.grams == 80 and math.isclose(lemon_water.calories, 30 * Sugar.CALORIES)
+    assert double_lemon.grams == 60 and math.isclose(double_lemon.calories, 60 * Sugar.CALORIES)
+    double_lemon.remove_ingredient_amount(lemon)
+    lemon.grams = 10
+    assert double_lemon.grams == 10 and lemon_water.grams == 60
+    double_lemon.add_ingredient_amount(IngredientAmount(Water, 5))
+    assert double_lemon.grams == 15
+
+    # A recipe that is gone no longer hears from its amounts, and ingredients without a DENSITY still work.
+    del lemon_water
+    lemon.grams = 11
+    assert len(lemon._owners) == 1 # double_lemon still holds it once.
+
+    class Salt(Ingredient):
+        NAME = 'salt'
+    salted = Recipe('salted', [IngredientAmount(Salt, 5)])
+    salted.ingredient_amounts[0].grams = 6
+    assert salted.grams == 6
+    del Ingredient._registry['Salt']
+
+    # Copies and unpickled recipes keep their own totals, and never change the original's.
+    import copy
+    import pickle
+    original = Recipe('lemonade', [IngredientAmount(Sugar, 10), IngredientAmount(Water, 90)])
+    amounts = [IngredientAmount(Lemon, 5)]
+    listed = Recipe('listed', amounts)
+    amounts.append(IngredientAmount(Water, 100))
+    assert listed.grams == 5 and len(listed.ingredient_amounts) == 1
+    for duplicate in [copy.deepcopy(original), pickle.loads(pickle.dumps(original))]:
+        duplicate.ingredient_amounts[0].grams = 15
+        assert original.grams == 100 and duplicate.grams == 105
+        assert original.ingredient_amounts[0].grams == 10
+    shallow = copy.copy(original)
+    original.ingredient_amounts[0].grams = 20  # Shared by the shallow copy.
+    assert original.grams == shallow.grams == 110
+    sugar = copy.copy(original.ingredient_amounts[0])
+    sugar.grams = 5
+    assert original.grams == 110 and sugar.grams == 5 and not sugar._owners
+
+    # Frozen amounts are interned and immutable, and recipes made of them print the same.
+    frozen = Recipe('lemonade', [FrozenIngredientAmount.intern(x.ingredient, x.grams) for x in lemonade.ingredient_amounts])
+    assert repr(frozen) == repr(lemonade)
+    assert FrozenIngredientAmount.intern(Lemon, 20) is FrozenIngredientAmount.intern(Lemon, 20)
+    try:
+        FrozenIngredientAmount.intern(Lemon, 20).grams = 30
+    except AttributeError:
+        pass
+    else:
+        raise AssertionError("FrozenIngredientAmount is mutable.")
+    assert pickle.loads(pickle.dumps(frozen)).ingredient_amounts == frozen.ingredient_amounts
+    assert copy.deepcopy(frozen).ingredient_amounts == frozen.ingredient_amounts
+
+    # Recipe files round-trip, blank lines in JSONL files are skipped, and unknown formats are rejected.
+    import tempfile
+    recipes = random_recipes(10)
+    with tempfile.TemporaryDirectory() as directory:
+        for extension in ['.json', '.jsonl', '.csv']:
+            path = os.path.join(directory, 'recipes' + extension)
+            write_recipes(path, recipes)
+            if extension == '.jsonl':
+                with open(path, 'a') as f:
+                    f.write('\n\n')
+            assert [recipe.name for recipe in read_recipes(path)] == [name for name, _ in recipes]
+        try:
+            write_recipes(os.path.join(directory, 'recipes.txt'), recipes)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("write_recipes() accepted an unknown format.")
+
+
+def benchmarks():
+    benchmark()
+    benchmark_edits()
+    benchmark_memory()
+
 
 if __name__ == '__main__':
-    test()
\ No newline at end of file
+    import sys
+    if '--benchmark' in sys.argv[1:]: # python -m sandbox.josh_sandbox.josh_sandbox2 --benchmark
+        benchmarks()
+    else:
+        test()
\ No newline at end of file
@@ -0,0 +1,140 @@
+"""
+This file defines NutritionCatalog, which computes the calories, grams and volumes of a whole catalog of
+recipes (see josh_sandbox2.py) at once, with NumPy, rather than one Recipe property access at a time.
+
+The catalog keeps the constants of every registered Ingredient subclass as arrays (CALORIES and DENSITY,
+indexed by ingredient number) and the recipes as a sparse recipe x ingredient matrix of grams, in compressed
+sparse row (CSR) form: for recipe r, indices[indptr[r]:indptr[r + 1]] are its ingredient numbers and
+grams[indptr[r]:indptr[r + 1]] their amounts, in the recipe's own order.
+
+Each total is then one sparse matrix-vector product, e.g. calories = G @ CALORIES, computed as
+a product per stored entry followed by a sum per row. The sums add each row's entries from left to right,
+starting at 0, exactly as sum() does over a Recipe's ingredient amounts, so the results are equal, bit for bit,
+to Recipe.calories, Recipe.grams and Recipe.volume.
+
+SciPy is not needed; a CSR product is a few lines of NumPy.
+"""
+import time
+
+import numpy as np
+
+from sandbox.josh_sandbox.josh_sandbox2 import Ingredient, Recipe
+
+
+class NutritionCatalog:
+    def __init__(self, names, indptr, indices, grams, ingredients = None):
+        """
+        Build a catalog from its CSR arrays; see from_recipes() and from_records() for easier ways.
+        :param names: the name of each recipe.
+        :param indptr: int array of len(names) + 1 row boundaries.
+        :param indices: the ingredient number of each stored entry, indexing ingredients.
+        :param grams: the grams of each stored entry.
+        :param ingredients: the Ingredient subclasses, in ingredient-number order; defaults to every registered one.
+        """
+        self.ingredients = list(ingredients) if ingredients is not None else self.registered_ingredients()
+        self.names = list(names)
+        self.indptr = np.asarray(indptr, dtype = np.int64)
+        self.indices = np.asarray(indices, dtype = np.int64)
+        self.grams_data = np.asarray(grams, dtype = np.float64)
+        if len(self.indptr) != len(self.names) + 1 or not self.indptr[-1] == len(self.indices) == len(self.grams_data):
+            raise ValueError("Inconsistent CSR arrays.")
+
+        self.calories_per_gram = np.array([ingredient.CALORIES for ingredient in self.ingredients], dtype = np.float64)
+        self.density = np.array([ingredient.DENSITY for ingredient in self.ingredients], dtype = np.float64)
+        self._rows = np.repeat(np.arange(len(self.names)), np.diff(self.indptr)) # The recipe of each stored entry.
+
+    @staticmethod
+    def registered_ingredients():
+        return [Ingredient._registry[name] for name in sorted(Ingredient._registry)]
+
+    @classmethod
+    def from_recipes(cls, recipes):
+        """
+        Build a catalog of Recipe objects.
+        """
+        return cls.from_records((recipe.name, [(amount.ingredient.__name__, amount.grams) for amount in recipe.ingredient_amounts])
+                                for recipe in recipes)
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        Build a catalog straight from (name, amounts) pairs, without creating Recipe objects, where amounts is a
+        dict, or a list of pairs, mapping ingredient class names (e.g. 'Lemon') to grams.
+        """
+        ingredients = cls.registered_ingredients()
+        number = {ingredient.__name__: i for i, ingredient in enumerate(ingredients)}
+        names, indptr, indices, grams = [], [0], [], []
+        for name, amounts in records:
+            if isinstance(amounts, dict):
+                amounts = amounts.items()
+            for ingr, amount in amounts:
+                if ingr not in number:
+                    Ingredient.lookup(ingr) # Raises ValueError for unknown names.
+                indices.append(number[ingr])
+                grams.append(amount)
+            names.append(name)
+            indptr.append(len(indices))
+        return cls(names, indptr, indices, grams, ingredients)
+
+    def __len__(self):
+        return len(self.names)
+
+    # =============================================================================
+    #                     Totals
+    # =============================================================================
+    def _row_sums(self, entries):
+        """
+        Return, for each recipe, the sum of entries (one value per stored entry) over its row, added left to right.
+        """
+        return np.bincount(self._rows, weights = entries, minlength = len(self.names))
+
+    def calories(self):
+        """
+        Return the calories of every recipe: the product of the gram matrix with the calories-per-gram vector.
+        """
+        return self._row_sums(self.grams_data * self.calories_per_gram[self.indices])
+
+    def grams(self):
+        return self._row_sums(self.grams_data)
+
+    def volumes(self):
+        """
+        Return the volume of every recipe, in cm^3: the sum of grams / DENSITY over its ingredients.
+        """
+        return self._row_sums(self.grams_data / self.density[self.indices])
+
+    def calories_per_cm3(self):
+        """
+        Return the calorie density of every recipe, i.e., its calories divided by its volume.
+        """
+        return self.calories() / self.volumes()
+
+
+# =============================================================================
+#                     Test
+# =============================================================================
+def test(n = 200_000):
+    from sandbox.josh_sandbox.josh_sandbox2 import random_recipes
+
+    records = random_recipes(n)
+    recipes = [Recipe.make_from_ounces(name, **amounts) for name, amounts in records]
+
+    start = time.perf_counter()
+    expected = {'calories': [recipe.calories for recipe in recipes],
+                'grams': [recipe.grams for recipe in recipes],
+                'volumes': [recipe.volume for recipe in recipes]}
+    object_seconds = time.perf_counter() - start
+
+    catalog = NutritionCatalog.from_recipes(recipes)
+    start = time.perf_counter()
+    actual = {'calories': catalog.calories(), 'grams': catalog.grams(), 'volumes': catalog.volumes()}
+    catalog_seconds = time.perf_counter() - start
+
+    for name in expected:
+        assert actual[name].tolist() == expected[name], "Catalog {name} differ from the Recipe properties".format(name = name)
+    print("{n} recipes: Recipe properties {object:.3f}s, NutritionCatalog {catalog:.3f}s".format(
+        n = n, object = object_seconds, catalog = catalog_seconds))
+
+
+if __name__ == '__main__':
+    test()
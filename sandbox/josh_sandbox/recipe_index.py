@@ -0,0 +1,318 @@
+"""
+This file defines RecipeIndex, which finds the recipes (see josh_sandbox2.py) of a collection that satisfy a
+query such as "under 300 calories and containing Lemon" without looking at every recipe.
+
+The index keeps:
+    - the recipe ids sorted by total calories, and sorted by total grams, so that the recipes in a range of
+      either are a contiguous run, found with bisect. The sorted ids are kept in buckets of about a thousand,
+      so adding or removing a recipe does not shift a list of every recipe;
+    - an inverted index from each Ingredient class to the set of ids of the recipes that contain it.
+
+A query is answered by counting how many recipes each of its conditions admits, which takes a few bisections
+or a len(), starting from the ids admitted by the most selective condition, and narrowing them down by the others.
+The time taken grows with the number of recipes that the most selective condition admits, not with the size of
+the index.
+
+    index = RecipeIndex(recipes)
+    index.search(calories = (None, 300), ingredients = [Lemon])
+
+Recipes can be added and removed at any time. Recipes are mutable, though (see IngredientAmount), and the index
+does not watch them: after editing an indexed recipe, call refresh() with its id.
+"""
+import time
+from bisect import bisect_left, bisect_right
+
+from sandbox.josh_sandbox.josh_sandbox2 import FrozenIngredientAmount, Ingredient, Recipe, random_recipes
+
+
+class _SortedColumn:
+    """
+    Recipe ids sorted by a key, with ties in id order. The (key, id) entries are held in buckets of about
+    BUCKET_SIZE, each a pair of parallel lists, keys and ids, so that inserting or removing an entry moves at most
+    a bucket's worth of items rather than shifting a list of every recipe.
+    """
+    BUCKET_SIZE = 1000
+
+    def __init__(self, keys_by_id):
+        """
+        :param keys_by_id: a dict mapping each recipe id to its key.
+        """
+        ids = sorted(keys_by_id, key = keys_by_id.__getitem__)  # sorted() is stable, so ties stay in id order.
+        size = self.BUCKET_SIZE
+        self._ids = [ids[i:i + size] for i in range(0, len(ids), size)] or [[]]
+        self._keys = [[keys_by_id[recipe_id] for recipe_id in bucket] for bucket in self._ids]
+        self._maxes = [self._max(b) for b in range(len(self._ids))]
+
+    def _max(self, b):
+        """
+        Return the largest (key, id) entry of bucket b, or None if it is empty.
+        """
+        return (self._keys[b][-1], self._ids[b][-1]) if self._ids[b] else None
+
+    def _bucket(self, entry):
+        """
+        Return the bucket in which entry, a (key, id) pair or a (key,) lower bound, belongs.
+        """
+        if self._maxes[-1] is None:
+            return 0
+        return min(bisect_left(self._maxes, entry), len(self._maxes) - 1)
+
+    def _position(self, key, recipe_id):
+        b = self._bucket((key, recipe_id))
+        keys = self._keys[b]
+        return b, bisect_left(self._ids[b], recipe_id, bisect_left(keys, key), bisect_right(keys, key))
+
+    def insert(self, key, recipe_id):
+        b, i = self._position(key, recipe_id)
+        keys, ids = self._keys[b], self._ids[b]
+        keys.insert(i, key)
+        ids.insert(i, recipe_id)
+        if len(ids) > 2 * self.BUCKET_SIZE:
+            half = len(ids) // 2
+            self._keys[b + 1:b + 1] = [keys[half:]]
+            self._ids[b + 1:b + 1] = [ids[half:]]
+            del keys[half:], ids[half:]
+            self._maxes[b + 1:b + 1] = [None]
+            self._maxes[b + 1] = self._max(b + 1)
+        self._maxes[b] = self._max(b)
+
+    def remove(self, key, recipe_id):
+        b, i = self._position(key, recipe_id)
+        keys, ids = self._keys[b], self._ids[b]
+        if i == len(ids) or ids[i] != recipe_id or keys[i] != key:
+            raise ValueError("Recipe {recipe_id} is not indexed under {key}".format(recipe_id = recipe_id, key = key))
+        del keys[i], ids[i]
+        if ids or len(self._ids) == 1:
+            self._maxes[b] = self._max(b)
+        else:
+            del self._keys[b], self._ids[b], self._maxes[b]
+
+    def _lower_bound(self, key):
+        """
+        Return the (bucket, index) position of the first entry whose key is >= key; None means past the end.
+        """
+        if key is None:
+            return 0, 0
+        b = self._bucket((key,))
+        return b, bisect_left(self._keys[b], key)
+
+    def span(self, low, high):
+        """
+        Return the (start, stop) positions of the entries with low <= key < high, and how many there are.
+        None means unbounded.
+        """
+        start = self._lower_bound(low)
+        stop = (len(self._ids) - 1, len(self._ids[-1])) if high is None else self._lower_bound(high)
+        if stop <= start:
+            return start, start, 0
+        (b0, i0), (b1, i1) = start, stop
+        return start, stop, sum(map(len, self._ids[b0:b1])) - i0 + i1
+
+    def ids(self, start, stop):
+        """
+        Return a list of the ids of the entries from position start up to position stop.
+        """
+        (b0, i0), (b1, i1) = start, stop
+        if b0 == b1:
+            return self._ids[b0][i0:i1]
+        result = self._ids[b0][i0:]
+        for bucket in self._ids[b0 + 1:b1]:
+            result.extend(bucket)
+        result.extend(self._ids[b1][:i1])
+        return result
+
+
+class RecipeIndex:
+    def __init__(self, recipes = ()):
+        """
+        Index recipes, which are given ids 0, 1, 2, ... in order.
+        """
+        self._recipes = {}  # Id -> Recipe.
+        self._entries = {}  # Id -> the (calories, grams, ingredients) the recipe is indexed under.
+        self._by_ingredient = {}  # Ingredient class -> set of ids.
+        self._next_id = 0
+        for recipe in recipes:
+            self._add_entry(recipe)
+        self._by_calories = _SortedColumn({recipe_id: entry[0] for recipe_id, entry in self._entries.items()})
+        self._by_grams = _SortedColumn({recipe_id: entry[1] for recipe_id, entry in self._entries.items()})
+
+    def __len__(self):
+        return len(self._recipes)
+
+    def __getitem__(self, recipe_id):
+        return self._recipes[recipe_id]
+
+    # =============================================================================
+    #                     Maintenance
+    # =============================================================================
+    def _add_entry(self, recipe, recipe_id = None):
+        if recipe_id is None:
+            recipe_id = self._next_id
+            self._next_id += 1
+        ingredients = tuple({amount.ingredient: None for amount in recipe.ingredient_amounts})
+        self._recipes[recipe_id] = recipe
+        self._entries[recipe_id] = entry = (recipe.calories, recipe.grams, ingredients)
+        for ingredient in ingredients:
+            self._by_ingredient.setdefault(ingredient, set()).add(recipe_id)
+        return recipe_id, entry
+
+    def add(self, recipe):
+        """
+        Add recipe to the index.
+        :return: its id.
+        """
+        recipe_id, (calories, grams, _) = self._add_entry(recipe)
+        self._by_calories.insert(calories, recipe_id)
+        self._by_grams.insert(grams, recipe_id)
+        return recipe_id
+
+    def remove(self, recipe_id):
+        """
+        Remove the recipe with id recipe_id from the index.
+        :return: the recipe.
+        """
+        if recipe_id not in self._recipes:
+            raise ValueError("No recipe has id {recipe_id}".format(recipe_id = recipe_id))
+        calories, grams, ingredients = self._entries.pop(recipe_id)
+        self._by_calories.remove(calories, recipe_id)
+        self._by_grams.remove(grams, recipe_id)
+        for ingredient in ingredients:
+            recipe_ids = self._by_ingredient[ingredient]
+            recipe_ids.discard(recipe_id)
+            if not recipe_ids:
+                del self._by_ingredient[ingredient]
+        return self._recipes.pop(recipe_id)
+
+    def refresh(self, recipe_id):
+        """
+        Re-index the recipe with id recipe_id, after it has been edited. It keeps its id.
+        """
+        recipe = self.remove(recipe_id)
+        _, (calories, grams, _) = self._add_entry(recipe, recipe_id)
+        self._by_calories.insert(calories, recipe_id)
+        self._by_grams.insert(grams, recipe_id)
+
+    # =============================================================================
+    #                     Queries
+    # =============================================================================
+    def search_ids(self, calories = None, grams = None, ingredients = (), excluded = ()):
+        """
+        Return the ids of the recipes that satisfy every condition given, in no particular order.
+        :param calories: a (low, high) pair; admits recipes with low <= calories < high. Either bound may be None.
+        :param grams: a (low, high) pair, likewise.
+        :param ingredients: Ingredient classes that the recipe must all contain.
+        :param excluded: Ingredient classes that the recipe must not contain.
+        """
+        # Each condition is a (size, kind, data) triple, with size the number of recipes it admits. kind is 'range',
+        # with data a (column, start, stop, position, low, high) tuple, or 'ingredient', with data a set of ids.
+        conditions = []
+        for position, (bounds, column) in enumerate([(calories, self._by_calories), (grams, self._by_grams)]):
+            if bounds is not None:
+                start, stop, size = column.span(*bounds)
+                conditions.append((size, 'range', (column, start, stop, position) + tuple(bounds)))
+        for ingredient in ingredients:
+            recipe_ids = self._by_ingredient.get(ingredient, set())
+            conditions.append((len(recipe_ids), 'ingredient', recipe_ids))
+        if not conditions:
+            result = set(self._recipes)
+        else:
+            # Start from the most selective condition. Narrow down with set operations, which run at C speed, and
+            # check a range by looking up each remaining recipe's entry only when there are fewer of them than
+            # the range admits.
+            conditions.sort(key = lambda condition: condition[0])
+            _, kind, data = conditions[0]
+            result = set(data[0].ids(data[1], data[2])) if kind == 'range' else set(data)
+            for size, kind, data in conditions[1:]:
+                if kind == 'ingredient':
+                    result &= data
+                elif len(result) < size:
+                    result = set(filter(self._range_check(*data[3:]), result))
+                else:
+                    result.intersection_update(data[0].ids(data[1], data[2]))
+        for ingredient in excluded:
+            result -= self._by_ingredient.get(ingredient, set())
+        return list(result)
+
+    def _range_check(self, position, low, high):
+        """
+        Return a predicate on recipe ids that is true when low <= entry[position] < high.
+        """
+        low = float('-inf') if low is None else low
+        high = float('inf') if high is None else high
+        entries = self._entries
+        return lambda recipe_id: low <= entries[recipe_id][position] < high
+
+    def search(self, calories = None, grams = None, ingredients = (), excluded = ()):
+        """
+        Return the recipes that satisfy every condition given; see search_ids().
+        """
+        return [self._recipes[recipe_id] for recipe_id in self.search_ids(calories, grams, ingredients, excluded)]
+
+
+# =============================================================================
+#                     Test
+# =============================================================================
+def _brute_force(index, calories = None, grams = None, ingredients = (), excluded = ()):
+    """
+    Answer a query by checking every indexed recipe, for comparison with RecipeIndex.search_ids().
+    """
+    def within(value, bounds):
+        return bounds is None or ((bounds[0] is None or bounds[0] <= value) and (bounds[1] is None or value < bounds[1]))
+
+    result = []
+    for recipe_id, recipe in index._recipes.items():
+        contained = {amount.ingredient for amount in recipe.ingredient_amounts}
+        if (within(recipe.calories, calories) and within(recipe.grams, grams) and contained.issuperset(ingredients)
+                and contained.isdisjoint(excluded)):
+            result.append(recipe_id)
+    return sorted(result)
+
+
+def test(n = 1_000_000):
+    lemon, sugar, water = (Ingredient.lookup(name) for name in ['Lemon', 'Sugar', 'Water'])
+    queries = [{'calories': (None, 300), 'ingredients': [lemon]},
+               {'calories': (1000, 1010)},
+               {'calories': (2000, 2100), 'grams': (1500, 1600), 'excluded': [water]},
+               {'grams': (None, 100), 'ingredients': [sugar, lemon]},
+               {'ingredients': [sugar], 'excluded': [lemon, water]}]
+
+    # Check every query against brute force, including after adds, removes and an edit.
+    small = RecipeIndex(Recipe.make_from_ounces(name, **amounts) for name, amounts in random_recipes(2000, seed = 1))
+    for name, amounts in random_recipes(100, seed = 2):
+        small.add(Recipe.make_from_ounces(name, **amounts))
+    for recipe_id in range(0, 2100, 3):
+        small.remove(recipe_id)
+    edited = small[1]
+    edited.ingredient_amounts[0].grams += 500
+    small.refresh(1)
+    for query in queries + [{}]:
+        assert sorted(small.search_ids(**query)) == _brute_force(small, **query), query
+
+    records = random_recipes(n)
+    recipes = [Recipe(name, [FrozenIngredientAmount.intern(Ingredient.lookup(ingr), Recipe.ounces_to_grams(amt))
+                             for ingr, amt in amounts.items()]) for name, amounts in records]
+    start = time.perf_counter()
+    index = RecipeIndex(recipes)
+    print("Indexed {n} recipes in {s:.2f}s".format(n = n, s = time.perf_counter() - start))
+
+    start = time.perf_counter()
+    new_ids = [index.add(recipe) for recipe in recipes[:1000]]
+    for recipe_id in new_ids:
+        index.remove(recipe_id)
+    print("Added and removed 1000 recipes in {ms:.3f}ms each".format(ms = (time.perf_counter() - start) * 1000 / 1000))
+
+    for query in queries:
+        repeats = 20
+        start = time.perf_counter()
+        for _ in range(repeats):
+            found = index.search_ids(**query)
+        description = ', '.join('{name}={value}'.format(name = name, value = [ingredient.__name__ for ingredient in value]
+                                                        if name in ('ingredients', 'excluded') else value)
+                                for name, value in query.items())
+        print("{query}: {k} recipes in {ms:.3f}ms".format(query = description, k = len(found),
+                                                          ms = (time.perf_counter() - start) * 1000 / repeats))
+    FrozenIngredientAmount._interned.clear()
+
+
+if __name__ == '__main__':
+    test()